@@ -0,0 +1,200 @@
+"""聊天后端压测驱动
+
+按真实前端的流程并发发起对话（--flow two-step 为 POST /api/chat 再 GET /api/chat/stream，
+--flow single 为一次 POST /api/chat/stream），统计：
+- TTFB：从发出 /api/chat 到收到第一个 content 帧的时间
+- tokens/sec：每个流内容部分的输出速度
+- 端到端延迟 p50/p99：从发出 /api/chat 到收到 done 帧
+- 最大同时打开的流数
+
+结果可以写成JSON，并与之前一次的结果对比。
+
+典型用法（在 backend 目录下）：
+    python bench/fake_llm_server.py --port 8300 &
+    python bench/tool_stubs.py --port 8301 &
+    AliDeep=fake LLM_BASE_URL=http://127.0.0.1:8300/v1 AMAP_BASE_URL=http://127.0.0.1:8301 \\
+    TIANAPI_BASE_URL=http://127.0.0.1:8301 HR_SERVICE_URL=http://127.0.0.1:8301 python llm_agent.py &
+    python bench/driver.py --concurrency 20 --requests 200 --output run.json --compare baseline.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context_window import count_text_tokens  # noqa: E402
+
+DEFAULT_QUESTIONS = [
+    "北京今天天气怎么样？",
+    "抖音热搜有哪些？",
+    "违章代码1301是什么？",
+    "查询2025-03-07的考勤记录",
+    "推荐系统设计需要考虑哪些因素？",
+]
+
+
+class StreamGauge:
+    """记录当前打开的流数及其最大值"""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        return self
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.current -= 1
+
+
+def iter_sse_events(response):
+    """解析SSE响应，逐个产出 data 字段的JSON"""
+    for line in response.iter_lines(decode_unicode=True):
+        if line and line.startswith("data: {"):
+            yield json.loads(line[len("data: "):])
+
+
+def open_stream(session, base_url, question, flow, timeout):
+    """按指定流程提交问题并打开流式响应"""
+    if flow == "single":
+        return session.post(f"{base_url}/api/chat/stream", json={"message": question},
+                            stream=True, timeout=timeout)
+    response = session.post(f"{base_url}/api/chat", json={"message": question, "stream": True},
+                            timeout=timeout)
+    session_id = response.json()["sessionId"]
+    return session.get(f"{base_url}/api/chat/stream", params={"sessionId": session_id},
+                       stream=True, timeout=timeout)
+
+
+def run_conversation(base_url, question, gauge, timeout, flow="two-step"):
+    """执行一次完整对话，返回单次的测量结果"""
+    session = requests.Session()
+    start = time.perf_counter()
+    result = {"ok": False, "ttfb": None, "latency": None, "tokens": 0, "stream_seconds": None}
+    try:
+        with gauge, open_stream(session, base_url, question, flow, timeout) as stream:
+            first_content_at = None
+            for event in iter_sse_events(stream):
+                if event.get("type") == "content":
+                    if first_content_at is None:
+                        first_content_at = time.perf_counter()
+                        result["ttfb"] = first_content_at - start
+                    result["tokens"] += count_text_tokens(event.get("content"))
+                elif event.get("type") == "error":
+                    result["error"] = event.get("content")
+                elif event.get("type") == "done":
+                    end = time.perf_counter()
+                    result["latency"] = end - start
+                    if first_content_at is not None:
+                        result["stream_seconds"] = end - first_content_at
+                    result["ok"] = "error" not in result
+                    break
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        session.close()
+    return result
+
+
+def percentile(values, p):
+    """计算百分位数（最近秩法）"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(results, wall_seconds, peak_streams, config):
+    """汇总单次压测的结果"""
+    ok = [r for r in results if r["ok"]]
+    ttfbs = [r["ttfb"] for r in ok if r["ttfb"] is not None]
+    latencies = [r["latency"] for r in ok]
+    rates = [r["tokens"] / r["stream_seconds"] for r in ok if r["stream_seconds"]]
+    return {
+        "config": {"concurrency": config.concurrency, "requests": config.requests, "flow": config.flow},
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "wall_seconds": wall_seconds,
+        "throughput_rps": len(ok) / wall_seconds if wall_seconds else 0,
+        "ttfb_p50": percentile(ttfbs, 50),
+        "ttfb_p99": percentile(ttfbs, 99),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "tokens_per_sec_p50": percentile(rates, 50),
+        "max_concurrent_streams": peak_streams,
+        "errors": sorted({r["error"] for r in results if r.get("error")})[:10],
+    }
+
+
+def print_report(summary, baseline=None):
+    """打印结果，提供基线时同时打印变化比例"""
+    keys = ["succeeded", "failed", "throughput_rps", "ttfb_p50", "ttfb_p99",
+            "latency_p50", "latency_p99", "tokens_per_sec_p50", "max_concurrent_streams"]
+    for key in keys:
+        value = summary[key]
+        line = f"{key:>24}: {value:.4f}" if isinstance(value, float) else f"{key:>24}: {value}"
+        old = (baseline or {}).get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"  (baseline {old:.4f}, {(value - old) / old:+.1%})"
+        print(line)
+    for error in summary["errors"]:
+        print(f"{'error':>24}: {error}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="聊天后端压测驱动")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5100")
+    parser.add_argument("--concurrency", type=int, default=10, help="并发对话数")
+    parser.add_argument("--requests", type=int, default=100, help="总对话数")
+    parser.add_argument("--questions", help="问题文件，每行一个问题")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--flow", choices=["two-step", "single"], default="two-step",
+                        help="two-step: POST /api/chat 后 GET 流；single: 一次 POST /api/chat/stream")
+    parser.add_argument("--output", help="把汇总结果写入JSON文件")
+    parser.add_argument("--compare", help="与之前保存的JSON结果对比")
+    return parser
+
+
+def main():
+    config = build_parser().parse_args()
+    questions = DEFAULT_QUESTIONS
+    if config.questions:
+        with open(config.questions, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    gauge = StreamGauge()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=config.concurrency) as executor:
+        futures = [
+            executor.submit(run_conversation, config.base_url, questions[i % len(questions)],
+                            gauge, config.timeout, config.flow)
+            for i in range(config.requests)
+        ]
+        results = [future.result() for future in futures]
+    summary = summarize(results, time.perf_counter() - start, gauge.peak, config)
+
+    baseline = None
+    if config.compare and os.path.exists(config.compare):
+        with open(config.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(summary, baseline)
+
+    if config.output:
+        with open(config.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""本地 OpenAI 兼容的 /chat/completions 替身服务
+
+用于在不调用 dashscope 的情况下压测后端，可配置：
+- 首字节延迟（TTFB）和每个数据块之间的延迟
+- 每个内容块的字符数（模拟上游把回答切成多少块）
+- 首轮请求返回工具调用的概率、一次返回几个工具调用，以及工具参数被切成几段
+
+用法：
+    python bench/fake_llm_server.py --port 8300 --ttfb 0.3 --chunk-delay 0.02
+    LLM_BASE_URL=http://127.0.0.1:8300/v1 python llm_agent.py
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 工具调用时使用的示例参数
+SAMPLE_TOOL_ARGUMENTS = {
+    "get_weather": [{"city": "北京"}, {"city": "上海"}, {"city": "广州"}],
+    "get_douyin_hot": [{}],
+    "query_violation_code": [{"code": "1301"}, {"code": "1208"}],
+    "get_attendance_records": [{"date": "2025-03-07"}],
+    "get_shift_info": [{"date": "2025-03-07"}],
+    "get_attendance_records_range": [{"start_date": "2025-03-03", "end_date": "2025-03-09"}],
+    "get_shift_info_range": [{"start_date": "2025-03-03", "end_date": "2025-03-09"}],
+}
+
+ANSWER_SENTENCE = "根据查询结果，今天北京晴，气温适宜，适合外出。"
+
+
+def split_text(text, size):
+    """把文本按固定字符数切块"""
+    return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+
+def split_parts(text, parts):
+    """把文本尽量均匀地切成 parts 段"""
+    parts = max(1, min(parts, len(text)))
+    step = -(-len(text) // parts)
+    return [text[i:i + step] for i in range(0, len(text), step)]
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        tool_calls = self.plan_tool_calls(body)
+        content = self.plan_content(tool_calls)
+        time.sleep(self.config.ttfb)
+
+        if body.get("stream"):
+            self.stream_response(body, content, tool_calls)
+        else:
+            self.json_response(body, content, tool_calls)
+
+    def plan_tool_calls(self, body):
+        """首轮（带 tools 且最后一条是用户消息）按概率返回工具调用"""
+        messages = body.get("messages") or []
+        if not body.get("tools") or not messages or messages[-1].get("role") != "user":
+            return []
+        if random.random() >= self.config.tool_call_rate:
+            return []
+        available = [tool["function"]["name"] for tool in body["tools"]
+                     if tool["function"]["name"] in SAMPLE_TOOL_ARGUMENTS]
+        names = [name for name in self.config.tools if name in available] or available
+        return [
+            {
+                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "name": name,
+                "arguments": json.dumps(random.choice(SAMPLE_TOOL_ARGUMENTS[name]), ensure_ascii=False),
+            }
+            for name in random.sample(names, min(self.config.parallel_tools, len(names)))
+        ]
+
+    def plan_content(self, tool_calls):
+        """生成ReAct格式的回答文本"""
+        if tool_calls:
+            return "**思考:** 需要调用工具获取信息。\n\n**行动:** 调用工具。"
+        repeat = max(1, self.config.answer_chars // len(ANSWER_SENTENCE))
+        return "**思考:** 分析用户问题。\n\n**最终答案:** " + ANSWER_SENTENCE * repeat
+
+    def chunk_payload(self, body, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def write_chunk(self, data):
+        """以 HTTP chunked 编码写出一段数据并立即刷新"""
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def stream_response(self, body, content, tool_calls):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        deltas = [{"role": "assistant", "content": piece}
+                  for piece in split_text(content, self.config.chunk_chars)]
+        for index, tool_call in enumerate(tool_calls):
+            fragments = split_parts(tool_call["arguments"], self.config.arg_fragments)
+            deltas.append({"tool_calls": [{
+                "index": index, "id": tool_call["id"], "type": "function",
+                "function": {"name": tool_call["name"], "arguments": fragments[0]},
+            }]})
+            deltas.extend({"tool_calls": [{"index": index, "function": {"arguments": fragment}}]}
+                          for fragment in fragments[1:])
+
+        for i, delta in enumerate(deltas):
+            if i:
+                time.sleep(self.config.chunk_delay)
+            payload = self.chunk_payload(body, delta)
+            self.write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode())
+        finish_reason = "tool_calls" if tool_calls else "stop"
+        payload = self.chunk_payload(body, {}, finish_reason)
+        self.write_chunk(f"data: {json.dumps(payload)}\n\n".encode())
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def json_response(self, body, content, tool_calls):
+        # 非流式响应按内容块数模拟生成耗时
+        time.sleep(self.config.chunk_delay * len(split_text(content, self.config.chunk_chars)))
+        message = {"role": "assistant", "content": content}
+        if tool_calls:
+            message["tool_calls"] = [
+                {"id": tc["id"], "type": "function",
+                 "function": {"name": tc["name"], "arguments": tc["arguments"]}}
+                for tc in tool_calls
+            ]
+        payload = json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": message,
+                         "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(content), "total_tokens": len(content)},
+        }, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8300)
+    parser.add_argument("--ttfb", type=float, default=0.3, help="首字节延迟（秒）")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="数据块间隔（秒）")
+    parser.add_argument("--chunk-chars", type=int, default=2, help="每个内容块的字符数")
+    parser.add_argument("--answer-chars", type=int, default=200, help="最终答案的大致字符数")
+    parser.add_argument("--tool-call-rate", type=float, default=0.5, help="首轮返回工具调用的概率")
+    parser.add_argument("--parallel-tools", type=int, default=1, help="一次返回的工具调用个数")
+    parser.add_argument("--arg-fragments", type=int, default=3, help="工具参数被切成的段数")
+    parser.add_argument("--tools", type=lambda s: [t for t in s.split(",") if t], default=[],
+                        help="只返回这些工具的调用，逗号分隔")
+    return parser
+
+
+def serve(config):
+    handler = type("ConfiguredHandler", (FakeCompletionHandler,), {"config": config})
+    server = ThreadingHTTPServer((config.host, config.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    config = build_parser().parse_args()
+    print(f"fake LLM server listening on http://{config.host}:{config.port}/v1")
+    serve(config).serve_forever()
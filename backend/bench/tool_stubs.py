@@ -0,0 +1,122 @@
+"""工具后端的本地替身服务
+
+在一个端口上模拟高德天气、天行数据（抖音热搜、违章代码）和本地HR服务（考勤、排班），
+响应格式与真实接口一致，延迟可配置。
+
+用法：
+    python bench/tool_stubs.py --port 8301 --latency 0.05
+    AMAP_BASE_URL=http://127.0.0.1:8301 TIANAPI_BASE_URL=http://127.0.0.1:8301 \\
+    HR_SERVICE_URL=http://127.0.0.1:8301 python llm_agent.py
+"""
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def weather_response(params):
+    city = params.get("city", ["北京"])[0]
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if params.get("extensions", ["base"])[0] == "all":
+        casts = [
+            {"date": datetime.now().strftime("%Y-%m-%d"), "week": "1", "dayweather": "晴",
+             "nightweather": "多云", "daytemp": "25", "nighttemp": "15",
+             "daywind": "南", "nightwind": "南", "daypower": "≤3", "nightpower": "≤3"}
+            for _ in range(4)
+        ]
+        return {"status": "1", "info": "OK", "forecasts": [
+            {"city": city, "adcode": "110000", "province": city, "reporttime": now, "casts": casts}
+        ]}
+    return {"status": "1", "info": "OK", "lives": [
+        {"province": city, "city": city, "adcode": "110000", "weather": "晴", "temperature": "22",
+         "winddirection": "南", "windpower": "≤3", "humidity": "40", "reporttime": now}
+    ]}
+
+
+def douyin_hot_response(params):
+    return {"code": 200, "msg": "success", "result": {"list": [
+        {"word": f"热搜话题{i}", "hotindex": 1000000 - i * 1000, "label": 0} for i in range(50)
+    ]}}
+
+
+def violation_code_response(params):
+    code = params.get("code", ["1301"])[0]
+    return {"code": 200, "msg": "success", "result": {
+        "code": code, "content": "机动车在高速公路上逆行的", "fine": "200", "score": "12"
+    }}
+
+
+def attendance_response(params):
+    date = params.get("date", [""])[0]
+    return [{"id": i, "name": f"员工{i}", "date": date, "clock_in": "09:00", "clock_out": "18:00"}
+            for i in range(20)]
+
+
+def shifts_response(params):
+    date = params.get("date", [""])[0]
+    return [{"id": i, "name": f"员工{i}", "date": date, "details": "白班 09:00-18:00"}
+            for i in range(10)]
+
+
+ROUTES = {
+    "/v3/weather/weatherInfo": weather_response,
+    "/douyinhot/index": douyin_hot_response,
+    "/jtwfcode/index": violation_code_response,
+    "/attendace_records": attendance_response,
+    "/shifts": shifts_response,
+}
+
+
+class ToolStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self, params):
+        route = ROUTES.get(urlsplit(self.path).path)
+        if route is None:
+            self.send_error(404)
+            return
+        time.sleep(max(0.0, random.gauss(self.config.latency, self.config.latency * self.config.jitter)))
+        payload = json.dumps(route(params), ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.handle_request(parse_qs(urlsplit(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        params = parse_qs(self.rfile.read(length).decode())
+        params.update(parse_qs(urlsplit(self.path).query))
+        self.handle_request(params)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="工具后端替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8301)
+    parser.add_argument("--latency", type=float, default=0.05, help="平均响应延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延迟的相对标准差")
+    return parser
+
+
+def serve(config):
+    handler = type("ConfiguredHandler", (ToolStubHandler,), {"config": config})
+    server = ThreadingHTTPServer((config.host, config.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    config = build_parser().parse_args()
+    print(f"tool stubs listening on http://{config.host}:{config.port}")
+    serve(config).serve_forever()
@@ -0,0 +1,160 @@
+"""城市名 -> 高德 adcode 索引
+
+天气工具按 adcode 查询和缓存，"北京"、"北京市"、"Beijing" 对应同一个上游请求和缓存条目：
+- 启动时从城市表载入一次，只保留 名称键 -> adcode 和 adcode -> 名称 两个字典
+- 名称键由中文名、拼音和别名生成：忽略大小写、空白和连字符，去掉"省/市/区/县/自治区"等后缀
+  （英文去掉 city/province/district 等）；带后缀的全称也单独登记，"朝阳区"不会被当成"朝阳市"
+- 同一个名称键对应多个地区时按 地级市 > 区县 > 省 的顺序取一个；"北京朝阳"、"辽宁省朝阳市"
+  这类带上级名称的写法在上级地区内查找
+- 直接传入6位 adcode 时原样使用
+
+城市表为CSV，列为 adcode,name,pinyin,aliases（别名用 | 分隔），自带的表只收录省级和主要城市，
+可以换成高德官方的完整行政区划表。
+
+配置（环境变量）：
+- CITY_ADCODE_FILE: 城市表路径，默认 backend/resources/city_adcodes.csv
+- WEATHER_CITY_STRICT: 为 1 时城市表中找不到的名称直接返回错误，不请求高德；默认 0，
+  找不到的名称原样交给高德
+"""
+import os
+import re
+import csv
+import logging
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CITY_ADCODE_FILE = os.environ.get(
+    "CITY_ADCODE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "city_adcodes.csv")
+)
+WEATHER_CITY_STRICT = os.environ.get("WEATHER_CITY_STRICT", "0") == "1"
+
+# 按长度从长到短排列，先匹配较长的后缀
+NAME_SUFFIXES = ("特别行政区", "维吾尔自治区", "壮族自治区", "回族自治区", "自治区", "自治州", "地区", "新区",
+                 "省", "市", "区", "县")
+ASCII_SUFFIXES = (" province", " district", " city", " sheng", " shi", " qu")
+IGNORED_CHARS = re.compile(r"[\s'\-·.]")
+ADCODE_PATTERN = re.compile(r"\d{6}")
+
+CITY_LOOKUPS = registry.counter(
+    "city_index_lookups_total", "City name to adcode resolutions by result", ("result",))
+
+
+def admin_level(adcode):
+    """同名地区的优先级，数值越小越优先：地级市、区县、省"""
+    if adcode.endswith("0000"):
+        return 2
+    if adcode.endswith("00"):
+        return 0
+    return 1
+
+
+def full_key(name):
+    return IGNORED_CHARS.sub("", name.strip().lower())
+
+
+def short_key(name):
+    """去掉行政区划后缀的名称键"""
+    text = name.strip().lower()
+    for suffix in ASCII_SUFFIXES:
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+            break
+    text = IGNORED_CHARS.sub("", text)
+    for suffix in NAME_SUFFIXES:
+        if text.endswith(suffix) and len(text) - len(suffix) >= 2:
+            return text[:-len(suffix)]
+    return text
+
+
+def within(adcode, parent):
+    """adcode 是否属于上级地区 parent"""
+    if parent.endswith("0000"):
+        return adcode[:2] == parent[:2] and adcode != parent
+    if parent.endswith("00"):
+        return adcode[:4] == parent[:4] and adcode != parent
+    return False
+
+
+class CityIndex:
+    """城市名到 adcode 的只读索引"""
+
+    def __init__(self, rows=()):
+        self.names = {}
+        exact = {}
+        short = {}
+        for adcode, name, pinyin, aliases in rows:
+            self.names[adcode] = name
+            exact.setdefault(full_key(name), []).append(adcode)
+            for key in [name, pinyin, *aliases]:
+                if key:
+                    short.setdefault(short_key(key), []).append(adcode)
+        # 同名冲突在载入时按优先级消解，查找时只需一次字典访问
+        def pick(adcodes):
+            return min(adcodes, key=lambda code: (admin_level(code), code))
+        self._exact = {key: pick(adcodes) for key, adcodes in exact.items()}
+        self._short = {key: pick(adcodes) for key, adcodes in short.items()}
+        self._candidates = {key: adcodes for key, adcodes in short.items() if len(adcodes) > 1}
+
+    @classmethod
+    def from_csv(cls, path=CITY_ADCODE_FILE):
+        try:
+            with open(path, newline="", encoding="utf-8-sig") as f:
+                rows = [
+                    (row["adcode"].strip(), row["name"].strip(), (row.get("pinyin") or "").strip(),
+                     [alias.strip() for alias in (row.get("aliases") or "").split("|") if alias.strip()])
+                    for row in csv.DictReader(f)
+                ]
+        except (OSError, KeyError) as e:
+            logger.warning("城市表 %s 载入失败，天气查询将直接使用城市名: %s", path, e)
+            rows = []
+        return cls(rows)
+
+    def _lookup(self, name):
+        return self._exact.get(full_key(name)) or self._short.get(short_key(name))
+
+    def _lookup_within(self, name, parent):
+        """在上级地区内查找，同名地区中只取属于 parent 的"""
+        key = short_key(name)
+        for adcode in self._candidates.get(key, ()):
+            if within(adcode, parent):
+                return adcode
+        adcode = self._exact.get(full_key(name)) or self._short.get(key)
+        if adcode and within(adcode, parent):
+            return adcode
+        return None
+
+    def resolve(self, name):
+        """返回 adcode，找不到时返回 None"""
+        name = (name or "").strip()
+        if ADCODE_PATTERN.fullmatch(name):
+            return name
+        adcode = self._lookup(name)
+        if adcode is None:
+            # "北京朝阳"、"辽宁省朝阳市"：前一部分是上级地区
+            for split in range(len(name) - 2, 1, -1):
+                parent = self._lookup(name[:split])
+                if parent:
+                    adcode = self._lookup_within(name[split:], parent)
+                    if adcode:
+                        break
+        CITY_LOOKUPS.inc(result="unknown" if adcode is None else "resolved")
+        return adcode
+
+    def stats(self):
+        return {"regions": len(self.names), "keys": len(self._exact) + len(self._short)}
+
+
+city_index = CityIndex.from_csv()
+
+
+def resolve_weather_city(city):
+    """天气查询使用的 city 参数，返回 (参数, 错误)；严格模式下找不到的城市返回错误"""
+    adcode = city_index.resolve(city)
+    if adcode:
+        return adcode, None
+    if WEATHER_CITY_STRICT or not str(city or "").strip():
+        return None, {"error": f"未找到城市：{city}，请提供准确的城市或区县名称"}
+    return str(city).strip(), None
@@ -0,0 +1,270 @@
+"""LLM补全结果缓存（默认关闭）
+
+相同的问题（例如首轮的"抖音热搜"、"违章代码1301是什么"）直接复用之前的回答文本和工具调用决定：
+- 键为模型、阶段、规范化后的消息和工具定义摘要的 sha256，系统消息中的日期被替换为占位符
+- 值保存在本地SQLite中，有TTL和总大小上限，超出时按最近访问时间淘汰到上限的90%；
+  总大小在内存中累计，超过上限或每隔一段时间才清理过期条目并重新统计
+- 缓存的是模型的输出；命中时工具调用仍会重新执行，拿到最新结果
+- 消息中包含易变工具（天气、热搜、考勤、排班、请假）结果的补全不缓存；
+  输出中出现了用户没有提到的日期（由系统提示词中的今天推算而来）时也不缓存
+
+配置（环境变量）：
+- COMPLETION_CACHE_ENABLED: 设为 1 开启，默认关闭
+- COMPLETION_CACHE_PATH: 数据库文件路径，默认 backend/data/completion_cache.db
+- COMPLETION_CACHE_TTL: 条目有效期（秒），默认 3600
+- COMPLETION_CACHE_MAX_BYTES: 缓存总大小上限，默认 64MB
+"""
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+import sqlite3
+import threading
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+COMPLETION_CACHE_ENABLED = os.environ.get("COMPLETION_CACHE_ENABLED", "0") == "1"
+COMPLETION_CACHE_PATH = os.environ.get(
+    "COMPLETION_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "completion_cache.db")
+)
+COMPLETION_CACHE_TTL = float(os.environ.get("COMPLETION_CACHE_TTL", "3600"))
+COMPLETION_CACHE_MAX_BYTES = int(os.environ.get("COMPLETION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# 结果随时间变化或有副作用的工具，依赖它们结果的补全不缓存
+VOLATILE_TOOLS = {"get_weather", "get_douyin_hot", "get_attendance_records", "get_shift_info",
+                  "get_attendance_records_range", "get_shift_info_range", "apply_leave"}
+
+# 两次清理过期条目、重新统计总大小之间的最长间隔（秒）
+PURGE_INTERVAL = 60
+# 超出上限时淘汰到上限的这个比例，避免接近上限时每次写入都触发淘汰
+EVICT_TARGET_RATIO = 0.9
+
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+COMPLETION_CACHE_REQUESTS = registry.counter(
+    "completion_cache_requests_total", "Completion cache lookups and stores by stage and result",
+    ("stage", "result"))
+
+
+def normalize_messages(messages):
+    """只保留影响回答的字段，系统消息中的日期替换为占位符"""
+    normalized = []
+    for message in messages:
+        item = {"role": message.get("role"), "content": message.get("content")}
+        if item["role"] == "system" and isinstance(item["content"], str):
+            item["content"] = DATE_PATTERN.sub("{date}", item["content"])
+        if message.get("tool_calls"):
+            item["tool_calls"] = [
+                {"name": tc["function"]["name"], "arguments": tc["function"]["arguments"]}
+                for tc in message["tool_calls"]
+            ]
+        normalized.append(item)
+    return normalized
+
+
+def depends_on_volatile_tools(messages):
+    """消息中是否包含易变工具的结果或出错的工具结果"""
+    for message in messages:
+        for tool_call in message.get("tool_calls") or []:
+            if tool_call["function"]["name"] in VOLATILE_TOOLS:
+                return True
+        if message.get("role") == "tool" and '"error"' in (message.get("content") or ""):
+            return True
+    return False
+
+
+def derives_date(messages, value):
+    """输出中是否出现了用户消息里没有的日期"""
+    output = json.dumps(value, ensure_ascii=False)
+    dates = set(DATE_PATTERN.findall(output))
+    if not dates:
+        return False
+    mentioned = set()
+    for message in messages:
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            mentioned.update(DATE_PATTERN.findall(message["content"]))
+    return bool(dates - mentioned)
+
+
+def cached_tool_calls(value):
+    """把缓存的工具调用还原成 ToolCallAssembler 的输出格式，使用新的调用id"""
+    return [
+        {
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "function": {"name": tool_call["name"], "arguments": json.dumps(tool_call["arguments"])},
+            "parsed_arguments": tool_call["arguments"],
+        }
+        for tool_call in value.get("tool_calls") or []
+    ]
+
+
+def cacheable_tool_calls(tool_calls):
+    """取出可缓存的工具调用决定，有参数出错的调用时返回 None"""
+    if any("error" in tool_call for tool_call in tool_calls):
+        return None
+    return [
+        {"name": tool_call["function"]["name"], "arguments": tool_call["parsed_arguments"]}
+        for tool_call in tool_calls
+    ]
+
+
+def cacheable_message_tool_calls(tool_calls):
+    """非流式响应 message.tool_calls 的版本，有参数不是有效JSON的调用时返回 None"""
+    try:
+        return [
+            {"name": tool_call.function.name, "arguments": json.loads(tool_call.function.arguments or "{}")}
+            for tool_call in tool_calls or []
+        ]
+    except ValueError:
+        return None
+
+
+class CompletionCache:
+    """SQLite中的补全缓存，每个线程一个连接"""
+
+    def __init__(self, path=COMPLETION_CACHE_PATH, ttl=COMPLETION_CACHE_TTL,
+                 max_bytes=COMPLETION_CACHE_MAX_BYTES, enabled=COMPLETION_CACHE_ENABLED):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._next_purge = 0.0
+        if not enabled:
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed_at)")
+            self._purge(conn, time.time())
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def make_key(self, model, stage, messages, tools_digest=None):
+        payload = json.dumps(
+            {"model": model, "stage": stage, "tools": tools_digest,
+             "messages": normalize_messages(messages)},
+            ensure_ascii=False, sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, model, stage, messages, tools_digest=None):
+        """返回 (key, value)；不可缓存时 key 为 None，未命中时 value 为 None"""
+        if not self.enabled:
+            return None, None
+        if depends_on_volatile_tools(messages):
+            COMPLETION_CACHE_REQUESTS.inc(stage=stage, result="skip")
+            return None, None
+        key = self.make_key(model, stage, messages, tools_digest)
+        try:
+            value = self._get(key)
+        except sqlite3.Error as e:
+            logger.warning("读取补全缓存失败: %s", e)
+            value = None
+        COMPLETION_CACHE_REQUESTS.inc(stage=stage, result="hit" if value is not None else "miss")
+        return key, value
+
+    def store(self, key, stage, messages, value):
+        """写入一条补全结果；key 为 None 或输出依赖今天的日期时跳过"""
+        if key is None or not self.enabled:
+            return
+        if derives_date(messages, value):
+            COMPLETION_CACHE_REQUESTS.inc(stage=stage, result="skip")
+            return
+        try:
+            self._put(key, value)
+            COMPLETION_CACHE_REQUESTS.inc(stage=stage, result="store")
+        except sqlite3.Error as e:
+            logger.warning("写入补全缓存失败: %s", e)
+
+    def _get(self, key):
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, created_at FROM completions WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl:
+            with conn:
+                conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            return None
+        with conn:
+            conn.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def _put(self, key, value):
+        text = json.dumps(value, ensure_ascii=False)
+        size = len(text.encode("utf-8"))
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            row = conn.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)", (key, text, size, now, now)
+            )
+        with self._lock:
+            self._bytes += size - (row[0] if row else 0)
+            due = self._bytes > self.max_bytes or now >= self._next_purge
+        if due:
+            with conn:
+                self._purge(conn, now)
+
+    def _purge(self, conn, now):
+        """删除过期条目并重新统计总大小，超出上限时淘汰"""
+        conn.execute("DELETE FROM completions WHERE created_at < ?", (now - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total > self.max_bytes:
+            total -= self._evict(conn, total - int(self.max_bytes * EVICT_TARGET_RATIO))
+        with self._lock:
+            self._bytes = total
+            self._next_purge = now + PURGE_INTERVAL
+
+    def _evict(self, conn, excess):
+        """按最近访问时间从旧到新删除，直到释放 excess 字节，返回释放的字节数"""
+        freed = 0
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM completions ORDER BY accessed_at"):
+            if freed >= excess:
+                break
+            victims.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM completions WHERE key = ?", victims)
+        return freed
+
+    def stats(self):
+        if not self.enabled:
+            return {"enabled": False}
+        entries, total = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()
+        return {"enabled": True, "entries": entries, "bytes": total, "max_bytes": self.max_bytes,
+                "ttl": self.ttl}
+
+
+completion_cache = CompletionCache()
@@ -0,0 +1,164 @@
+"""上下文窗口管理
+
+按token预算裁剪发送给模型的会话历史，避免提示词随对话长度线性增长：
+- 统计组装后消息的token数（有 tiktoken 时用它，否则按中日韩字符约1个token、其他字符约4个字符1个token估算）；
+  消息中的 "<|endoftext|>" 等特殊token文本按普通文本统计
+- tiktoken 的 cl100k_base 词表在第一次统计时才加载，本地没有缓存时 tiktoken 会联网下载；
+  离线部署需预先下载词表并设置 TIKTOKEN_CACHE_DIR，加载失败时退回估算
+- 超出预算时从最早的轮次开始丢弃，只保留最近能放下的完整轮次
+- 被丢弃的部分由后台线程增量生成摘要并按会话缓存，下一次请求直接使用缓存的摘要，热路径不等待摘要生成
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_PROMPT_BUDGET = int(os.environ.get("CONTEXT_PROMPT_BUDGET", "24000"))
+CONTEXT_SUMMARY_ENABLED = os.environ.get("CONTEXT_SUMMARY_ENABLED", "1") == "1"
+CONTEXT_SUMMARY_MAX_SESSIONS = int(os.environ.get("CONTEXT_SUMMARY_MAX_SESSIONS", "1000"))
+
+# 每条消息的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """返回 cl100k_base 编码，第一次调用时加载；没有 tiktoken 或加载失败时返回 None"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                if tiktoken is not None:
+                    try:
+                        _encoding = tiktoken.get_encoding("cl100k_base")
+                    except Exception as e:
+                        logger.warning("tiktoken 词表加载失败，token数改为估算: %s", e)
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_text_tokens(text):
+    """统计文本的token数"""
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is not None:
+        # 用户输入和工具结果中可能出现特殊token文本，按普通文本统计而不是报错
+        return len(encoding.encode_ordinary(text))
+    cjk = sum(1 for ch in text if "⺀" <= ch <= "鿿" or "가" <= ch <= "힯")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(message):
+    """统计单条消息的token数，包括工具调用参数"""
+    tokens = MESSAGE_OVERHEAD_TOKENS + count_text_tokens(message.get("content"))
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        tokens += count_text_tokens(function.get("name")) + count_text_tokens(function.get("arguments"))
+    return tokens
+
+
+def count_messages_tokens(messages):
+    """统计消息列表的token总数"""
+    return sum(count_message_tokens(message) for message in messages)
+
+
+class ContextWindowManager:
+    """按token预算组装会话消息，并在后台维护每个会话的历史摘要"""
+
+    def __init__(self, summarize=None, budget=CONTEXT_PROMPT_BUDGET, overhead_tokens=0,
+                 max_sessions=CONTEXT_SUMMARY_MAX_SESSIONS):
+        """
+        Args:
+            summarize: 摘要函数 summarize(previous_summary, messages) -> str，为None时只丢弃不摘要
+            budget: 提示词token预算
+            overhead_tokens: 每次请求固定占用的token数（如工具定义）
+            max_sessions: 最多缓存多少个会话的摘要
+        """
+        self.summarize = summarize if CONTEXT_SUMMARY_ENABLED else None
+        self.budget = budget
+        self.overhead_tokens = overhead_tokens
+        self.max_sessions = max_sessions
+        # session_id -> (已摘要的消息条数, 摘要文本)
+        self._summaries = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+    def get_summary(self, session_id):
+        with self._lock:
+            summary = self._summaries.get(session_id)
+            if summary is not None:
+                self._summaries.move_to_end(session_id)
+            return summary
+
+    def build_messages(self, session_id, system_messages, history):
+        """组装不超过预算的消息列表：系统消息 + [历史摘要] + 最近的完整轮次"""
+        available = self.budget - self.overhead_tokens - count_messages_tokens(system_messages)
+        history_tokens = [count_message_tokens(message) for message in history]
+        if sum(history_tokens) <= available:
+            return [*system_messages, *history]
+
+        summary = self.get_summary(session_id) if self.summarize else None
+        if summary is not None:
+            summary_message = {
+                "role": "system",
+                "content": f"以下是本次会话较早内容的摘要：\n{summary[1]}"
+            }
+            available -= count_message_tokens(summary_message)
+
+        # 从最新的消息往前累加，最后一条（当前用户消息）总是保留
+        start = len(history) - 1
+        used = history_tokens[start] if history else 0
+        while start > 0 and used + history_tokens[start - 1] <= available:
+            start -= 1
+            used += history_tokens[start]
+        # 保证保留的历史从用户消息开始
+        while start < len(history) - 1 and history[start]["role"] != "user":
+            start += 1
+
+        if self.summarize:
+            self._schedule_summary(session_id, history[:start])
+
+        messages = list(system_messages)
+        if summary is not None and summary[0] <= start:
+            messages.append(summary_message)
+        messages.extend(history[start:])
+        return messages
+
+    def _schedule_summary(self, session_id, dropped):
+        """在后台把被丢弃的消息并入该会话的摘要，同一会话同时只有一个摘要任务"""
+        with self._lock:
+            summary = self._summaries.get(session_id)
+            covered = summary[0] if summary else 0
+            if len(dropped) <= covered or session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        previous = summary[1] if summary else None
+        self._executor.submit(self._update_summary, session_id, previous, covered, dropped)
+
+    def _update_summary(self, session_id, previous, covered, dropped):
+        try:
+            text = self.summarize(previous, dropped[covered:])
+            if text:
+                with self._lock:
+                    self._summaries[session_id] = (len(dropped), text)
+                    self._summaries.move_to_end(session_id)
+                    while len(self._summaries) > self.max_sessions:
+                        self._summaries.popitem(last=False)
+        except Exception as e:
+            logger.warning("生成会话摘要失败: %s", e)
+        finally:
+            with self._lock:
+                self._pending.discard(session_id)
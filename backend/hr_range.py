@@ -0,0 +1,224 @@
+"""考勤、排班的日期范围查询
+
+"这周的考勤"这类问题原本需要模型逐日调用工具，每天一次HTTP请求加一次后续补全。
+范围版本的工具一次调用返回每一天的结果：
+- expand_dates(): 校验并展开日期范围，最多 HR_RANGE_MAX_DAYS 天
+- 今天之前的日期结果保存在本地SQLite中长期有效（过去的考勤和排班不会再变），今天及以后的日期总是实时查询
+- 缓存中没有的日期并发查询（同步版本用线程池，异步版本用 asyncio），单日失败只影响那一天
+
+配置（环境变量）：
+- HR_RANGE_MAX_DAYS: 一次查询的最大天数，默认 31
+- HR_RANGE_CONCURRENCY: 同时查询的日期数，默认 8
+- HR_DAY_CACHE_PATH: 历史日期缓存的数据库路径，默认 backend/data/hr_days.db
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+import contextvars
+from datetime import date as Date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+HR_RANGE_MAX_DAYS = int(os.environ.get("HR_RANGE_MAX_DAYS", "31"))
+HR_RANGE_CONCURRENCY = int(os.environ.get("HR_RANGE_CONCURRENCY", "8"))
+HR_DAY_CACHE_PATH = os.environ.get(
+    "HR_DAY_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "hr_days.db")
+)
+
+HR_DAY_CACHE_REQUESTS = registry.counter(
+    "hr_day_cache_requests_total", "Past-day HR cache lookups by kind and result", ("kind", "result"))
+
+range_executor = ThreadPoolExecutor(max_workers=HR_RANGE_CONCURRENCY, thread_name_prefix="hr-range")
+
+
+def expand_dates(start_date, end_date):
+    """展开 [start_date, end_date] 内的每一天，参数无效时抛出 ValueError"""
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    if end < start:
+        raise ValueError(f"结束日期 {end_date} 早于开始日期 {start_date}")
+    days = (end - start).days + 1
+    if days > HR_RANGE_MAX_DAYS:
+        raise ValueError(f"一次最多查询 {HR_RANGE_MAX_DAYS} 天，请缩小日期范围")
+    return [(start + timedelta(days=i)).isoformat() for i in range(days)]
+
+
+def is_past(day):
+    return day < Date.today().isoformat()
+
+
+class HrDayCache:
+    """今天之前的考勤、排班原始数据，按 (类型, 日期) 保存，每个线程一个连接"""
+
+    def __init__(self, path=HR_DAY_CACHE_PATH):
+        self.path = path
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS hr_days (
+                    kind TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (kind, day)
+                )
+            """)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, kind, days):
+        """返回 {日期: 原始数据}，只查今天之前的日期"""
+        past = [day for day in days if is_past(day)]
+        if not past:
+            return {}
+        try:
+            rows = self._connection().execute(
+                f"SELECT day, payload FROM hr_days WHERE kind = ? AND day IN ({','.join('?' * len(past))})",
+                [kind, *past]
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning("读取考勤排班缓存失败: %s", e)
+            return {}
+        found = {day: json.loads(payload) for day, payload in rows}
+        HR_DAY_CACHE_REQUESTS.inc(len(found), kind=kind, result="hit")
+        HR_DAY_CACHE_REQUESTS.inc(len(past) - len(found), kind=kind, result="miss")
+        return found
+
+    def put_many(self, kind, items):
+        """保存 {日期: 原始数据} 中今天之前的日期"""
+        rows = [(kind, day, json.dumps(data, ensure_ascii=False), time.time())
+                for day, data in items.items() if is_past(day)]
+        if not rows:
+            return
+        try:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO hr_days (kind, day, payload, fetched_at) VALUES (?, ?, ?, ?)", rows
+                )
+        except sqlite3.Error as e:
+            logger.warning("写入考勤排班缓存失败: %s", e)
+
+    def stats(self):
+        rows = self._connection().execute("SELECT kind, COUNT(*) FROM hr_days GROUP BY kind").fetchall()
+        return {kind: count for kind, count in rows}
+
+
+hr_day_cache = HrDayCache()
+
+
+def _collect(kind, days, cached, fetched, errors, parse):
+    """把缓存命中和新查询到的数据按日期顺序解析成工具结果，可缓存的新数据写回缓存"""
+    results = []
+    cacheable = {}
+    for day in days:
+        if day in errors:
+            results.append({"date": day, "error": str(errors[day])})
+            continue
+        data = cached[day] if day in cached else fetched[day]
+        parsed = parse(day, data)
+        if "error" in parsed:
+            parsed = {"date": day, "error": parsed["error"]}
+        elif day in fetched:
+            cacheable[day] = data
+        results.append(parsed)
+    hr_day_cache.put_many(kind, cacheable)
+    return results
+
+
+def fetch_day(kind, day, fetch, parse):
+    """查询单日，今天之前的日期先查本地缓存"""
+    cached = hr_day_cache.get_many(kind, [day])
+    if day in cached:
+        return parse(day, cached[day])
+    data = fetch(day)
+    parsed = parse(day, data)
+    if "error" not in parsed:
+        hr_day_cache.put_many(kind, {day: data})
+    return parsed
+
+
+async def fetch_day_async(kind, day, fetch, parse):
+    """fetch_day 的异步版本，fetch 为协程函数；SQLite读写在线程中执行，不阻塞事件循环"""
+    cached = await asyncio.to_thread(hr_day_cache.get_many, kind, [day])
+    if day in cached:
+        return parse(day, cached[day])
+    data = await fetch(day)
+    parsed = parse(day, data)
+    if "error" not in parsed:
+        await asyncio.to_thread(hr_day_cache.put_many, kind, {day: data})
+    return parsed
+
+
+def fetch_range(kind, start_date, end_date, fetch, parse):
+    """查询日期范围内的每一天，fetch(day) 返回原始数据，parse(day, data) 返回单日结果"""
+    try:
+        days = expand_dates(start_date, end_date)
+    except ValueError as e:
+        return {"error": str(e)}
+    cached = hr_day_cache.get_many(kind, days)
+    missing = [day for day in days if day not in cached]
+    futures = {day: range_executor.submit(contextvars.copy_context().run, fetch, day) for day in missing}
+    fetched, errors = {}, {}
+    for day, future in futures.items():
+        try:
+            fetched[day] = future.result()
+        except Exception as e:
+            errors[day] = e
+    if missing and len(errors) == len(missing) and not cached:
+        # 每一天都失败说明后端不可用，抛出交给工具执行层计入熔断
+        raise next(iter(errors.values()))
+    return build_range_result(start_date, end_date, _collect(kind, days, cached, fetched, errors, parse))
+
+
+async def fetch_range_async(kind, start_date, end_date, fetch, parse):
+    """fetch_range 的异步版本，fetch 为协程函数；SQLite读写在线程中执行"""
+    try:
+        days = expand_dates(start_date, end_date)
+    except ValueError as e:
+        return {"error": str(e)}
+    cached = await asyncio.to_thread(hr_day_cache.get_many, kind, days)
+    missing = [day for day in days if day not in cached]
+    semaphore = asyncio.Semaphore(HR_RANGE_CONCURRENCY)
+
+    async def fetch_limited(day):
+        async with semaphore:
+            return await fetch(day)
+
+    outcomes = await asyncio.gather(*(fetch_limited(day) for day in missing), return_exceptions=True)
+    fetched, errors = {}, {}
+    for day, outcome in zip(missing, outcomes):
+        if isinstance(outcome, Exception):
+            errors[day] = outcome
+        else:
+            fetched[day] = outcome
+    if missing and len(errors) == len(missing) and not cached:
+        raise next(iter(errors.values()))
+    results = await asyncio.to_thread(_collect, kind, days, cached, fetched, errors, parse)
+    return build_range_result(start_date, end_date, results)
+
+
+def build_range_result(start_date, end_date, results):
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "days": results,
+        "failed_days": [item["date"] for item in results if "error" in item],
+    }
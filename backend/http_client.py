@@ -0,0 +1,184 @@
+"""工具后端共用的HTTP客户端
+
+所有工具（高德天气、天行数据、本地HR服务）都通过这里发请求：
+- 每个主机一个 requests.Session，底层 urllib3 连接池保持 keep-alive，避免每次调用重新握手TCP/TLS
+- 统一的连接/读取超时
+- 对连接错误、超时和 429/5xx 做有限次数的重试，退避时间带随机抖动
+- 按主机统计请求数、重试数、失败数和新建连接数，用于观察连接池复用情况
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+TOOL_HTTP_CONNECT_TIMEOUT = float(os.environ.get("TOOL_HTTP_CONNECT_TIMEOUT", "3"))
+# 读取超时要小于 tool_guard 的工具截止时间（默认 8 秒），否则截止时间总是先到，
+# 同步工具的线程要等读取超时才结束，期间一直占用隔离舱名额
+TOOL_HTTP_READ_TIMEOUT = float(os.environ.get("TOOL_HTTP_READ_TIMEOUT", "5"))
+TOOL_HTTP_MAX_RETRIES = int(os.environ.get("TOOL_HTTP_MAX_RETRIES", "2"))
+TOOL_HTTP_BACKOFF_BASE = float(os.environ.get("TOOL_HTTP_BACKOFF_BASE", "0.2"))
+TOOL_HTTP_BACKOFF_MAX = float(os.environ.get("TOOL_HTTP_BACKOFF_MAX", "2"))
+TOOL_HTTP_POOL_SIZE = int(os.environ.get("TOOL_HTTP_POOL_SIZE", "20"))
+
+# 可以重试的HTTP状态码
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def backoff_delay(attempt, base=TOOL_HTTP_BACKOFF_BASE, cap=TOOL_HTTP_BACKOFF_MAX):
+    """计算第 attempt 次重试前的等待时间（full jitter 指数退避）"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def host_key(url):
+    """从URL中提取连接池的主机键，如 https://restapi.amap.com"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def new_host_stats():
+    """创建单个主机的统计计数"""
+    return {"requests": 0, "retries": 0, "failures": 0, "connections_opened": 0}
+
+
+class ToolHttpClient:
+    """按主机划分连接池、带超时和重试的同步HTTP客户端"""
+
+    def __init__(self, connect_timeout=TOOL_HTTP_CONNECT_TIMEOUT, read_timeout=TOOL_HTTP_READ_TIMEOUT,
+                 max_retries=TOOL_HTTP_MAX_RETRIES, pool_size=TOOL_HTTP_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get_session(self, host):
+        """获取（必要时创建）某个主机专用的会话"""
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount(host, adapter)
+                    self._sessions[host] = session
+                    self._stats[host] = new_host_stats()
+        return session
+
+    def _count(self, host, field):
+        with self._lock:
+            self._stats[host][field] += 1
+
+    def request(self, method, url, timeout=None, max_retries=None, **kwargs):
+        """发送请求，对可重试的失败按退避策略重试，重试耗尽后返回最后的响应或抛出最后的异常"""
+        host = host_key(url)
+        session = self._get_session(host)
+        retries = self.max_retries if max_retries is None else max_retries
+        timeout = timeout or self.timeout
+
+        attempt = 0
+        while True:
+            self._count(host, "requests")
+            try:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+                    return response
+                response.close()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= retries:
+                    self._count(host, "failures")
+                    raise
+            self._count(host, "retries")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        """返回每个主机的请求统计和连接池使用情况"""
+        with self._lock:
+            snapshot = {host: dict(counts) for host, counts in self._stats.items()}
+            sessions = dict(self._sessions)
+        for host, session in sessions.items():
+            pools = session.get_adapter(host).poolmanager.pools
+            stats = snapshot[host]
+            stats["connections_opened"] = sum(pools[key].num_connections for key in pools.keys())
+            stats["pool_size"] = self.pool_size
+        return snapshot
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+class AsyncToolHttpClient:
+    """异步版本的工具HTTP客户端，基于 httpx.AsyncClient 的连接池，超时与重试策略与同步版本一致"""
+
+    def __init__(self, connect_timeout=TOOL_HTTP_CONNECT_TIMEOUT, read_timeout=TOOL_HTTP_READ_TIMEOUT,
+                 max_retries=TOOL_HTTP_MAX_RETRIES, pool_size=TOOL_HTTP_POOL_SIZE):
+        import httpx
+
+        self._httpx = httpx
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_keepalive_connections=pool_size),
+        )
+        self._stats = {}
+
+    def _count(self, host, field):
+        self._stats.setdefault(host, new_host_stats())[field] += 1
+
+    async def request(self, method, url, max_retries=None, **kwargs):
+        host = host_key(url)
+        retries = self.max_retries if max_retries is None else max_retries
+
+        async def trace(event_name, info):
+            # httpcore 只在新建连接时发出 connect_tcp 事件，复用连接池中的连接时没有
+            if event_name == "connection.connect_tcp.complete":
+                self._count(host, "connections_opened")
+
+        kwargs["extensions"] = dict(kwargs.get("extensions") or {}, trace=trace)
+        attempt = 0
+        while True:
+            self._count(host, "requests")
+            try:
+                response = await self._client.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+                    return response
+            except (self._httpx.TransportError, self._httpx.TimeoutException):
+                if attempt >= retries:
+                    self._count(host, "failures")
+                    raise
+            self._count(host, "retries")
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    def stats(self):
+        return {host: dict(counts, pool_size=self.pool_size) for host, counts in self._stats.items()}
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+# 同步工具共用的客户端实例
+tool_http = ToolHttpClient()
@@ -1,13 +1,43 @@
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify, Response
 import os
-import uuid
 import json
-import requests
-from openai import OpenAI
+import time
+import logging
+import threading
+import contextvars
+from openai.types.chat import ChatCompletion
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from flask_cors import CORS
-from jinja2 import Template
+
+from http_client import tool_http, new_host_stats
+from tool_cache import tool_cache
+from session_store import create_session_store
+from context_window import ContextWindowManager, count_text_tokens, count_messages_tokens
+from prompt_assembly import PromptAssembler
+from stream_replay import StreamReplayRegistry, GenerationInProgress, GenerationCapacityExceeded
+from tool_call_assembler import ToolCallAssembler
+from completion_cache import (
+    completion_cache, cached_tool_calls, cacheable_tool_calls, cacheable_message_tool_calls
+)
+from metrics import (
+    registry, span, llm_span, track_llm_stream, record_tool_call,
+    STREAMS_IN_FLIGHT, TOOLS_IN_FLIGHT
+)
+from log_pipeline import configure_logging, log_payload
+from upstream_scheduler import upstream, session_scope
+from tool_guard import tool_guard
+from violation_codes import violation_codes
+from city_index import city_index, resolve_weather_city
+from tool_result_shaping import tool_result_shaper
+from hr_range import hr_day_cache, fetch_day, fetch_range, HR_RANGE_MAX_DAYS
+from provider_pool import ProviderPool
+from model_router import ModelRouter
+
+# 日志经队列由后台线程写出，见 log_pipeline.py
+configure_logging()
+logger = logging.getLogger("llm_agent")
 
 app = Flask(__name__)
 # 配置 CORS，允许前端访问
@@ -15,152 +45,232 @@ CORS(app, supports_credentials=True, resources={
     r"/api/*": {
         "origins": ["http://localhost:3000"],  # 明确指定前端域名
         "methods": ["GET", "POST", "OPTIONS"],  # 允许的方法
-        "allow_headers": ["Content-Type", "Authorization"],  # 允许的请求头
+        "allow_headers": ["Content-Type", "Authorization", "Last-Event-ID"],  # 允许的请求头
         "expose_headers": ["Content-Type"],
         "max_age": 600,
         "supports_credentials": True
     }
 })
 
-# 模拟数据库，实际应用中应使用Redis或MongoDB
-sessions = {}
-
-# 初始化OpenAI客户端
-client = OpenAI(
-    api_key=os.environ.get("AliDeep"),
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-    )
+# 会话存储：SQLite持久化 + 有界内存热层，见 session_store.py
+session_store = create_session_store()
+
+# 工具执行模式：parallel 并行执行同一轮的全部工具调用并只发起一次后续补全，
+# sequential 逐个执行工具并为每个工具单独发起后续补全
+TOOL_EXECUTION_MODE = os.environ.get("TOOL_EXECUTION_MODE", "parallel")
+TOOL_MAX_WORKERS = int(os.environ.get("TOOL_MAX_WORKERS", "8"))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
+# 生成在独立线程中运行，帧写入按会话的回放缓冲区，客户端断开重连后可续传，见 stream_replay.py
+# 同时进行的生成数达到 STREAM_GENERATION_WORKERS 时，新的生成直接返回503，不在线程池里排队
+# （排队的流只能收到保活帧，看起来像卡住）；加入已有生成的订阅者不受限制
+stream_replay = StreamReplayRegistry()
+STREAM_GENERATION_WORKERS = int(os.environ.get("STREAM_GENERATION_WORKERS", "64"))
+generation_executor = ThreadPoolExecutor(
+    max_workers=STREAM_GENERATION_WORKERS, thread_name_prefix="generation"
+)
+generation_slots = threading.BoundedSemaphore(STREAM_GENERATION_WORKERS)
+
+# 补充最终答案的方式：stream 在当前SSE流中以一次流式续写补全，
+# blocking 使用一次非流式补全（旧行为）
+ANSWER_COMPLETION_MODE = os.environ.get("ANSWER_COMPLETION_MODE", "stream")
+FINAL_ANSWER_MARKER = "**最终答案:**"
+
+# 生成会话历史摘要使用的模型
+CONTEXT_SUMMARY_MODEL = os.environ.get("CONTEXT_SUMMARY_MODEL", "qwen-turbo")
+
+# 工具上游服务地址，可通过环境变量指向本地替身服务（见 bench/）；LLM服务地址见 provider_pool.py
+AMAP_BASE_URL = os.environ.get("AMAP_BASE_URL", "https://restapi.amap.com")
+TIANAPI_BASE_URL = os.environ.get("TIANAPI_BASE_URL", "https://apis.tianapi.com")
+HR_SERVICE_URL = os.environ.get("HR_SERVICE_URL", "http://localhost:5200")
+
+# 对话默认使用的模型，各阶段实际使用的模型由 model_router 选择
+CHAT_MODEL = os.environ.get("CHAT_MODEL", "qwen-max")
+
+# LLM服务商池：按健康分数故障切换，可选对冲请求，见 provider_pool.py
+llm_providers = ProviderPool.from_env()
+
+# 按阶段和问题类型选择模型，见 model_router.py
+model_router = ModelRouter.from_env(CHAT_MODEL, CONTEXT_SUMMARY_MODEL)
+
+# 所有LLM请求经上游调度器排队、限流并按会话公平放行，见 upstream_scheduler.py
+def complete_chat(stage, model=None, **kwargs):
+    """发起一次非流式补全，未指定模型时由路由选择"""
+    model = model or model_router.route(stage, kwargs["messages"])
+    with upstream.slot(count_messages_tokens(kwargs["messages"])) as ticket, llm_span(stage, model):
+        response = llm_providers.create(model, **kwargs)
+        if response.usage:
+            ticket.used_tokens = response.usage.total_tokens
+    model_router.observe(model, total=time.monotonic() - ticket.started_at)
+    return response
+
+def stream_chat(stage, model=None, **kwargs):
+    """发起一次流式补全并逐块产出；流读完或被放弃时才归还上游并发槽"""
+    model = model or model_router.route(stage, kwargs["messages"])
+    with upstream.slot(count_messages_tokens(kwargs["messages"])) as ticket:
+        started_at = time.perf_counter()
+        stream = llm_providers.stream(model, stream_options={"include_usage": True}, **kwargs)
+        for chunk in track_llm_stream(stream, stage, model, started_at):
+            ticket.first_token()
+            if chunk.usage:
+                ticket.used_tokens = chunk.usage.total_tokens
+            yield chunk
+    model_router.observe(model, ttfb=ticket.first_token_at and ticket.first_token_at - ticket.started_at,
+                         total=time.monotonic() - ticket.started_at)
 
 # 工具定义
-def get_weather(city):
-    """调用高德地图API查询天气"""
-    try:
-        # 打印调试信息
-        print(f"查询天气: {city}")
-        apikey = os.environ.get("amapkey")
-        # 高德地图天气API
-        url = f"https://restapi.amap.com/v3/weather/weatherInfo?city={city}&key={apikey}&extensions=all"
-        response = requests.get(url)
-        data = response.json()
-        
-        # 打印API响应
-        print(f"天气API响应: {data}")
-        
-        if data.get("status") == "1":
-            # 获取实时天气
-            if data.get("lives"):
-                live_weather = data["lives"][0]
-                return {
-                    "city": live_weather["city"],
-                    "weather": live_weather["weather"],
-                    "temperature": live_weather["temperature"],
-                    "humidity": live_weather["humidity"],
-                    "wind_direction": live_weather["winddirection"],
-                    "wind_power": live_weather["windpower"],
-                    "report_time": live_weather["reporttime"],
-                    "type": "live"
-                }
-            # 获取天气预报
-            elif data.get("forecasts"):
-                forecast = data["forecasts"][0]
-                casts = forecast["casts"]
-                return {
-                    "city": forecast["city"],
-                    "adcode": forecast["adcode"],
-                    "province": forecast["province"],
-                    "report_time": forecast["reporttime"],
-                    "forecasts": casts,
-                    "type": "forecast"
-                }
-            else:
-                return {"error": "无法获取天气信息", "raw_response": data}
+def get_weather(city, forecast=False):
+    """调用高德地图API查询天气，forecast 为真时查询未来几天的预报，否则只查实况"""
+    logger.info("查询天气: %s", city)
+    query, error = resolve_weather_city(city)
+    if error:
+        return error
+    apikey = os.environ.get("amapkey")
+    # 高德地图天气API，extensions=base 为实况，all 为预报
+    url = f"{AMAP_BASE_URL}/v3/weather/weatherInfo"
+    response = tool_http.get(url, params={"city": query, "key": apikey, "extensions": "all" if forecast else "base"})
+    data = response.json()
+    log_payload(logger, "get_weather", "天气API响应", data)
+    return parse_weather_response(data)
+
+def parse_weather_response(data):
+    """解析高德天气API响应"""
+    if data.get("status") == "1":
+        # 获取实时天气
+        if data.get("lives"):
+            live_weather = data["lives"][0]
+            return {
+                "city": live_weather["city"],
+                "weather": live_weather["weather"],
+                "temperature": live_weather["temperature"],
+                "humidity": live_weather["humidity"],
+                "wind_direction": live_weather["winddirection"],
+                "wind_power": live_weather["windpower"],
+                "report_time": live_weather["reporttime"],
+                "type": "live"
+            }
+        # 获取天气预报
+        elif data.get("forecasts"):
+            forecast = data["forecasts"][0]
+            casts = forecast["casts"]
+            return {
+                "city": forecast["city"],
+                "adcode": forecast["adcode"],
+                "province": forecast["province"],
+                "report_time": forecast["reporttime"],
+                "forecasts": casts,
+                "type": "forecast"
+            }
         else:
-            return {"error": f"天气API返回错误: {data.get('info', '未知错误')}", "raw_response": data}
-    except Exception as e:
-        print(f"查询天气出错: {e}")
-        return {"error": str(e)}
+            return {"error": "无法获取天气信息", "raw_response": data}
+    else:
+        return {"error": f"天气API返回错误: {data.get('info', '未知错误')}", "raw_response": data}
 
 def get_douyin_hot():
     """查询抖音热搜"""
-    try:
-        url = "https://apis.tianapi.com/douyinhot/index"
-        data = {"key": os.environ.get("tianapikey")}
-        response = requests.post(url, data=data)
-        result = response.json()
-        if result.get("code") == 200:
-            return {
-                "list": [item for item in result.get("result", {}).get("list", [])[:10]]
-            }
-        return {"error": "获取抖音热搜失败", "raw_response": result}
-    except Exception as e:
-        return {"error": str(e)}
+    url = f"{TIANAPI_BASE_URL}/douyinhot/index"
+    data = {"key": os.environ.get("tianapikey")}
+    response = tool_http.post(url, data=data)
+    result = response.json()
+    log_payload(logger, "get_douyin_hot", "抖音热搜API响应", result)
+    return parse_douyin_hot_response(result)
+
+def parse_douyin_hot_response(result):
+    """解析抖音热搜API响应"""
+    if result.get("code") == 200:
+        return {
+            "list": [item for item in result.get("result", {}).get("list", [])[:10]]
+        }
+    return {"error": "获取抖音热搜失败", "raw_response": result}
+
+def fetch_violation_code(code):
+    """请求违章代码API"""
+    url = f"{TIANAPI_BASE_URL}/jtwfcode/index"
+    data = {"key": os.environ.get("tianapikey"), "code": code}
+    response = tool_http.post(url, data=data)
+    result = response.json()
+    log_payload(logger, "query_violation_code", "违章代码API响应", result)
+    return parse_violation_code_response(result)
 
 def query_violation_code(code):
-    """查询交通违章代码"""
-    try:
-        # 打印调试信息
-        print(f"查询违章代码: {code}")
-        
-        url = "https://apis.tianapi.com/jtwfcode/index"
-        data = {"key": os.environ.get("tianapikey"), "code": code}
-        response = requests.post(url, data=data)
-        result = response.json()
-        
-        # 打印API响应
-        print(f"API响应: {result}")
-        
-        if result.get("code") == 200:
-            return result.get("result", {})
-        return {"error": "获取违章代码信息失败", "raw_response": result}
-    except Exception as e:
-        print(f"查询违章代码出错: {e}")
-        return {"error": str(e)}
+    """查询交通违章代码，先查本地代码表，未知代码再请求API"""
+    logger.info("查询违章代码: %s", code)
+    entry = violation_codes.get(code)
+    if entry is not None:
+        return entry
+    return remember_violation_code(code, fetch_violation_code(code))
+
+def remember_violation_code(code, result):
+    """API查询成功的结果写回本地代码表；查不到时附上本地以它开头的代码供参考"""
+    if "error" not in result:
+        violation_codes.put(dict(result, code=code))
+        return result
+    candidates = violation_codes.search_prefix(code)
+    if candidates:
+        return dict(result, candidates=candidates)
+    return result
+
+def parse_violation_code_response(result):
+    """解析违章代码API响应"""
+    if result.get("code") == 200:
+        return result.get("result", {})
+    return {"error": "获取违章代码信息失败", "raw_response": result}
+
+def fetch_attendance_day(date):
+    """请求单日考勤API，返回原始数据"""
+    response = tool_http.get(f"{HR_SERVICE_URL}/attendace_records", params={"date": date})
+    data = response.json()
+    log_payload(logger, "get_attendance_records", "考勤API响应", data)
+    return data
 
 def get_attendance_records(date):
     """查询指定日期的考勤记录"""
-    try:
-        print(f"查询考勤记录: {date}")
-        
-        url = f"http://localhost:5200/attendace_records?date={date}"
-        response = requests.get(url)
-        data = response.json()
-        
-        print(f"考勤API响应: {data}")
-        
-        if data and isinstance(data, list):
-            return {
-                "date": date,
-                "records": data,
-                "count": len(data)
-            }
-        else:
-            return {"error": "无法获取考勤记录", "raw_response": data}
-    except Exception as e:
-        print(f"查询考勤记录出错: {e}")
-        return {"error": str(e)}
+    logger.info("查询考勤记录: %s", date)
+    return fetch_day("attendance", date, fetch_attendance_day, parse_attendance_response)
+
+def get_attendance_records_range(start_date, end_date):
+    """查询一段日期内每天的考勤记录"""
+    logger.info("查询考勤记录: %s ~ %s", start_date, end_date)
+    return fetch_range("attendance", start_date, end_date, fetch_attendance_day, parse_attendance_response)
+
+def parse_attendance_response(date, data):
+    """解析考勤API响应"""
+    if data and isinstance(data, list):
+        return {
+            "date": date,
+            "records": data,
+            "count": len(data)
+        }
+    else:
+        return {"error": "无法获取考勤记录", "raw_response": data}
+
+def fetch_shift_day(date):
+    """请求单日排班API，返回原始数据"""
+    # 模拟API调用，实际应用中应连接到真实数据源
+    response = tool_http.get(f"{HR_SERVICE_URL}/shifts", params={"date": date})
+    data = response.json()
+    log_payload(logger, "get_shift_info", "排班API响应", data)
+    return data
 
 def get_shift_info(date):
     """查询指定日期的排班信息"""
-    try:
-        print(f"查询排班信息: {date}")
-        
-        # 模拟API调用，实际应用中应连接到真实数据源
-        url = f"http://localhost:5200/shifts?date={date}"
-        response = requests.get(url)
-        data = response.json()
-        
-        print(f"排班API响应: {data}")
-        
-        if data and isinstance(data, list):
-            return {
-                "date": date,
-                "records": data
-            }
-        else:
-            return {"error": "未找到排班记录"}
-    except Exception as e:
-        print(f"查询排班信息出错: {e}")
-        return {"error": str(e)}
+    logger.info("查询排班信息: %s", date)
+    return fetch_day("shift", date, fetch_shift_day, parse_shift_response)
+
+def get_shift_info_range(start_date, end_date):
+    """查询一段日期内每天的排班信息"""
+    logger.info("查询排班信息: %s ~ %s", start_date, end_date)
+    return fetch_range("shift", start_date, end_date, fetch_shift_day, parse_shift_response)
+
+def parse_shift_response(date, data):
+    """解析排班API响应"""
+    if data and isinstance(data, list):
+        return {
+            "date": date,
+            "records": data
+        }
+    else:
+        return {"error": "未找到排班记录"}
 
 def apply_leave(start_date=None, hours=None, reason=None):
     """创建请假申请链接"""
@@ -182,7 +292,7 @@ def apply_leave(start_date=None, hours=None, reason=None):
             hours = 8
             
         # 构建请假申请URL
-        application_url = f"http://localhost:5200/leaves?date={start_date}&hours={hours}&reason={reason}"
+        application_url = f"{HR_SERVICE_URL}/leaves?date={start_date}&hours={hours}&reason={reason}"
         
         return {
             "status": "success",
@@ -207,7 +317,11 @@ available_tools = [
                 "properties": {
                     "city": {
                         "type": "string",
-                        "description": "城市名称，如北京、上海、广州等"
+                        "description": "城市或区县名称，如北京、上海、广州、海淀区等"
+                    },
+                    "forecast": {
+                        "type": "boolean",
+                        "description": "是否查询未来几天的天气预报；只问当前天气时不填"
                     }
                 },
                 "required": ["city"]
@@ -276,6 +390,48 @@ available_tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_attendance_records_range",
+            "description": f"查询一段日期内（最多{HR_RANGE_MAX_DAYS}天）每天的考勤记录，查询一周、一个月等多天时使用此工具一次查完，不要逐日调用get_attendance_records",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "start_date": {
+                        "type": "string",
+                        "description": "开始日期，格式为YYYY-MM-DD，如2025-03-03"
+                    },
+                    "end_date": {
+                        "type": "string",
+                        "description": "结束日期（包含当天），格式为YYYY-MM-DD，如2025-03-09"
+                    }
+                },
+                "required": ["start_date", "end_date"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_shift_info_range",
+            "description": f"查询一段日期内（最多{HR_RANGE_MAX_DAYS}天）每天的排班信息，查询多天时使用此工具一次查完，不要逐日调用get_shift_info",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "start_date": {
+                        "type": "string",
+                        "description": "开始日期，格式为YYYY-MM-DD，如2025-03-03"
+                    },
+                    "end_date": {
+                        "type": "string",
+                        "description": "结束日期（包含当天），格式为YYYY-MM-DD，如2025-03-09"
+                    }
+                },
+                "required": ["start_date", "end_date"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -303,19 +459,22 @@ available_tools = [
     }
 ]
 
-# 工具执行函数映射
+# 工具执行函数映射；后端出错时工具函数直接抛出异常，由 tool_guard 转换成结构化错误并计入熔断
 tool_functions = {
     "get_weather": get_weather,
     "get_douyin_hot": get_douyin_hot,
     "query_violation_code": query_violation_code,
     "get_attendance_records": get_attendance_records,
     "get_shift_info": get_shift_info,
+    "get_attendance_records_range": get_attendance_records_range,
+    "get_shift_info_range": get_shift_info_range,
     "apply_leave": apply_leave
 }
 
-def create_react_system_prompt():
-    """创建ReAct模式的系统提示词"""
-    template_string = """你是一个解决问题的AI助手。请使用ReAct（思考和行动）方法解决问题，并使用Markdown格式输出，遵循以下格式：
+violation_codes.start_refresher(fetch_violation_code)
+
+# ReAct模式的系统提示词，不包含日期等随时间变化的内容，保证请求前缀稳定
+REACT_SYSTEM_PROMPT = """你是一个解决问题的AI助手。请使用ReAct（思考和行动）方法解决问题，并使用Markdown格式输出，遵循以下格式：
 
 **思考:** 分析问题，考虑可能的方法和步骤。详细解释你的推理过程。
 
@@ -340,82 +499,186 @@ def create_react_system_prompt():
 3. 明确告诉用户需要提供哪些具体信息
 4. 等待用户提供完整参数后再调用工具
 
-今天日期是：{{date}}
-
 保持回答简洁、清晰且信息丰富。
 """
-    template = Template(template_string)
-    return template.render(date=datetime.now().strftime("%Y-%m-%d"))
+
+# 日期单独作为一条系统消息放在固定提示词之后
+REACT_DATE_TEMPLATE = "今天日期是：{{date}}"
+
+prompt_assembler = PromptAssembler(REACT_SYSTEM_PROMPT, REACT_DATE_TEMPLATE, available_tools)
 
 def create_or_get_session(session_id):
     """创建新会话或获取现有会话"""
-    if not session_id or session_id not in sessions:
-        session_id = str(uuid.uuid4())
-        sessions[session_id] = []
+    if not session_id or not session_exists(session_id):
+        session_id = session_store.create()
     return session_id
 
+def session_exists(session_id):
+    """检查会话是否存在"""
+    return session_store.exists(session_id)
+
 def add_message_to_session(session_id, role, content):
     """添加消息到会话历史"""
-    sessions[session_id].append({"role": role, "content": content})
+    session_store.append(session_id, role, content)
 
 def get_session_messages(session_id):
     """获取会话历史消息"""
-    return sessions[session_id]
+    return session_store.get_messages(session_id)
 
 def build_complete_messages(session_id):
-    """构建完整的消息列表，包括系统提示"""
-    return [
-        {"role": "system", "content": create_react_system_prompt()},
-        *get_session_messages(session_id)
-    ]
+    """构建完整的消息列表，包括系统提示；历史超出token预算时只保留最近的轮次和摘要"""
+    return context_manager.build_messages(
+        session_id,
+        prompt_assembler.system_messages(),
+        get_session_messages(session_id)
+    )
+
+def summarize_history(previous_summary, messages):
+    """把较早的对话合并进会话摘要（在后台线程中调用）"""
+    transcript = "\n".join(
+        f"{message['role']}: {message['content']}" for message in messages if message.get("content")
+    )
+    if previous_summary:
+        transcript = f"已有摘要：\n{previous_summary}\n\n新增对话：\n{transcript}"
+    response = complete_chat(
+        "summary",
+        messages=[
+            {
+                "role": "system",
+                "content": "请把以下对话压缩成简洁的摘要，保留用户的需求、已确认的事实以及人名、日期、地点等关键信息，不超过300字。"
+            },
+            {"role": "user", "content": transcript}
+        ]
+    )
+    return response.choices[0].message.content
+
+# 会话历史的上下文窗口管理，见 context_window.py
+context_manager = ContextWindowManager(
+    summarize=summarize_history,
+    overhead_tokens=count_text_tokens(prompt_assembler.tools_json)
+)
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
-        print("收到聊天请求")
+        logger.debug("收到聊天请求")
         data = request.json
         user_message = data.get('message')
         session_id = data.get('sessionId')
         
         session_id = create_or_get_session(session_id)
-        add_message_to_session(session_id, "user", user_message)
+        with stream_replay.submitting(session_id):
+            add_message_to_session(session_id, "user", user_message)
         
         return jsonify({
             'sessionId': session_id,
             'status': 'streaming_ready'
         })
         
+    except GenerationInProgress:
+        return generation_conflict_response()
     except Exception as e:
-        print(f"处理聊天请求时出错: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("处理聊天请求时出错: %s", e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/chat/stream', methods=['GET'])
+@app.route('/api/chat/stream', methods=['GET', 'POST'])
 def chat_stream():
-    """处理流式响应请求"""
+    """处理流式响应请求
+
+    GET: 两步流程的第二步，先 POST /api/chat 提交消息，再按 sessionId 打开流（EventSource）。
+    POST: 一次往返，请求体与 /api/chat 相同，在同一个连接上直接返回SSE流，
+    第一帧 session_id 告知客户端会话ID。
+    带 Last-Event-ID 的重连只补发错过的帧，不会重新生成；
+    同一会话已有生成在进行时，请求作为订阅者加入它。
+    """
     try:
-        session_id = request.args.get('sessionId', '')
+        user_message = None
+        if request.method == 'POST':
+            data = request.json
+            session_id = create_or_get_session(data.get('sessionId'))
+            user_message = data.get('message')
+        else:
+            session_id = request.args.get('sessionId', '')
         
-        if not session_id or session_id not in sessions:
+        if not session_id or not session_exists(session_id):
             return jsonify({'error': 'Invalid session ID'}), 400
         
-        messages = build_complete_messages(session_id)
-        return stream_response(messages, session_id)
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+        if last_event_id:
+            return resume_stream_response(session_id, last_event_id)
         
+        return stream_response(session_id, user_message)
+        
+    except GenerationInProgress:
+        return generation_conflict_response()
+    except GenerationCapacityExceeded:
+        return generation_busy_response()
     except Exception as e:
-        print(f"处理流式请求时出错: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("处理流式请求时出错: %s", e)
         return jsonify({'error': str(e)}), 500
 
-def stream_response(messages, session_id):
-    """创建流式响应"""
-    return Response(
-        stream_with_context(generate_stream(messages, session_id)), 
-        mimetype='text/event-stream',
-        headers=get_sse_headers()
+def stream_response(session_id, user_message=None):
+    """返回订阅会话生成的流式响应，会话没有进行中的生成时在后台开始一次
+
+    user_message 为 None 表示消息已通过 /api/chat 提交；此时会话没有待回答的消息，
+    就回放最近一次生成，而不是再回答一遍。
+    """
+    if user_message is None and not has_pending_user_message(session_id):
+        latest = stream_replay.latest(session_id)
+        if latest is None:
+            return jsonify({'error': '没有待回答的消息'}), 409
+        return sse_response(latest.iter_frames())
+    
+    generation, created = stream_replay.claim(
+        session_id, user_message, admit=lambda: generation_slots.acquire(blocking=False)
     )
+    if created:
+        try:
+            if user_message is not None:
+                add_message_to_session(session_id, "user", user_message)
+            messages = build_complete_messages(session_id)
+            generation_executor.submit(run_generation, generation, generate_stream(messages, session_id))
+        except Exception:
+            generation.finish()
+            generation_slots.release()
+            raise
+    return sse_response(generation.iter_frames())
+
+def has_pending_user_message(session_id):
+    """会话最后一条消息是否是尚未回答的用户消息"""
+    messages = get_session_messages(session_id)
+    return bool(messages) and messages[-1]["role"] == "user"
+
+def generation_conflict_response():
+    return jsonify({'error': '该会话的上一条消息仍在生成中，请稍后再试'}), 409
+
+def generation_busy_response():
+    response = jsonify({'error': '服务繁忙，请稍后再试'})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+def resume_stream_response(session_id, last_event_id):
+    """按 Last-Event-ID 续传；对应的生成已过期时返回204，EventSource 收到后不再重连"""
+    resumed = stream_replay.resume(session_id, last_event_id)
+    if resumed is None:
+        return Response(status=204)
+    generation, seq = resumed
+    return sse_response(generation.iter_frames(seq, send_error('部分内容已过期，无法补发')))
+
+def run_generation(generation, frames):
+    """在后台线程中运行生成，把帧写入回放缓冲区；客户端断开不影响生成"""
+    try:
+        with session_scope(generation.session_id):
+            for frame in frames:
+                generation.append(frame)
+    except Exception as e:
+        logger.exception("后台生成出错: %s", e)
+    finally:
+        generation.finish()
+        generation_slots.release()
+
+def sse_response(frames):
+    return Response(frames, mimetype='text/event-stream', headers=get_sse_headers())
 
 def get_sse_headers():
     """获取SSE响应头"""
@@ -428,19 +691,34 @@ def get_sse_headers():
     }
 
 def generate_stream(messages, session_id):
-    """生成流式响应内容"""
+    """生成流式响应内容，各阶段耗时记录到 /api/metrics"""
     try:
-        yield send_session_id(session_id)
-        
-        full_response, tool_calls = process_initial_response(messages)
-        
-        for tool_call in merge_tool_calls(tool_calls):
-            yield from process_tool_call(tool_call, messages, full_response, session_id)
-        
-        full_response = ensure_complete_response(messages, full_response, send_content)
-        
-        add_message_to_session(session_id, "assistant", full_response)
-        yield send_done_signal()
+        with STREAMS_IN_FLIGHT.track_inprogress(), span("turn"):
+            yield send_session_id(session_id)
+            
+            # 并行模式下工具在参数完整时即开始执行，不等首轮流结束
+            tool_futures = {} if TOOL_EXECUTION_MODE == "parallel" else None
+            with span("first_pass"):
+                full_response, tool_calls = yield from process_initial_response(
+                    messages, tool_futures
+                )
+            
+            with span("tools_and_followup"):
+                if tool_futures is not None and tool_calls:
+                    full_response = yield from process_tool_calls_parallel(
+                        tool_calls, tool_futures, messages, full_response
+                    )
+                else:
+                    for tool_call in tool_calls:
+                        full_response = yield from process_tool_call(
+                            tool_call, messages, full_response, session_id
+                        )
+            
+            with span("ensure_complete"):
+                full_response = yield from ensure_complete_response(messages, full_response)
+            
+            add_message_to_session(session_id, "assistant", full_response)
+            yield send_done_signal()
         
     except Exception as e:
         yield from handle_stream_error(e, send_content)
@@ -471,40 +749,57 @@ def send_done_signal():
     """发送完成信号"""
     return f"data: {json.dumps({'type': 'done'})}\n\n"
 
-def process_initial_response(messages):
-    """处理初始响应并收集工具调用"""
+def process_initial_response(messages, tool_futures=None):
+    """处理初始响应：内容增量到达即转发给客户端，同时按 index 组装工具调用
+
+    这是一个生成器，逐个产出 content 帧，结束时通过 return 返回
+    (full_response, tool_calls)，调用方使用 ``yield from`` 获取。
+    传入 tool_futures 时，参数完整的工具调用会立即提交到线程池执行，
+    future 按调用id存入 tool_futures，工具执行与模型后续的生成重叠。
+    开启补全缓存且命中时直接回放缓存的回答和工具调用决定。
+    """
+    model = model_router.route("first_pass", messages)
+    cache_key, cached = completion_cache.lookup(
+        model, "first_pass", messages, prompt_assembler.tools_digest
+    )
+    if cached is not None:
+        return (yield from replay_cached_completion(cached, tool_futures))
+    
     full_response = ""
-    tool_calls = []
-    current_tool_call = None
+    assembler = ToolCallAssembler()
     
-    stream = client.chat.completions.create(
-        model="qwen-max",
-        messages=messages,
-        tools=available_tools,
-        stream=True
-    )
+    for chunk in stream_chat("first_pass", model, messages=messages, tools=prompt_assembler.tools):
+        if not chunk.choices:
+            continue
+        if has_content(chunk):
+            content = chunk.choices[0].delta.content
+            full_response += content
+            yield send_content(content)
+        if has_tool_calls(chunk):
+            for tool_call in assembler.feed(chunk.choices[0].delta.tool_calls):
+                if tool_futures is not None:
+                    yield from start_tool_call(tool_call, tool_futures)
     
-    for chunk in stream:
-        result = process_chunk(chunk, full_response, tool_calls, current_tool_call)
-        if isinstance(result, tuple) and len(result) == 3:
-            full_response, tool_calls, current_tool_call = result
+    for tool_call in assembler.finish():
+        if tool_futures is not None:
+            yield from start_tool_call(tool_call, tool_futures)
     
+    tool_calls = assembler.calls()
+    decisions = cacheable_tool_calls(tool_calls)
+    if decisions is not None:
+        completion_cache.store(cache_key, "first_pass", messages,
+                               {"content": full_response, "tool_calls": decisions})
     return full_response, tool_calls
 
-def process_chunk(chunk, full_response, tool_calls, current_tool_call):
-    """处理响应块，更新内容和工具调用"""
-    if has_content(chunk):
-        content = chunk.choices[0].delta.content
-        full_response += content
-    
-    if has_tool_calls(chunk):
-        tool_calls, current_tool_call = update_tool_calls(
-            chunk.choices[0].delta.tool_calls, 
-            tool_calls, 
-            current_tool_call
-        )
-    
-    return full_response, tool_calls, current_tool_call
+def replay_cached_completion(cached, tool_futures=None):
+    """一次性回放缓存的首轮回答，缓存的工具调用照常重新执行"""
+    if cached["content"]:
+        yield send_content(cached["content"])
+    tool_calls = cached_tool_calls(cached)
+    if tool_futures is not None:
+        for tool_call in tool_calls:
+            yield from start_tool_call(tool_call, tool_futures)
+    return cached["content"], tool_calls
 
 def has_content(chunk):
     """检查响应块是否包含内容"""
@@ -514,115 +809,18 @@ def has_tool_calls(chunk):
     """检查响应块是否包含工具调用"""
     return hasattr(chunk.choices[0].delta, 'tool_calls') and chunk.choices[0].delta.tool_calls
 
-def update_tool_calls(new_tool_calls, tool_calls, current_tool_call):
-    """更新工具调用列表"""
-    for tool_call in new_tool_calls:
-        if is_new_complete_tool_call(tool_call):
-            current_tool_call = create_complete_tool_call(tool_call)
-            tool_calls.append(current_tool_call)
-        elif is_new_tool_call_start(tool_call, current_tool_call):
-            current_tool_call = create_new_tool_call(tool_call)
-            tool_calls.append(current_tool_call)
-        elif is_tool_call_argument_update(tool_call, current_tool_call):
-            current_tool_call["function"]["arguments"] += tool_call.function.arguments
-        
-        if is_tool_call_id_update(tool_call, current_tool_call):
-            current_tool_call["id"] = tool_call.id
-    
-    return tool_calls, current_tool_call
-
-def is_new_complete_tool_call(tool_call):
-    """检查是否是新的完整工具调用"""
-    return (hasattr(tool_call, 'function') and tool_call.function and
-            hasattr(tool_call, 'id') and tool_call.id)
-
-def create_complete_tool_call(tool_call):
-    """创建完整的工具调用对象"""
-    return {
-        "id": tool_call.id,
-        "function": {
-            "name": tool_call.function.name,
-            "arguments": tool_call.function.arguments or ""
-        }
-    }
-
-def is_new_tool_call_start(tool_call, current_tool_call):
-    """检查是否是新工具调用的开始"""
-    return (current_tool_call is None and 
-            hasattr(tool_call, 'function') and 
-            tool_call.function and 
-            tool_call.function.name)
-
-def create_new_tool_call(tool_call):
-    """创建新的工具调用对象"""
-    return {
-        "id": None,
-        "function": {
-            "name": tool_call.function.name,
-            "arguments": tool_call.function.arguments or ""
-        }
-    }
-
-def is_tool_call_argument_update(tool_call, current_tool_call):
-    """检查是否是工具调用参数更新"""
-    return (current_tool_call is not None and 
-            hasattr(tool_call, 'function') and 
-            tool_call.function and 
-            tool_call.function.arguments)
-
-def is_tool_call_id_update(tool_call, current_tool_call):
-    """检查是否是工具调用ID更新"""
-    return (hasattr(tool_call, 'id') and 
-            tool_call.id and 
-            current_tool_call and 
-            current_tool_call["id"] is None)
-
-def merge_tool_calls(tool_calls):
-    """合并工具调用参数"""
-    merged_calls = []
-    for tc in tool_calls:
-        try:
-            args_str = tc["function"]["arguments"].strip()
-            if not args_str:
-                continue
-                
-            args_str = fix_json_format(args_str)
-            args = json.loads(args_str)
-            
-            merged_calls.append({
-                "id": tc["id"] or str(uuid.uuid4()),
-                "function": {
-                    "name": tc["function"]["name"],
-                    "arguments": json.dumps(args)
-                }
-            })
-        except Exception as e:
-            print(f"合并工具参数出错: {e}")
-    
-    # 如果没有成功合并但有工具调用，使用第一个工具调用
-    if not merged_calls and tool_calls:
-        add_first_tool_call(merged_calls, tool_calls)
-    
-    return merged_calls
-
-def fix_json_format(args_str):
-    """修复可能的JSON格式问题"""
-    if args_str.startswith('{') and not args_str.endswith('}'):
-        args_str += '}'
-    if not args_str.startswith('{'):
-        args_str = '{' + args_str
-    return args_str
-
-def add_first_tool_call(merged_calls, tool_calls):
-    """添加第一个工具调用到合并列表"""
-    first_tool = tool_calls[0]
-    merged_calls.append({
-        "id": first_tool["id"] or str(uuid.uuid4()),
-        "function": {
-            "name": first_tool["function"]["name"],
-            "arguments": first_tool["function"]["arguments"] or "{}"
-        }
-    })
+def start_tool_call(tool_call, tool_futures):
+    """通知客户端并立即在线程池中开始执行一个参数已完整的工具调用"""
+    if "error" in tool_call:
+        yield send_error(f"工具调用出错: {tool_call['error']}")
+        return
+    function_name = tool_call["function"]["name"]
+    arguments = tool_call["parsed_arguments"]
+    yield send_tool_call(function_name, arguments)
+    if function_name in tool_functions:
+        tool_futures[tool_call["id"]] = tool_executor.submit(
+            contextvars.copy_context().run, execute_tool, function_name, arguments
+        )
 
 def process_tool_call(tool_call, messages, full_response, session_id):
     """处理单个工具调用"""
@@ -639,15 +837,75 @@ def process_tool_call(tool_call, messages, full_response, session_id):
                 messages, tool_call, function_name, tool_result
             )
             
-            yield from continue_conversation(
+            full_response = yield from continue_conversation(
                 tool_response_messages, full_response
             )
     except Exception as e:
         yield send_error(f"工具调用出错: {str(e)}")
+    return full_response
+
+def process_tool_calls_parallel(tool_calls, tool_futures, messages, full_response):
+    """收集同一轮全部工具调用的结果，并通过一次后续补全回答
+
+    工具已在首轮流式响应中随参数完整逐个提交到线程池（见 start_tool_call），
+    这里按完成顺序把结果推送给客户端，再按原调用顺序组装成一批 tool 消息发回模型。
+    """
+    parsed_calls = []
+    futures = {}
+    tool_results = []
+    for tool_call in tool_calls:
+        if "error" in tool_call:
+            continue
+        function_name = tool_call["function"]["name"]
+        future = tool_futures.get(tool_call["id"])
+        if future is not None:
+            futures[future] = len(parsed_calls)
+            tool_results.append(None)
+        else:
+            tool_results.append({"error": f"未知工具: {function_name}"})
+        parsed_calls.append((tool_call, function_name, tool_call["parsed_arguments"]))
+    
+    if not parsed_calls:
+        return full_response
+    
+    for future in as_completed(futures):
+        i = futures[future]
+        function_name = parsed_calls[i][1]
+        try:
+            tool_results[i] = future.result()
+        except Exception as e:
+            tool_results[i] = {"error": str(e)}
+        yield send_tool_result(function_name, tool_results[i])
+    
+    tool_response_messages = build_batch_tool_response_messages(
+        messages, parsed_calls, tool_results
+    )
+    full_response = yield from continue_conversation(
+        tool_response_messages, full_response
+    )
+    return full_response
+
+def canonical_tool_arguments(function_name, arguments):
+    """调用和查缓存前统一参数写法：天气按 adcode 查询，同一城市的不同写法共用一个缓存条目"""
+    if function_name != "get_weather" or not isinstance(arguments.get("city"), str):
+        return arguments
+    adcode = city_index.resolve(arguments["city"])
+    return dict(arguments, city=adcode or arguments["city"], forecast=bool(arguments.get("forecast")))
 
 def execute_tool(function_name, arguments):
-    """执行工具函数"""
-    return tool_functions[function_name](**arguments)
+    """执行工具函数，可缓存的工具先查结果缓存；截止时间、隔离舱和熔断见 tool_guard.py"""
+    arguments = canonical_tool_arguments(function_name, arguments)
+    started_at = time.perf_counter()
+    result = None
+    try:
+        with TOOLS_IN_FLIGHT.track_inprogress(tool=function_name):
+            result = tool_cache.get_or_compute(
+                function_name, arguments,
+                lambda: tool_guard.call(function_name, tool_functions[function_name], arguments)
+            )
+        return result
+    finally:
+        record_tool_call(function_name, time.perf_counter() - started_at, result)
 
 def build_tool_response_messages(messages, tool_call, function_name, tool_result):
     """构建包含工具响应的消息列表"""
@@ -667,63 +925,159 @@ def build_tool_response_messages(messages, tool_call, function_name, tool_result
         },
         {
             "role": "tool", 
-            "content": json.dumps(tool_result, ensure_ascii=False), 
+            "content": tool_result_shaper.render(function_name, tool_result),
             "tool_call_id": tool_call["id"]
         }
     ])
     return tool_response_messages
 
+def build_batch_tool_response_messages(messages, parsed_calls, tool_results):
+    """构建包含一批工具响应的消息列表：一条 assistant 工具调用消息加上对应的多条 tool 消息"""
+    tool_response_messages = messages.copy()
+    tool_response_messages.append({
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{
+            "id": tool_call["id"],
+            "type": "function",
+            "function": {
+                "name": function_name,
+                "arguments": tool_call["function"]["arguments"]
+            }
+        } for tool_call, function_name, _ in parsed_calls]
+    })
+    for (tool_call, function_name, _), tool_result in zip(parsed_calls, tool_results):
+        tool_response_messages.append({
+            "role": "tool",
+            "content": tool_result_shaper.render(function_name, tool_result),
+            "tool_call_id": tool_call["id"]
+        })
+    return tool_response_messages
+
 def continue_conversation(tool_response_messages, full_response):
-    """继续对话，处理工具调用后的响应"""
-    continue_stream = client.chat.completions.create(
-        model="qwen-max",
-        messages=tool_response_messages,
-        stream=True
-    )
+    """继续对话，处理工具调用后的响应
+
+    只有所用工具的结果都不易变时（例如违章代码）才会读写补全缓存。
+    """
+    model = model_router.route("tool_followup", tool_response_messages)
+    cache_key, cached = completion_cache.lookup(model, "tool_followup", tool_response_messages)
+    if cached is not None:
+        yield send_content(cached["content"])
+        return full_response + cached["content"]
     
-    received_content = False
-    for chunk in continue_stream:
-        if has_content(chunk):
+    followup = ""
+    for chunk in stream_chat("tool_followup", model, messages=tool_response_messages):
+        if chunk.choices and has_content(chunk):
             content = chunk.choices[0].delta.content
-            full_response += content
+            followup += content
             yield send_content(content)
-            received_content = True
+    full_response += followup
     
-    if not received_content:
-        yield from handle_missing_content(tool_response_messages)
+    if followup:
+        completion_cache.store(cache_key, "tool_followup", tool_response_messages, {"content": followup})
+    else:
+        if ANSWER_COMPLETION_MODE == "stream":
+            full_response = yield from stream_answer_completion(
+                tool_response_messages, full_response
+            )
+        else:
+            full_response = yield from handle_missing_content(
+                tool_response_messages, full_response
+            )
+    
+    return full_response
 
-def handle_missing_content(tool_response_messages):
-    """处理未收到内容的情况"""
+def handle_missing_content(tool_response_messages, full_response):
+    """处理未收到内容的情况（blocking 模式）"""
     try:
-        complete_response = client.chat.completions.create(
-            model="qwen-max",
-            messages=tool_response_messages
-        )
+        complete_response = complete_chat("answer_completion", messages=tool_response_messages)
         
         if complete_response.choices[0].message.content:
             content = complete_response.choices[0].message.content
+            full_response += content
             yield send_content(content)
     except Exception as e:
-        print(f"获取完整响应失败: {e}")
+        logger.warning("获取完整响应失败: %s", e)
+    return full_response
+
+def ensure_complete_response(messages, full_response):
+    """确保响应完整，包含最终答案
 
-def ensure_complete_response(messages, full_response, send_func):
-    """确保响应完整，包含最终答案"""
+    生成器：产出补充内容的帧，并返回补充后的完整回答。
+    """
     if needs_completion(full_response):
-        full_response = complete_response(messages, full_response, send_func)
+        if ANSWER_COMPLETION_MODE == "stream":
+            full_response = yield from stream_answer_completion(messages, full_response)
+        else:
+            full_response = yield from complete_response(messages, full_response)
     
     if not full_response.strip():
-        full_response = provide_default_response(send_func)
+        full_response = yield from provide_default_response()
     
     return full_response
 
+def stream_answer_completion(messages, full_response):
+    """以一次流式续写补充最终答案，内容边生成边转发
+
+    先发出最终答案标记，再转发续写内容；续写开头如果重复了标记则去掉。
+    """
+    prefix = f"\n\n{FINAL_ANSWER_MARKER} "
+    try:
+        stream = stream_chat("answer_completion", messages=build_completion_messages(messages, full_response))
+        full_response += prefix
+        yield send_content(prefix)
+        for content in strip_leading_marker(iter_stream_content(stream)):
+            full_response += content
+            yield send_content(content)
+    except Exception as e:
+        logger.warning("补充最终答案失败: %s", e)
+        if FINAL_ANSWER_MARKER not in full_response:
+            full_response += prefix
+            yield send_content(prefix)
+        default_answer = "根据查询结果，这是相关信息的总结。"
+        full_response += default_answer
+        yield send_content(default_answer)
+    return full_response
+
+def iter_stream_content(stream):
+    """依次取出流式响应中的文本增量"""
+    for chunk in stream:
+        if chunk.choices and has_content(chunk):
+            yield chunk.choices[0].delta.content
+
+def strip_leading_marker(contents):
+    """去掉文本流开头重复出现的最终答案标记"""
+    buffer = ""
+    for content in contents:
+        if buffer is None:
+            yield content
+            continue
+        buffer += content
+        output = consume_leading_marker(buffer)
+        if output is not None:
+            buffer = None
+            if output:
+                yield output
+    if buffer:
+        yield buffer
+
+def consume_leading_marker(buffer):
+    """检查续写开头是否为最终答案标记，返回去掉标记后应转发的文本；仍无法判断时返回None"""
+    stripped = buffer.lstrip()
+    if stripped.startswith(FINAL_ANSWER_MARKER):
+        return stripped[len(FINAL_ANSWER_MARKER):].lstrip()
+    if FINAL_ANSWER_MARKER.startswith(stripped):
+        return None
+    return buffer
+
 def needs_completion(full_response):
     """检查响应是否需要补充完整"""
     return (full_response.strip() and 
             "**思考:**" in full_response and 
-            "**最终答案:**" not in full_response)
+            FINAL_ANSWER_MARKER not in full_response)
 
-def complete_response(messages, full_response, send_func):
-    """补充完整响应"""
+def complete_response(messages, full_response):
+    """补充完整响应（blocking 模式）"""
     try:
         completion_messages = build_completion_messages(messages, full_response)
         completion_response = get_completion_response(completion_messages)
@@ -734,22 +1088,23 @@ def complete_response(messages, full_response, send_func):
             )
             
             full_response += additional_content
-            send_func(send_content(additional_content))
+            yield send_content(additional_content)
     except Exception as e:
-        print(f"补充最终答案失败: {e}")
+        logger.warning("补充最终答案失败: %s", e)
         default_answer = "\n\n**最终答案:** 根据查询结果，这是相关信息的总结。"
         full_response += default_answer
-        send_func(send_content(default_answer))
+        yield send_content(default_answer)
     
     return full_response
 
 def build_completion_messages(messages, full_response):
     """构建补充完整响应的消息列表"""
     completion_messages = messages.copy()
-    completion_messages.append({
-        "role": "assistant",
-        "content": full_response
-    })
+    if full_response.strip():
+        completion_messages.append({
+            "role": "assistant",
+            "content": full_response
+        })
     completion_messages.append({
         "role": "user",
         "content": "请继续你的回答，提供最终答案。"
@@ -758,28 +1113,23 @@ def build_completion_messages(messages, full_response):
 
 def get_completion_response(completion_messages):
     """获取补充响应"""
-    return client.chat.completions.create(
-        model="qwen-max",
-        messages=completion_messages
-    )
+    return complete_chat("answer_completion", messages=completion_messages)
 
 def format_additional_content(content):
     """格式化补充内容"""
-    if "**最终答案:**" not in content:
-        content = "\n\n**最终答案:** " + content
+    if FINAL_ANSWER_MARKER not in content:
+        content = f"\n\n{FINAL_ANSWER_MARKER} " + content
     return content
 
-def provide_default_response(send_func):
+def provide_default_response():
     """提供默认响应"""
     default_response = "**思考:** 我需要分析用户的问题并提供适当的回答。\n\n**最终答案:** 抱歉，我在处理您的请求时遇到了问题。请稍后再试。"
-    send_func(send_content(default_response))
+    yield send_content(default_response)
     return default_response
 
 def handle_stream_error(error, send_func):
     """处理流式响应错误"""
-    print(f"流式响应出错: {error}")
-    import traceback
-    traceback.print_exc()
+    logger.error("流式响应出错: %s", error, exc_info=error)
     yield send_error(str(error))
     yield send_func('抱歉，处理您的请求时出现了问题。')
     yield send_done_signal()
@@ -806,12 +1156,43 @@ def standard_response(messages, session_id):
         return jsonify({'error': str(e)}), 500
 
 def get_initial_response(messages):
-    """获取初始响应"""
-    return client.chat.completions.create(
-        model="qwen-max",
-        messages=messages,
-        tools=available_tools
+    """获取初始响应，开启补全缓存时先查缓存"""
+    model = model_router.route("first_pass", messages)
+    cache_key, cached = completion_cache.lookup(
+        model, "first_pass", messages, prompt_assembler.tools_digest
     )
+    if cached is not None:
+        return build_cached_completion(cached, model)
+    
+    response = complete_chat("first_pass", model, messages=messages, tools=prompt_assembler.tools)
+    
+    message = response.choices[0].message
+    # 参数不是有效的JSON时不缓存，交给后续的工具调用处理报错
+    decisions = cacheable_message_tool_calls(message.tool_calls)
+    if decisions is not None:
+        completion_cache.store(cache_key, "first_pass", messages, {
+            "content": message.content or "",
+            "tool_calls": decisions,
+        })
+    return response
+
+def build_cached_completion(cached, model):
+    """把缓存的首轮结果还原成非流式补全响应对象"""
+    tool_calls = [
+        {"id": tc["id"], "type": "function", "function": tc["function"]}
+        for tc in cached_tool_calls(cached)
+    ]
+    return ChatCompletion.model_validate({
+        "id": "cached",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "finish_reason": "tool_calls" if tool_calls else "stop",
+            "message": {"role": "assistant", "content": cached["content"], "tool_calls": tool_calls or None}
+        }]
+    })
 
 def process_standard_tool_calls(response, messages):
     """处理标准模式下的工具调用"""
@@ -821,7 +1202,7 @@ def process_standard_tool_calls(response, messages):
         arguments = json.loads(tool_call.function.arguments)
         
         if function_name in tool_functions:
-            result = tool_functions[function_name](**arguments)
+            result = execute_tool(function_name, arguments)
             tool_results.append({
                 "tool": function_name,
                 "arguments": arguments,
@@ -833,11 +1214,7 @@ def get_final_response(messages, response, tool_results):
     """获取包含工具调用结果的最终响应"""
     tool_messages = build_standard_tool_messages(messages, response, tool_results)
     
-    final_response = client.chat.completions.create(
-        model="qwen-max",
-        messages=tool_messages,
-        tools=available_tools
-    )
+    final_response = complete_chat("tool_followup", messages=tool_messages, tools=prompt_assembler.tools)
     
     return final_response.choices[0].message.content
 
@@ -859,7 +1236,7 @@ def build_standard_tool_messages(messages, response, tool_results):
         })
         tool_messages.append({
             "role": "tool",
-            "content": json.dumps(tool_results[i]["result"]),
+            "content": tool_result_shaper.render(tool_call.function.name, tool_results[i]["result"]),
             "tool_call_id": tool_call.id
         })
     return tool_messages
@@ -867,7 +1244,56 @@ def build_standard_tool_messages(messages, response, tool_results):
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查接口"""
-    return jsonify({'status': 'ok'})
+    return jsonify({
+        'status': 'ok',
+        'tool_http': tool_http.stats(),
+        'tool_cache': tool_cache.stats(),
+        'completion_cache': completion_cache.stats(),
+        'upstream': upstream.stats(),
+        'tool_guard': tool_guard.stats(),
+        'hr_day_cache': hr_day_cache.stats(),
+        'violation_codes': violation_codes.stats(),
+        'city_index': city_index.stats(),
+        'llm_providers': llm_providers.stats(),
+        'model_router': model_router.stats()
+    })
+
+TOOL_CACHE_REQUESTS = registry.counter(
+    "tool_cache_requests_total", "Tool cache lookups by result", ("tool", "result"))
+TOOL_CACHE_ENTRIES = registry.gauge("tool_cache_entries", "Entries held by the tool result cache")
+TOOL_HTTP_REQUESTS = registry.counter(
+    "tool_http_requests_total", "Tool HTTP requests by host and kind", ("host", "kind"))
+TOOL_HTTP_CONNECTIONS = registry.gauge(
+    "tool_http_connections_opened", "Connections opened per tool backend host", ("host",))
+
+# 导出统计的工具HTTP客户端，ASGI版本会加入异步客户端
+tool_http_clients = [tool_http]
+
+def collect_component_stats():
+    """导出指标前，从工具缓存和HTTP连接池读取统计"""
+    cache_stats = tool_cache.stats()
+    for tool, counts in cache_stats["tools"].items():
+        for result in ("hits", "misses", "coalesced"):
+            TOOL_CACHE_REQUESTS.set_total(counts[result], tool=tool, result=result)
+    TOOL_CACHE_ENTRIES.set(cache_stats["entries"])
+    # 同一主机可能同时出现在同步和异步客户端中，先按主机合并再导出
+    hosts = {}
+    for client in tool_http_clients:
+        for host, counts in client.stats().items():
+            merged = hosts.setdefault(host, new_host_stats())
+            for kind in merged:
+                merged[kind] += counts.get(kind, 0)
+    for host, counts in hosts.items():
+        for kind in ("requests", "retries", "failures"):
+            TOOL_HTTP_REQUESTS.set_total(counts[kind], host=host, kind=kind)
+        TOOL_HTTP_CONNECTIONS.set(counts["connections_opened"], host=host)
+
+registry.add_collector(collect_component_stats)
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 格式的指标接口"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5100, debug=True)
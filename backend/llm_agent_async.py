@@ -0,0 +1,652 @@
+"""基于 asyncio 的聊天后端（ASGI 服务模式）
+
+与 llm_agent.py 提供相同的 /api/chat、/api/chat/stream、/api/health 接口和相同的 SSE 事件格式，
+但 LLM 调用使用服务商池的异步接口、工具调用使用异步 HTTP 客户端，
+空闲但仍打开的流式连接不再占用工作线程，单个进程即可同时保持大量 SSE 连接。
+
+启动方式：
+    hypercorn llm_agent_async:app --bind 0.0.0.0:5100
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+
+from quart import Quart, request, jsonify, Response
+from quart_cors import cors
+
+from http_client import AsyncToolHttpClient
+from tool_cache import tool_cache
+from metrics import (
+    registry, span, llm_span, track_llm_stream_async, record_tool_call,
+    STREAMS_IN_FLIGHT, TOOLS_IN_FLIGHT
+)
+from log_pipeline import log_payload
+from tool_call_assembler import ToolCallAssembler
+from stream_replay import GenerationInProgress
+from completion_cache import completion_cache, cached_tool_calls, cacheable_tool_calls
+from context_window import count_messages_tokens
+from upstream_scheduler import upstream, session_scope
+from tool_guard import tool_guard
+from violation_codes import violation_codes
+from city_index import city_index, resolve_weather_city
+from hr_range import hr_day_cache, fetch_day_async, fetch_range_async
+
+from llm_agent import (
+    TOOL_EXECUTION_MODE,
+    ANSWER_COMPLETION_MODE,
+    FINAL_ANSWER_MARKER,
+    AMAP_BASE_URL,
+    TIANAPI_BASE_URL,
+    HR_SERVICE_URL,
+    TOOL_MAX_WORKERS,
+    stream_replay,
+    tool_http_clients,
+    llm_providers,
+    model_router,
+    prompt_assembler,
+    apply_leave,
+    parse_weather_response,
+    parse_douyin_hot_response,
+    parse_violation_code_response,
+    remember_violation_code,
+    canonical_tool_arguments,
+    parse_attendance_response,
+    parse_shift_response,
+    create_or_get_session,
+    session_exists,
+    has_pending_user_message,
+    generation_conflict_response,
+    add_message_to_session,
+    build_complete_messages,
+    get_sse_headers,
+    send_session_id,
+    send_content,
+    send_tool_call,
+    send_tool_result,
+    send_error,
+    send_done_signal,
+    has_content,
+    has_tool_calls,
+    build_tool_response_messages,
+    build_batch_tool_response_messages,
+    needs_completion,
+    build_completion_messages,
+    format_additional_content,
+    consume_leading_marker,
+    handle_stream_error,
+)
+
+logger = logging.getLogger("llm_agent_async")
+
+app = Quart(__name__)
+# 配置 CORS，与同步版本保持一致
+app = cors(
+    app,
+    allow_origin=["http://localhost:3000"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization", "Last-Event-ID"],
+    expose_headers=["Content-Type"],
+    allow_credentials=True,
+    max_age=600,
+)
+
+# 与同步版本共用上游调度器、服务商池和模型路由，见 upstream_scheduler.py、provider_pool.py、model_router.py
+async def complete_chat(stage, model=None, **kwargs):
+    """发起一次非流式补全，未指定模型时由路由选择"""
+    model = model or model_router.route(stage, kwargs["messages"])
+    async with upstream.slot_async(count_messages_tokens(kwargs["messages"])) as ticket:
+        with llm_span(stage, model):
+            response = await llm_providers.acreate(model, **kwargs)
+        if response.usage:
+            ticket.used_tokens = response.usage.total_tokens
+    model_router.observe(model, total=time.monotonic() - ticket.started_at)
+    return response
+
+async def stream_chat(stage, model=None, **kwargs):
+    """发起一次流式补全并逐块产出；流读完或被放弃时才归还上游并发槽"""
+    model = model or model_router.route(stage, kwargs["messages"])
+    async with upstream.slot_async(count_messages_tokens(kwargs["messages"])) as ticket:
+        started_at = time.perf_counter()
+        stream = llm_providers.astream(model, stream_options={"include_usage": True}, **kwargs)
+        async for chunk in track_llm_stream_async(stream, stage, model, started_at):
+            ticket.first_token()
+            if chunk.usage:
+                ticket.used_tokens = chunk.usage.total_tokens
+            yield chunk
+    model_router.observe(model, ttfb=ticket.first_token_at and ticket.first_token_at - ticket.started_at,
+                         total=time.monotonic() - ticket.started_at)
+
+# 工具调用共用的异步HTTP客户端（按主机复用连接，超时与重试策略同同步版本）
+http_client = AsyncToolHttpClient()
+tool_http_clients.append(http_client)
+
+# 正在后台运行的生成任务
+generation_tasks = set()
+
+# 同一轮内并发执行的工具数上限
+tool_semaphore = asyncio.Semaphore(TOOL_MAX_WORKERS)
+
+# 异步工具定义
+async def get_weather_async(city, forecast=False):
+    """调用高德地图API查询天气（异步），forecast 为真时查询预报，否则只查实况"""
+    logger.info("查询天气: %s", city)
+    query, error = resolve_weather_city(city)
+    if error:
+        return error
+    response = await http_client.get(
+        f"{AMAP_BASE_URL}/v3/weather/weatherInfo",
+        params={"city": query, "key": os.environ.get("amapkey"), "extensions": "all" if forecast else "base"}
+    )
+    data = response.json()
+    log_payload(logger, "get_weather", "天气API响应", data)
+    return parse_weather_response(data)
+
+async def get_douyin_hot_async():
+    """查询抖音热搜（异步）"""
+    response = await http_client.post(
+        f"{TIANAPI_BASE_URL}/douyinhot/index",
+        data={"key": os.environ.get("tianapikey")}
+    )
+    result = response.json()
+    log_payload(logger, "get_douyin_hot", "抖音热搜API响应", result)
+    return parse_douyin_hot_response(result)
+
+async def query_violation_code_async(code):
+    """查询交通违章代码（异步），先查本地代码表，未知代码再请求API"""
+    logger.info("查询违章代码: %s", code)
+    entry = violation_codes.get(code)
+    if entry is not None:
+        return entry
+    response = await http_client.post(
+        f"{TIANAPI_BASE_URL}/jtwfcode/index",
+        data={"key": os.environ.get("tianapikey"), "code": code}
+    )
+    result = response.json()
+    log_payload(logger, "query_violation_code", "违章代码API响应", result)
+    return await asyncio.to_thread(remember_violation_code, code, parse_violation_code_response(result))
+
+async def fetch_attendance_day_async(date):
+    """请求单日考勤API，返回原始数据（异步）"""
+    response = await http_client.get(
+        f"{HR_SERVICE_URL}/attendace_records", params={"date": date}
+    )
+    data = response.json()
+    log_payload(logger, "get_attendance_records", "考勤API响应", data)
+    return data
+
+async def get_attendance_records_async(date):
+    """查询指定日期的考勤记录（异步）"""
+    logger.info("查询考勤记录: %s", date)
+    return await fetch_day_async("attendance", date, fetch_attendance_day_async, parse_attendance_response)
+
+async def get_attendance_records_range_async(start_date, end_date):
+    """查询一段日期内每天的考勤记录（异步）"""
+    logger.info("查询考勤记录: %s ~ %s", start_date, end_date)
+    return await fetch_range_async(
+        "attendance", start_date, end_date, fetch_attendance_day_async, parse_attendance_response
+    )
+
+async def fetch_shift_day_async(date):
+    """请求单日排班API，返回原始数据（异步）"""
+    response = await http_client.get(
+        f"{HR_SERVICE_URL}/shifts", params={"date": date}
+    )
+    data = response.json()
+    log_payload(logger, "get_shift_info", "排班API响应", data)
+    return data
+
+async def get_shift_info_async(date):
+    """查询指定日期的排班信息（异步）"""
+    logger.info("查询排班信息: %s", date)
+    return await fetch_day_async("shift", date, fetch_shift_day_async, parse_shift_response)
+
+async def get_shift_info_range_async(start_date, end_date):
+    """查询一段日期内每天的排班信息（异步）"""
+    logger.info("查询排班信息: %s ~ %s", start_date, end_date)
+    return await fetch_range_async("shift", start_date, end_date, fetch_shift_day_async, parse_shift_response)
+
+async def apply_leave_async(start_date=None, hours=None, reason=None):
+    """创建请假申请链接（纯本地计算，无需IO）"""
+    return apply_leave(start_date=start_date, hours=hours, reason=reason)
+
+# 异步工具执行函数映射
+async_tool_functions = {
+    "get_weather": get_weather_async,
+    "get_douyin_hot": get_douyin_hot_async,
+    "query_violation_code": query_violation_code_async,
+    "get_attendance_records": get_attendance_records_async,
+    "get_shift_info": get_shift_info_async,
+    "get_attendance_records_range": get_attendance_records_range_async,
+    "get_shift_info_range": get_shift_info_range_async,
+    "apply_leave": apply_leave_async
+}
+
+@app.route('/api/chat', methods=['POST'])
+async def chat():
+    try:
+        logger.debug("收到聊天请求")
+        data = await request.get_json()
+        user_message = data.get('message')
+        session_id = data.get('sessionId')
+
+        session_id = await asyncio.to_thread(create_or_get_session, session_id)
+        with stream_replay.submitting(session_id):
+            await asyncio.to_thread(add_message_to_session, session_id, "user", user_message)
+
+        return jsonify({
+            'sessionId': session_id,
+            'status': 'streaming_ready'
+        })
+
+    except GenerationInProgress:
+        return generation_conflict_response()
+    except Exception as e:
+        logger.exception("处理聊天请求时出错: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/chat/stream', methods=['GET', 'POST'])
+async def chat_stream():
+    """处理流式响应请求，POST 时在同一个连接上提交消息并返回流；同一会话的生成只运行一次"""
+    try:
+        user_message = None
+        if request.method == 'POST':
+            data = await request.get_json()
+            session_id = await asyncio.to_thread(create_or_get_session, data.get('sessionId'))
+            user_message = data.get('message')
+        else:
+            session_id = request.args.get('sessionId', '')
+
+        if not session_id or not await asyncio.to_thread(session_exists, session_id):
+            return jsonify({'error': 'Invalid session ID'}), 400
+
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+        if last_event_id:
+            return resume_stream_response(session_id, last_event_id)
+
+        return await stream_response(session_id, user_message)
+
+    except GenerationInProgress:
+        return generation_conflict_response()
+    except Exception as e:
+        logger.exception("处理流式请求时出错: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def prepare_messages(session_id, user_message):
+    """写入用户消息并构建本轮的完整消息列表（会话存储是同步的，在线程中调用）"""
+    if user_message is not None:
+        add_message_to_session(session_id, "user", user_message)
+    return build_complete_messages(session_id)
+
+async def stream_response(session_id, user_message=None):
+    """返回订阅会话生成的流式响应，会话没有进行中的生成时以后台任务开始一次
+
+    会话存储和补全缓存都是同步的SQLite操作，一律通过 asyncio.to_thread 执行，
+    一次慢的磁盘写或被其他进程持有的写锁不会阻塞事件循环上的其他流。
+    """
+    if user_message is None and not await asyncio.to_thread(has_pending_user_message, session_id):
+        latest = stream_replay.latest(session_id)
+        if latest is None:
+            return jsonify({'error': '没有待回答的消息'}), 409
+        return sse_response(latest.aiter_frames())
+
+    generation, created = stream_replay.claim(session_id, user_message)
+    if created:
+        try:
+            messages = await asyncio.to_thread(prepare_messages, session_id, user_message)
+        except BaseException:
+            generation.finish()
+            raise
+        task = asyncio.ensure_future(run_generation(generation, generate_stream(messages, session_id)))
+        # 保留任务引用，避免客户端断开后任务被回收
+        generation_tasks.add(task)
+        task.add_done_callback(generation_tasks.discard)
+    return sse_response(generation.aiter_frames())
+
+def resume_stream_response(session_id, last_event_id):
+    """按 Last-Event-ID 续传；对应的生成已过期时返回204"""
+    resumed = stream_replay.resume(session_id, last_event_id)
+    if resumed is None:
+        return Response("", status=204)
+    generation, seq = resumed
+    return sse_response(generation.aiter_frames(seq, send_error('部分内容已过期，无法补发')))
+
+async def run_generation(generation, frames):
+    """运行生成并把帧写入回放缓冲区；客户端断开不影响生成"""
+    try:
+        with session_scope(generation.session_id):
+            async for frame in frames:
+                generation.append(frame)
+    except Exception as e:
+        logger.exception("后台生成出错: %s", e)
+    finally:
+        generation.finish()
+
+def sse_response(frames):
+    response = Response(frames, mimetype='text/event-stream', headers=get_sse_headers())
+    # 流式响应的持续时间取决于LLM和工具，不设置整体超时
+    response.timeout = None
+    return response
+
+async def generate_stream(messages, session_id):
+    """生成流式响应内容（异步版本）
+
+    异步生成器无法 return 值，累计的回答文本通过 turn["full_response"] 在各阶段之间传递。
+    """
+    turn = {"full_response": ""}
+    tool_tasks = None
+    STREAMS_IN_FLIGHT.inc()
+    try:
+        with span("turn"):
+            yield send_session_id(session_id)
+
+            # 并行模式下工具在参数完整时即开始执行，不等首轮流结束
+            tool_tasks = {} if TOOL_EXECUTION_MODE == "parallel" else None
+            tool_calls = []
+            with span("first_pass"):
+                async for frame in process_initial_response(messages, turn, tool_calls, tool_tasks):
+                    yield frame
+
+            with span("tools_and_followup"):
+                if tool_tasks is not None and tool_calls:
+                    async for frame in process_tool_calls_parallel(tool_calls, tool_tasks, messages, turn):
+                        yield frame
+                else:
+                    for tool_call in tool_calls:
+                        async for frame in process_tool_call(tool_call, messages, turn):
+                            yield frame
+
+            with span("ensure_complete"):
+                async for frame in ensure_complete_response(messages, turn):
+                    yield frame
+
+            await asyncio.to_thread(add_message_to_session, session_id, "assistant", turn["full_response"])
+            yield send_done_signal()
+
+    except Exception as e:
+        for frame in handle_stream_error(e, send_content):
+            yield frame
+    finally:
+        # 客户端断开或出错时取消尚未完成的工具调用
+        for task in (tool_tasks or {}).values():
+            task.cancel()
+        STREAMS_IN_FLIGHT.dec()
+        yield "event: close\ndata: close\n\n"
+
+async def process_initial_response(messages, turn, tool_calls, tool_tasks=None):
+    """处理初始响应：内容增量到达即转发，同时把组装好的工具调用收集到 tool_calls
+
+    传入 tool_tasks 时，参数完整的工具调用立即作为任务开始执行，任务按调用id存入 tool_tasks。
+    开启补全缓存且命中时直接回放缓存的回答和工具调用决定。
+    """
+    model = model_router.route("first_pass", messages)
+    cache_key, cached = await asyncio.to_thread(
+        completion_cache.lookup, model, "first_pass", messages, prompt_assembler.tools_digest
+    )
+    if cached is not None:
+        if cached["content"]:
+            turn["full_response"] += cached["content"]
+            yield send_content(cached["content"])
+        tool_calls.extend(cached_tool_calls(cached))
+        if tool_tasks is not None:
+            for tool_call in tool_calls:
+                for frame in start_tool_call(tool_call, tool_tasks):
+                    yield frame
+        return
+
+    assembler = ToolCallAssembler()
+
+    async for chunk in stream_chat("first_pass", model, messages=messages, tools=prompt_assembler.tools):
+        if not chunk.choices:
+            continue
+        if has_content(chunk):
+            content = chunk.choices[0].delta.content
+            turn["full_response"] += content
+            yield send_content(content)
+        if has_tool_calls(chunk):
+            for tool_call in assembler.feed(chunk.choices[0].delta.tool_calls):
+                if tool_tasks is not None:
+                    for frame in start_tool_call(tool_call, tool_tasks):
+                        yield frame
+
+    for tool_call in assembler.finish():
+        if tool_tasks is not None:
+            for frame in start_tool_call(tool_call, tool_tasks):
+                yield frame
+    tool_calls.extend(assembler.calls())
+
+    decisions = cacheable_tool_calls(tool_calls)
+    if decisions is not None:
+        await asyncio.to_thread(completion_cache.store, cache_key, "first_pass", messages,
+                                {"content": turn["full_response"], "tool_calls": decisions})
+
+def start_tool_call(tool_call, tool_tasks):
+    """通知客户端并立即开始执行一个参数已完整的工具调用"""
+    if "error" in tool_call:
+        yield send_error(f"工具调用出错: {tool_call['error']}")
+        return
+    function_name = tool_call["function"]["name"]
+    arguments = tool_call["parsed_arguments"]
+    yield send_tool_call(function_name, arguments)
+    if function_name in async_tool_functions:
+        tool_tasks[tool_call["id"]] = asyncio.ensure_future(execute_tool(function_name, arguments))
+
+async def execute_tool(function_name, arguments):
+    """执行异步工具函数，可缓存的工具先查结果缓存；截止时间、隔离舱和熔断见 tool_guard.py"""
+    arguments = canonical_tool_arguments(function_name, arguments)
+
+    async def compute():
+        async with tool_semaphore:
+            return await tool_guard.call_async(function_name, async_tool_functions[function_name], arguments)
+
+    started_at = time.perf_counter()
+    result = None
+    try:
+        with TOOLS_IN_FLIGHT.track_inprogress(tool=function_name):
+            result = await tool_cache.get_or_compute_async(function_name, arguments, compute)
+        return result
+    finally:
+        record_tool_call(function_name, time.perf_counter() - started_at, result)
+
+async def process_tool_call(tool_call, messages, turn):
+    """处理单个工具调用"""
+    function_name = tool_call["function"]["name"]
+    try:
+        arguments = json.loads(tool_call["function"]["arguments"])
+        yield send_tool_call(function_name, arguments)
+
+        if function_name in async_tool_functions:
+            tool_result = await execute_tool(function_name, arguments)
+            yield send_tool_result(function_name, tool_result)
+
+            tool_response_messages = build_tool_response_messages(
+                messages, tool_call, function_name, tool_result
+            )
+
+            async for frame in continue_conversation(tool_response_messages, turn):
+                yield frame
+    except Exception as e:
+        yield send_error(f"工具调用出错: {str(e)}")
+
+async def process_tool_calls_parallel(tool_calls, tool_tasks, messages, turn):
+    """收集同一轮全部工具调用的结果，并通过一次后续补全回答
+
+    工具任务已在首轮流式响应中随参数完整逐个启动，这里按完成顺序推送结果。
+    """
+    parsed_calls = []
+    tasks = {}
+    tool_results = []
+    for tool_call in tool_calls:
+        if "error" in tool_call:
+            continue
+        function_name = tool_call["function"]["name"]
+        task = tool_tasks.get(tool_call["id"])
+        if task is not None:
+            tasks[task] = len(parsed_calls)
+            tool_results.append(None)
+        else:
+            tool_results.append({"error": f"未知工具: {function_name}"})
+        parsed_calls.append((tool_call, function_name, tool_call["parsed_arguments"]))
+
+    if not parsed_calls:
+        return
+
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i = tasks[task]
+                try:
+                    tool_results[i] = task.result()
+                except Exception as e:
+                    tool_results[i] = {"error": str(e)}
+                yield send_tool_result(parsed_calls[i][1], tool_results[i])
+    finally:
+        # 客户端断开时取消尚未完成的工具调用
+        for task in pending:
+            task.cancel()
+
+    tool_response_messages = build_batch_tool_response_messages(
+        messages, parsed_calls, tool_results
+    )
+    async for frame in continue_conversation(tool_response_messages, turn):
+        yield frame
+
+async def continue_conversation(tool_response_messages, turn):
+    """继续对话，处理工具调用后的响应，工具结果都不易变时读写补全缓存"""
+    model = model_router.route("tool_followup", tool_response_messages)
+    cache_key, cached = await asyncio.to_thread(
+        completion_cache.lookup, model, "tool_followup", tool_response_messages
+    )
+    if cached is not None:
+        turn["full_response"] += cached["content"]
+        yield send_content(cached["content"])
+        return
+
+    followup = ""
+    async for chunk in stream_chat("tool_followup", model, messages=tool_response_messages):
+        if chunk.choices and has_content(chunk):
+            content = chunk.choices[0].delta.content
+            followup += content
+            turn["full_response"] += content
+            yield send_content(content)
+
+    if followup:
+        await asyncio.to_thread(
+            completion_cache.store, cache_key, "tool_followup", tool_response_messages, {"content": followup}
+        )
+    else:
+        if ANSWER_COMPLETION_MODE == "stream":
+            missing_content = stream_answer_completion(tool_response_messages, turn)
+        else:
+            missing_content = handle_missing_content(tool_response_messages, turn)
+        async for frame in missing_content:
+            yield frame
+
+async def handle_missing_content(tool_response_messages, turn):
+    """处理未收到内容的情况（blocking 模式）"""
+    try:
+        complete_response = await complete_chat("answer_completion", messages=tool_response_messages)
+
+        if complete_response.choices[0].message.content:
+            content = complete_response.choices[0].message.content
+            turn["full_response"] += content
+            yield send_content(content)
+    except Exception as e:
+        logger.warning("获取完整响应失败: %s", e)
+
+async def ensure_complete_response(messages, turn):
+    """确保响应完整，包含最终答案"""
+    if needs_completion(turn["full_response"]) and ANSWER_COMPLETION_MODE == "stream":
+        async for frame in stream_answer_completion(messages, turn):
+            yield frame
+    elif needs_completion(turn["full_response"]):
+        try:
+            completion_response = await complete_chat(
+                "answer_completion", messages=build_completion_messages(messages, turn["full_response"])
+            )
+            if completion_response.choices[0].message.content:
+                additional_content = format_additional_content(
+                    completion_response.choices[0].message.content
+                )
+                turn["full_response"] += additional_content
+                yield send_content(additional_content)
+        except Exception as e:
+            logger.warning("补充最终答案失败: %s", e)
+            default_answer = "\n\n**最终答案:** 根据查询结果，这是相关信息的总结。"
+            turn["full_response"] += default_answer
+            yield send_content(default_answer)
+
+    if not turn["full_response"].strip():
+        default_response = "**思考:** 我需要分析用户的问题并提供适当的回答。\n\n**最终答案:** 抱歉，我在处理您的请求时遇到了问题。请稍后再试。"
+        turn["full_response"] = default_response
+        yield send_content(default_response)
+
+async def stream_answer_completion(messages, turn):
+    """以一次流式续写补充最终答案，内容边生成边转发"""
+    prefix = f"\n\n{FINAL_ANSWER_MARKER} "
+    try:
+        stream = stream_chat(
+            "answer_completion", messages=build_completion_messages(messages, turn["full_response"])
+        )
+        turn["full_response"] += prefix
+        yield send_content(prefix)
+        buffer = ""
+        async for chunk in stream:
+            if not (chunk.choices and has_content(chunk)):
+                continue
+            content = chunk.choices[0].delta.content
+            if buffer is not None:
+                # 去掉续写开头重复的最终答案标记
+                buffer += content
+                content = consume_leading_marker(buffer)
+                if content is None:
+                    continue
+                buffer = None
+            if content:
+                turn["full_response"] += content
+                yield send_content(content)
+        if buffer:
+            turn["full_response"] += buffer
+            yield send_content(buffer)
+    except Exception as e:
+        logger.warning("补充最终答案失败: %s", e)
+        if FINAL_ANSWER_MARKER not in turn["full_response"]:
+            turn["full_response"] += prefix
+            yield send_content(prefix)
+        default_answer = "根据查询结果，这是相关信息的总结。"
+        turn["full_response"] += default_answer
+        yield send_content(default_answer)
+
+@app.route('/api/health', methods=['GET'])
+async def health_check():
+    """健康检查接口"""
+    return jsonify({
+        'status': 'ok',
+        'tool_http': http_client.stats(),
+        'tool_cache': tool_cache.stats(),
+        'completion_cache': await asyncio.to_thread(completion_cache.stats),
+        'upstream': upstream.stats(),
+        'tool_guard': tool_guard.stats(),
+        'hr_day_cache': await asyncio.to_thread(hr_day_cache.stats),
+        'violation_codes': violation_codes.stats(),
+        'city_index': city_index.stats(),
+        'llm_providers': llm_providers.stats(),
+        'model_router': model_router.stats()
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+async def metrics_endpoint():
+    """Prometheus 格式的指标接口"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_serving
+async def close_clients():
+    """服务停止时关闭连接池"""
+    await http_client.aclose()
+    await llm_providers.aclose()
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5100)
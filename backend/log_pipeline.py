@@ -0,0 +1,157 @@
+"""非阻塞日志管道
+
+请求线程只把日志记录放进有界队列，由后台线程格式化并写出：
+- 消息使用 logging 的 %s 占位符延迟格式化，格式化和写 stderr 都在后台线程完成
+- 队列满时直接丢弃并计数，不阻塞请求线程
+- 上游响应等大块内容通过 log_payload 记录：仅在 DEBUG 级别、按工具采样、截断到固定长度
+
+配置（环境变量）：
+- LOG_LEVEL: 日志级别，默认 INFO
+- LOG_FORMAT: text 或 json（每行一个JSON对象），默认 text
+- LOG_QUEUE_SIZE: 队列容量，默认 10000
+- LOG_PAYLOAD_MAX_CHARS: 单条内容的最大字符数，默认 512
+- LOG_PAYLOAD_SAMPLE_RATE: 内容日志的默认采样率，默认 1.0
+- LOG_PAYLOAD_SAMPLE_RATES: 按工具覆盖采样率的JSON，例如 {"get_weather": 0.1}
+"""
+import os
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import registry
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", "512"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+
+LOG_RECORDS_DROPPED = registry.counter(
+    "log_records_dropped_total", "Log records dropped because the log queue was full")
+
+# 写入 JSON 日志时保留的自定义字段（通过 extra= 传入）
+EXTRA_FIELDS = ("tool", "session_id", "stage")
+
+
+def load_sample_rates():
+    """读取按工具的采样率配置"""
+    rates = os.environ.get("LOG_PAYLOAD_SAMPLE_RATES")
+    if not rates:
+        return {}
+    try:
+        return {tool: float(rate) for tool, rate in json.loads(rates).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        logging.getLogger(__name__).warning("LOG_PAYLOAD_SAMPLE_RATES 配置无效: %s", e)
+        return {}
+
+
+class Truncated:
+    """延迟序列化并截断的内容，只有真正写出时才转换成字符串"""
+
+    __slots__ = ("payload", "limit")
+
+    def __init__(self, payload, limit=LOG_PAYLOAD_MAX_CHARS):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self):
+        if isinstance(self.payload, str):
+            text = self.payload
+        else:
+            try:
+                text = json.dumps(self.payload, ensure_ascii=False, default=str)
+            except (TypeError, ValueError):
+                text = repr(self.payload)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}...(共{len(text)}字符)"
+        return text
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """队列满时丢弃记录；不在调用线程中格式化消息"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+    def prepare(self, record):
+        # 进程内队列不需要序列化，消息和异常堆栈留给后台线程格式化
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出一行JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_listener = None
+_lock = threading.Lock()
+_sample_rates = load_sample_rates()
+
+
+def build_formatter():
+    if LOG_FORMAT == "json":
+        return JsonFormatter()
+    return logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s")
+
+
+def configure_logging():
+    """把根日志器接到后台队列上，可重复调用"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        output = logging.StreamHandler()
+        output.setFormatter(build_formatter())
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(NonBlockingQueueHandler(log_queue))
+        root.setLevel(LOG_LEVEL)
+
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """停止后台线程，写出队列中剩余的记录"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def should_sample(tool):
+    rate = _sample_rates.get(tool, LOG_PAYLOAD_SAMPLE_RATE)
+    return rate >= 1.0 or random.random() < rate
+
+
+def log_payload(logger, tool, label, payload):
+    """以 DEBUG 级别按采样记录上游响应等大块内容，内容被截断后写出"""
+    if not logger.isEnabledFor(logging.DEBUG) or not should_sample(tool):
+        return
+    logger.debug("%s: %s", label, Truncated(payload), extra={"tool": tool})
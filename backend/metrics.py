@@ -0,0 +1,286 @@
+"""轻量级指标采集，输出 Prometheus 文本格式
+
+提供带标签的计数器、仪表和直方图，以及在热路径上使用的计时工具：
+- span(): 计时上下文管理器
+- track_llm_stream(): 包装LLM流式响应，记录首个数据块等待时间（TTFB）和流持续时间
+- LatencyWindow: 最近若干次耗时的滑动窗口，供路由和对冲请求估算分位数
+"""
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 直方图默认分桶（秒），覆盖从毫秒级工具调用到分钟级的长回答
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_items(items))
+        return lines
+
+    def _render_items(self, items):
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"
+                for key, value in items]
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """直接设置累计值，用于从其他组件的统计中导出计数"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_items(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, key, [("le", format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class LatencyWindow:
+    """最近 size 次耗时的滑动窗口，用于在运行时估算分位数"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q):
+        """返回 q 分位（0~1）的耗时，没有样本时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class Registry:
+    """指标注册表，collector 用于在导出时从其他组件读取统计"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def add_collector(self, collector):
+        """collector() 在每次导出前被调用，用于刷新仪表的值"""
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning("指标采集出错: %s", e)
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+LLM_REQUESTS = registry.counter(
+    "llm_requests_total", "LLM requests by stage and model", ("stage", "model"))
+LLM_ERRORS = registry.counter(
+    "llm_errors_total", "Failed LLM requests by stage and model", ("stage", "model"))
+LLM_TTFB = registry.histogram(
+    "llm_ttfb_seconds", "Time from sending an LLM request to its first chunk", ("stage", "model"))
+LLM_STREAM = registry.histogram(
+    "llm_stream_seconds", "Time from the first chunk to the end of an LLM stream", ("stage", "model"))
+LLM_LATENCY = registry.histogram(
+    "llm_request_seconds", "Total duration of an LLM request", ("stage", "model"))
+STAGE_LATENCY = registry.histogram(
+    "chat_stage_seconds", "Duration of each generate_stream stage", ("stage",))
+TOOL_LATENCY = registry.histogram(
+    "tool_call_seconds", "Tool execution time", ("tool", "outcome"))
+TOOL_CALLS = registry.counter(
+    "tool_calls_total", "Tool executions by outcome", ("tool", "outcome"))
+STREAMS_IN_FLIGHT = registry.gauge(
+    "chat_streams_in_flight", "Currently open chat streams")
+TOOLS_IN_FLIGHT = registry.gauge(
+    "tool_calls_in_flight", "Currently running tool calls", ("tool",))
+
+
+@contextmanager
+def span(stage):
+    """记录一个 generate_stream 阶段的耗时"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - started_at, stage=stage)
+
+
+@contextmanager
+def llm_span(stage, model):
+    """记录一次非流式LLM请求的耗时"""
+    LLM_REQUESTS.inc(stage=stage, model=model)
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        LLM_ERRORS.inc(stage=stage, model=model)
+        raise
+    finally:
+        LLM_LATENCY.observe(time.perf_counter() - started_at, stage=stage, model=model)
+
+
+def track_llm_stream(stream, stage, model, started_at):
+    """包装流式响应，记录首个数据块等待时间和流的持续时间
+
+    started_at 应在发起请求之前取得，这样TTFB包含建立连接和上游排队的时间。
+    """
+    LLM_REQUESTS.inc(stage=stage, model=model)
+    first_chunk_at = None
+    try:
+        for chunk in stream:
+            if first_chunk_at is None:
+                first_chunk_at = time.perf_counter()
+                LLM_TTFB.observe(first_chunk_at - started_at, stage=stage, model=model)
+            yield chunk
+    except Exception:
+        LLM_ERRORS.inc(stage=stage, model=model)
+        raise
+    finally:
+        finished_at = time.perf_counter()
+        if first_chunk_at is not None:
+            LLM_STREAM.observe(finished_at - first_chunk_at, stage=stage, model=model)
+        LLM_LATENCY.observe(finished_at - started_at, stage=stage, model=model)
+
+
+async def track_llm_stream_async(stream, stage, model, started_at):
+    """track_llm_stream 的异步版本"""
+    LLM_REQUESTS.inc(stage=stage, model=model)
+    first_chunk_at = None
+    try:
+        async for chunk in stream:
+            if first_chunk_at is None:
+                first_chunk_at = time.perf_counter()
+                LLM_TTFB.observe(first_chunk_at - started_at, stage=stage, model=model)
+            yield chunk
+    except Exception:
+        LLM_ERRORS.inc(stage=stage, model=model)
+        raise
+    finally:
+        finished_at = time.perf_counter()
+        if first_chunk_at is not None:
+            LLM_STREAM.observe(finished_at - first_chunk_at, stage=stage, model=model)
+        LLM_LATENCY.observe(finished_at - started_at, stage=stage, model=model)
+
+
+def record_tool_call(tool, seconds, result):
+    """记录一次工具调用的耗时和结果"""
+    outcome = "error" if isinstance(result, dict) and "error" in result else "ok"
+    TOOL_LATENCY.observe(seconds, tool=tool, outcome=outcome)
+    TOOL_CALLS.inc(tool=tool, outcome=outcome)
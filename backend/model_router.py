@@ -0,0 +1,137 @@
+"""按阶段和问题类型选择模型
+
+大多数对话是简单的工具查询（天气、热搜、违章代码、考勤排班），选择工具和概括较短的工具结果
+用小模型就够了，开放式的推理仍然使用大模型：
+- 问题类型：最近一条用户消息较短且提到了某个工具的关键词时为 lookup，否则为 open；
+  工具结果后的续写阶段，工具结果超过 ROUTER_SHORT_RESULT_TOKENS 时也按 open 处理
+- 路由表按 阶段 -> 问题类型 -> 模型 查找，没有对应类型时用该阶段的 default，再没有时用默认模型
+- 路由表中的模型可以写成列表，按各模型最近的首包延迟中位数选最快的（没有样本的先试）
+- 每次调用后记录模型的首包延迟和总耗时，stats() 给出各模型的分位数
+
+阶段：first_pass（首轮，决定是否调用工具）、tool_followup（根据工具结果作答）、
+answer_completion（补充最终答案）、summary（会话历史摘要）
+
+配置（环境变量）：
+- ROUTER_FAST_MODEL: 默认路由表中 lookup 类问题使用的模型，默认 qwen-turbo
+- MODEL_ROUTES: 覆盖路由表的JSON，按阶段整体替换，例如
+  {"first_pass": {"lookup": "qwen-turbo", "default": "qwen-max"}, "tool_followup": ["qwen-turbo", "qwen-plus"]}
+- MODEL_OVERRIDE: 设置后所有阶段都使用这个模型
+- ROUTER_SHORT_QUERY_CHARS: lookup 类问题的最大长度，默认 80
+- ROUTER_SHORT_RESULT_TOKENS: 按 lookup 处理的工具结果token数上限，默认 1000
+"""
+import os
+import json
+import logging
+
+from context_window import count_text_tokens
+from metrics import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+ROUTER_FAST_MODEL = os.environ.get("ROUTER_FAST_MODEL", "qwen-turbo")
+MODEL_OVERRIDE = os.environ.get("MODEL_OVERRIDE") or None
+ROUTER_SHORT_QUERY_CHARS = int(os.environ.get("ROUTER_SHORT_QUERY_CHARS", "80"))
+ROUTER_SHORT_RESULT_TOKENS = int(os.environ.get("ROUTER_SHORT_RESULT_TOKENS", "1000"))
+
+# 提到这些词的短问题通常一次工具调用就能回答
+LOOKUP_KEYWORDS = ("天气", "气温", "下雨", "热搜", "抖音", "违章", "违法代码", "扣分",
+                   "考勤", "打卡", "排班", "班次", "上班", "请假")
+
+
+def load_routes():
+    """读取 MODEL_ROUTES 配置"""
+    routes = os.environ.get("MODEL_ROUTES")
+    if not routes:
+        return {}
+    try:
+        return json.loads(routes)
+    except ValueError as e:
+        logger.warning("MODEL_ROUTES 配置无效: %s", e)
+        return {}
+
+
+def last_user_message(messages):
+    for message in reversed(messages or []):
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            return message["content"]
+    return ""
+
+
+class ModelRouter:
+    """按阶段和问题类型选择模型，并记录各模型的延迟"""
+
+    def __init__(self, default_model, routes=None, override=MODEL_OVERRIDE):
+        self.default_model = default_model
+        self.override = override
+        self.routes = {}
+        for stage, route in (routes or {}).items():
+            self.routes[stage] = route if isinstance(route, dict) else {"default": route}
+        self._ttfb = {}
+        self._total = {}
+
+    @classmethod
+    def from_env(cls, default_model, summary_model):
+        routes = {
+            "first_pass": {"lookup": ROUTER_FAST_MODEL},
+            "tool_followup": {"lookup": ROUTER_FAST_MODEL},
+            "summary": summary_model,
+        }
+        routes.update(load_routes())
+        return cls(default_model, routes)
+
+    def classify(self, stage, messages):
+        """问题类型：lookup 或 open"""
+        query = last_user_message(messages).strip()
+        if len(query) > ROUTER_SHORT_QUERY_CHARS or not any(word in query for word in LOOKUP_KEYWORDS):
+            return "open"
+        if stage == "tool_followup":
+            result_tokens = sum(
+                count_text_tokens(message.get("content")) for message in messages
+                if message.get("role") == "tool"
+            )
+            if result_tokens > ROUTER_SHORT_RESULT_TOKENS:
+                return "open"
+        return "lookup"
+
+    def route(self, stage, messages=None):
+        """选择本次调用使用的模型"""
+        if self.override:
+            return self.override
+        route = self.routes.get(stage)
+        if not route:
+            return self.default_model
+        model = route.get(self.classify(stage, messages)) or route.get("default") or self.default_model
+        if isinstance(model, list):
+            return self.fastest(model)
+        return model
+
+    def fastest(self, models):
+        """首包延迟中位数最低的模型，没有样本的模型优先，以便积累数据"""
+        def median(model):
+            window = self._ttfb.get(model)
+            value = window.percentile(0.5) if window is not None else None
+            return -1.0 if value is None else value
+        return min(models, key=median)
+
+    def observe(self, model, ttfb=None, total=None):
+        """记录一次调用的首包延迟（流式）和总耗时"""
+        if ttfb is not None:
+            self._window(self._ttfb, model).observe(ttfb)
+        if total is not None:
+            self._window(self._total, model).observe(total)
+
+    def _window(self, windows, model):
+        window = windows.get(model)
+        if window is None:
+            window = windows.setdefault(model, LatencyWindow())
+        return window
+
+    def stats(self):
+        models = {}
+        for name, windows in (("ttfb", self._ttfb), ("total", self._total)):
+            for model, window in list(windows.items()):
+                entry = models.setdefault(model, {})
+                for q in (0.5, 0.95):
+                    entry[f"{name}_p{int(q * 100)}"] = round(window.percentile(q), 3)
+                entry[f"{name}_samples"] = len(window)
+        return {"override": self.override, "routes": self.routes, "models": models}
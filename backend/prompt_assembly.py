@@ -0,0 +1,43 @@
+"""提示词组装
+
+- 模板只编译一次，按日期渲染的系统消息做缓存
+- 工具定义只序列化一次，得到稳定的JSON文本和摘要，供token统计和缓存键使用
+- 消息布局为 [固定系统提示词][日期消息][历史...]，固定部分不含日期，
+  工具定义加固定系统提示词在所有会话之间逐字节相同，可以命中模型服务商的前缀缓存
+"""
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+from jinja2 import Template
+
+
+class PromptAssembler:
+    """组装系统消息并缓存工具定义的序列化结果"""
+
+    def __init__(self, static_prompt, date_template, tools):
+        self.static_message = {"role": "system", "content": static_prompt}
+        self._date_template = Template(date_template)
+        self._date_messages = {}
+        self._lock = threading.Lock()
+        self.tools = tools
+        self.tools_json = json.dumps(tools, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        self.tools_digest = hashlib.sha256(self.tools_json.encode("utf-8")).hexdigest()
+
+    def date_message(self, date):
+        """按日期渲染的系统消息，每个日期只渲染一次"""
+        message = self._date_messages.get(date)
+        if message is None:
+            message = {"role": "system", "content": self._date_template.render(date=date)}
+            with self._lock:
+                # 只保留最近几天的渲染结果
+                if len(self._date_messages) >= 7:
+                    self._date_messages.clear()
+                self._date_messages[date] = message
+        return message
+
+    def system_messages(self, date=None):
+        """返回系统消息列表：固定提示词在前，日期在后"""
+        date = date or datetime.now().strftime("%Y-%m-%d")
+        return [self.static_message, self.date_message(date)]
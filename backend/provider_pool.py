@@ -0,0 +1,422 @@
+"""多服务商的LLM调用池
+
+把若干个 OpenAI 兼容的服务端点放在一个池里，按健康分数排序使用：
+- 请求失败（连接错误、超时、429、5xx）时换下一个服务商重试，并降低失败方的健康分数；
+  连续失败达到阈值的服务商暂停使用一段时间，之后再放少量请求试探
+- 参数错误等请求本身的问题（4xx）直接抛出，不换服务商
+- 流式请求只在收到首个数据块之前切换，之后的中断照常抛出，避免回答内容重复
+- 可选的对冲请求：首个数据块在阈值（该服务商最近首包延迟的p95）内还没有到达时，
+  向下一个服务商再发一份相同的请求，先出首包的一方胜出，另一方的请求被取消
+
+配置（环境变量）：
+- LLM_PROVIDERS: 服务商列表的JSON，例如
+  [{"name": "dashscope", "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "api_key_env": "AliDeep"},
+   {"name": "deepseek", "base_url": "https://api.deepseek.com/v1", "api_key_env": "deepseek_api_key",
+    "models": {"qwen-max": "deepseek-chat", "qwen-turbo": "deepseek-chat"}}]
+  models 把本服务使用的模型名映射到该服务商的模型名，不写时模型名原样使用；
+  未配置时只有一个服务商，地址取 LLM_BASE_URL，密钥取 AliDeep
+- LLM_TIMEOUT: 单次请求的连接和读取超时（秒），默认 60
+- LLM_MAX_RETRIES: 客户端在同一服务商上的重试次数，默认 1
+- LLM_PROVIDER_FAILURE_THRESHOLD: 连续失败多少次后暂停使用，默认 3
+- LLM_PROVIDER_COOLDOWN: 暂停使用的初始秒数，之后每次失败翻倍，最多 300 秒，默认 10
+- LLM_HEDGE_ENABLED: 设为 1 开启对冲请求，默认关闭
+- LLM_HEDGE_MIN_DELAY: 对冲阈值的下限（秒），默认 0.5
+- LLM_HEDGE_DEFAULT_DELAY: 样本不足时使用的对冲阈值（秒），默认 3
+- LLM_HEDGE_MIN_SAMPLES: 使用p95作为阈值所需的最少样本数，默认 20
+"""
+import os
+import json
+import time
+import queue
+import asyncio
+import logging
+import threading
+
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+from metrics import registry, LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+LLM_BASE_URL = os.environ.get("LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "1"))
+LLM_PROVIDER_FAILURE_THRESHOLD = int(os.environ.get("LLM_PROVIDER_FAILURE_THRESHOLD", "3"))
+LLM_PROVIDER_COOLDOWN = float(os.environ.get("LLM_PROVIDER_COOLDOWN", "10"))
+LLM_PROVIDER_MAX_COOLDOWN = 300.0
+LLM_HEDGE_ENABLED = os.environ.get("LLM_HEDGE_ENABLED", "0") == "1"
+LLM_HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", "0.5"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.environ.get("LLM_HEDGE_DEFAULT_DELAY", "3"))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# 健康分数的指数平滑系数
+HEALTH_DECAY = 0.8
+
+LLM_PROVIDER_ATTEMPTS = registry.counter(
+    "llm_provider_attempts_total", "LLM request attempts by provider and outcome", ("provider", "outcome"))
+LLM_HEDGES = registry.counter(
+    "llm_hedged_requests_total", "Hedged LLM streams by which attempt produced the first chunk", ("winner",))
+
+
+def is_retryable(error):
+    """换一个服务商可能成功的错误：连接问题、超时、限流和服务端错误"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in (408, 409, 429) or status >= 500)
+
+
+def close_quietly(stream):
+    close = getattr(stream, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+async def aclose_quietly(stream):
+    close = getattr(stream, "close", None)
+    if close is not None:
+        try:
+            await close()
+        except Exception:
+            pass
+
+
+class Provider:
+    """一个 OpenAI 兼容的服务端点及其健康状态"""
+
+    def __init__(self, name, base_url, api_key, models=None, index=0):
+        self.name = name
+        self.base_url = base_url
+        self.models = models
+        self.index = index
+        self.client = OpenAI(api_key=api_key, base_url=base_url,
+                             timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES)
+        self.async_client = AsyncOpenAI(api_key=api_key, base_url=base_url,
+                                        timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES)
+        self.ttfb = LatencyWindow()
+        self.score = 1.0
+        self.failures = 0
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def model_name(self, model):
+        """该服务商上对应的模型名，不支持该模型时返回 None"""
+        if self.models is None:
+            return model
+        return self.models.get(model)
+
+    def available(self, now):
+        return now >= self.paused_until
+
+    def record_success(self, ttfb=None):
+        with self._lock:
+            self.score = self.score * HEALTH_DECAY + (1 - HEALTH_DECAY)
+            self.failures = 0
+            self.paused_until = 0.0
+        if ttfb is not None:
+            self.ttfb.observe(ttfb)
+        LLM_PROVIDER_ATTEMPTS.inc(provider=self.name, outcome="ok")
+
+    def record_failure(self, error):
+        with self._lock:
+            self.score *= HEALTH_DECAY
+            self.failures += 1
+            if self.failures >= LLM_PROVIDER_FAILURE_THRESHOLD:
+                cooldown = LLM_PROVIDER_COOLDOWN * 2 ** (self.failures - LLM_PROVIDER_FAILURE_THRESHOLD)
+                self.paused_until = time.monotonic() + min(cooldown, LLM_PROVIDER_MAX_COOLDOWN)
+        LLM_PROVIDER_ATTEMPTS.inc(provider=self.name, outcome="error")
+        logger.warning("LLM服务商 %s 请求失败: %s", self.name, error)
+
+    def hedge_delay(self):
+        """等待首个数据块多久后发出对冲请求"""
+        if len(self.ttfb) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_DEFAULT_DELAY
+        return max(LLM_HEDGE_MIN_DELAY, self.ttfb.percentile(0.95))
+
+    def stats(self):
+        p95 = self.ttfb.percentile(0.95)
+        return {
+            "base_url": self.base_url,
+            "score": round(self.score, 3),
+            "failures": self.failures,
+            "paused": not self.available(time.monotonic()),
+            "ttfb_p95": round(p95, 3) if p95 is not None else None,
+        }
+
+
+class ProviderPool:
+    """按健康分数使用多个服务商，提供带故障切换（和可选对冲）的补全调用"""
+
+    def __init__(self, providers, hedge=LLM_HEDGE_ENABLED):
+        if not providers:
+            raise ValueError("至少需要一个LLM服务商")
+        self.providers = providers
+        self.hedge = hedge
+
+    @classmethod
+    def from_env(cls):
+        config = os.environ.get("LLM_PROVIDERS")
+        if not config:
+            return cls([Provider("default", LLM_BASE_URL, os.environ.get("AliDeep"))])
+        providers = []
+        for index, item in enumerate(json.loads(config)):
+            name = item.get("name") or f"provider-{index}"
+            try:
+                providers.append(Provider(
+                    name, item["base_url"], os.environ.get(item.get("api_key_env", "AliDeep")),
+                    models=item.get("models"), index=index
+                ))
+            except openai.OpenAIError as e:
+                logger.warning("跳过LLM服务商 %s: %s", name, e)
+        return cls(providers)
+
+    def candidates(self, model):
+        """支持该模型的服务商，可用的按健康分数排在前面，暂停中的按恢复时间排在最后"""
+        now = time.monotonic()
+        supported = [p for p in self.providers if p.model_name(model) is not None]
+        if not supported:
+            raise ValueError(f"没有服务商支持模型 {model}")
+        available = sorted((p for p in supported if p.available(now)), key=lambda p: (-p.score, p.index))
+        paused = sorted((p for p in supported if not p.available(now)), key=lambda p: p.paused_until)
+        return available + paused
+
+    # ---- 同步接口 ----
+
+    def create(self, model, **kwargs):
+        """非流式补全，失败时按顺序换服务商"""
+        last_error = None
+        for provider in self.candidates(model):
+            try:
+                response = provider.client.chat.completions.create(
+                    model=provider.model_name(model), **kwargs
+                )
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                provider.record_failure(e)
+                last_error = e
+                continue
+            provider.record_success()
+            return response
+        raise last_error
+
+    def stream(self, model, **kwargs):
+        """流式补全，返回数据块迭代器；首个数据块到达前失败会换服务商"""
+        candidates = self.candidates(model)
+        if self.hedge and len(candidates) > 1:
+            provider, stream, first = self._race(candidates, model, kwargs)
+        else:
+            provider, stream, first = self._failover(candidates, model, kwargs)
+        return self._relay(provider, stream, first)
+
+    def _open(self, provider, model, kwargs, on_stream=None):
+        """发起流式请求并等到首个数据块，返回 (stream, 首个数据块或 None)"""
+        started_at = time.monotonic()
+        stream = provider.client.chat.completions.create(
+            model=provider.model_name(model), stream=True, **kwargs
+        )
+        if on_stream is not None:
+            on_stream(provider, stream)
+        try:
+            first = next(stream, None)
+        except BaseException:
+            close_quietly(stream)
+            raise
+        provider.record_success(time.monotonic() - started_at)
+        return stream, first
+
+    def _failover(self, candidates, model, kwargs):
+        last_error = None
+        for provider in candidates:
+            try:
+                stream, first = self._open(provider, model, kwargs)
+                return provider, stream, first
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                provider.record_failure(e)
+                last_error = e
+        raise last_error
+
+    def _race(self, candidates, model, kwargs):
+        """依次启动尝试：当前尝试超过对冲阈值未出首包或失败时启动下一个，先出首包者胜出"""
+        results = queue.Queue()
+        streams = {}
+        lock = threading.Lock()
+        decided = threading.Event()
+
+        def on_stream(provider, stream):
+            with lock:
+                streams[provider.name] = stream
+            if decided.is_set():
+                close_quietly(stream)
+
+        def attempt(provider):
+            try:
+                stream, first = self._open(provider, model, kwargs, on_stream)
+            except Exception as e:
+                if decided.is_set():
+                    # 落败方被取消引起的错误，不计入健康分数
+                    return
+                if is_retryable(e):
+                    provider.record_failure(e)
+                results.put((provider, None, None, e))
+                return
+            if decided.is_set():
+                close_quietly(stream)
+                return
+            results.put((provider, stream, first, None))
+
+        def launch(provider):
+            threading.Thread(target=attempt, args=(provider,), daemon=True,
+                             name=f"llm-{provider.name}").start()
+
+        remaining = list(candidates)
+        launch(remaining.pop(0))
+        running, hedged = 1, False
+        delay = candidates[0].hedge_delay()
+        last_error = None
+        while running:
+            try:
+                provider, stream, first, error = results.get(timeout=delay if remaining else None)
+            except queue.Empty:
+                logger.info("首个数据块超过 %.2fs 未到达，向 %s 发出对冲请求", delay, remaining[0].name)
+                launch(remaining.pop(0))
+                running, hedged = running + 1, True
+                continue
+            running -= 1
+            if error is None:
+                decided.set()
+                with lock:
+                    losers = [s for name, s in streams.items() if name != provider.name]
+                for loser in losers:
+                    close_quietly(loser)
+                if hedged:
+                    LLM_HEDGES.inc(winner="primary" if provider is candidates[0] else "hedge")
+                return provider, stream, first
+            if not is_retryable(error):
+                decided.set()
+                raise error
+            last_error = error
+            if remaining:
+                launch(remaining.pop(0))
+                running += 1
+        raise last_error
+
+    def _relay(self, provider, stream, first):
+        try:
+            if first is not None:
+                yield first
+            for chunk in stream:
+                yield chunk
+        except Exception as e:
+            if is_retryable(e):
+                provider.record_failure(e)
+            raise
+        finally:
+            close_quietly(stream)
+
+    # ---- 异步接口 ----
+
+    async def acreate(self, model, **kwargs):
+        """create 的异步版本"""
+        last_error = None
+        for provider in self.candidates(model):
+            try:
+                response = await provider.async_client.chat.completions.create(
+                    model=provider.model_name(model), **kwargs
+                )
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                provider.record_failure(e)
+                last_error = e
+                continue
+            provider.record_success()
+            return response
+        raise last_error
+
+    async def astream(self, model, **kwargs):
+        """stream 的异步版本，返回异步数据块迭代器"""
+        candidates = self.candidates(model)
+        remaining = list(candidates)
+        hedge = self.hedge and len(candidates) > 1
+        tasks = {}
+        last_error = None
+        hedged = False
+        try:
+            while True:
+                if not tasks:
+                    if not remaining:
+                        raise last_error
+                    provider = remaining.pop(0)
+                    tasks[asyncio.ensure_future(self._aopen(provider, model, kwargs))] = provider
+                timeout = candidates[0].hedge_delay() if hedge and remaining else None
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info("首个数据块超过 %.2fs 未到达，向 %s 发出对冲请求", timeout, remaining[0].name)
+                    provider = remaining.pop(0)
+                    tasks[asyncio.ensure_future(self._aopen(provider, model, kwargs))] = provider
+                    hedged = True
+                    continue
+                task = done.pop()
+                provider = tasks.pop(task)
+                error = task.exception()
+                if error is None:
+                    break
+                if not is_retryable(error):
+                    raise error
+                provider.record_failure(error)
+                last_error = error
+                if hedge and remaining:
+                    # 对冲模式下失败立即启动下一个尝试，不等其他尝试结束
+                    provider = remaining.pop(0)
+                    tasks[asyncio.ensure_future(self._aopen(provider, model, kwargs))] = provider
+        finally:
+            # 未完成的尝试取消，_aopen 会关闭已建立的连接；与胜者在同一轮完成的落败者已经
+            # 建立了流，cancel 对它无效，需要在这里关闭
+            for loser in tasks:
+                if not loser.done():
+                    loser.cancel()
+                elif not loser.cancelled() and loser.exception() is None:
+                    await aclose_quietly(loser.result()[0])
+        if hedged:
+            LLM_HEDGES.inc(winner="primary" if provider is candidates[0] else "hedge")
+        stream, first = task.result()
+        try:
+            if first is not None:
+                yield first
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            if is_retryable(e):
+                provider.record_failure(e)
+            raise
+        finally:
+            await aclose_quietly(stream)
+
+    async def _aopen(self, provider, model, kwargs):
+        started_at = time.monotonic()
+        stream = await provider.async_client.chat.completions.create(
+            model=provider.model_name(model), stream=True, **kwargs
+        )
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await aclose_quietly(stream)
+            raise
+        provider.record_success(time.monotonic() - started_at)
+        return stream, first
+
+    async def aclose(self):
+        for provider in self.providers:
+            await provider.async_client.close()
+
+    def stats(self):
+        return {"hedge": self.hedge, "providers": {p.name: p.stats() for p in self.providers}}
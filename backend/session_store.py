@@ -0,0 +1,193 @@
+"""会话存储
+
+替代进程内不断增长的 sessions 字典：
+- MemorySessionStore：只在内存中保存，条目数有上限，按LRU和空闲超时淘汰
+- SqliteSessionStore：以本地SQLite为准，内存中只保留最近活跃会话的热层；
+  追加消息是一条INSERT，多个工作进程可以共享同一个数据库文件并服务同一个会话
+
+通过 SESSION_STORE 环境变量选择实现（sqlite / memory），默认 sqlite。
+"""
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+import uuid
+
+SESSION_STORE = os.environ.get("SESSION_STORE", "sqlite")
+SESSION_DB_PATH = os.environ.get(
+    "SESSION_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sessions.db")
+)
+SESSION_HOT_MAX = int(os.environ.get("SESSION_HOT_MAX", "1000"))
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", "1800"))
+
+
+class MemorySessionStore:
+    """有界的内存会话存储，超出容量或空闲超时的会话被淘汰"""
+
+    def __init__(self, max_sessions=SESSION_HOT_MAX, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        # session_id -> [last_access, messages]
+        self._hot = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _touch(self, session_id, messages):
+        """放入或刷新热层条目，并淘汰超出容量或空闲过久的会话，调用方需持有锁"""
+        now = time.monotonic()
+        self._hot[session_id] = [now, messages]
+        self._hot.move_to_end(session_id)
+        while self._hot:
+            oldest_id, (last_access, _) = next(iter(self._hot.items()))
+            if len(self._hot) <= self.max_sessions and now - last_access < self.idle_timeout:
+                break
+            del self._hot[oldest_id]
+
+    def _hot_messages(self, session_id):
+        """取热层中的消息列表，调用方需持有锁"""
+        entry = self._hot.get(session_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.idle_timeout:
+            del self._hot[session_id]
+            return None
+        return entry[1]
+
+    def create(self):
+        session_id = str(uuid.uuid4())
+        with self._lock:
+            self._touch(session_id, [])
+        return session_id
+
+    def exists(self, session_id):
+        with self._lock:
+            return self._hot_messages(session_id) is not None
+
+    def append(self, session_id, role, content):
+        with self._lock:
+            messages = self._hot_messages(session_id)
+            if messages is None:
+                raise KeyError(session_id)
+            messages.append({"role": role, "content": content})
+            self._touch(session_id, messages)
+
+    def get_messages(self, session_id):
+        with self._lock:
+            messages = self._hot_messages(session_id)
+            if messages is None:
+                raise KeyError(session_id)
+            self._touch(session_id, messages)
+            return list(messages)
+
+    def hot_count(self):
+        with self._lock:
+            return len(self._hot)
+
+
+class SqliteSessionStore(MemorySessionStore):
+    """SQLite持久化的会话存储，内存热层只缓存最近活跃的会话
+
+    热层中的消息只是数据库的前缀缓存：读取时按序号补齐其他进程追加的消息，
+    因此多个进程共享同一个会话时看到的历史一致。
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, max_sessions=SESSION_HOT_MAX, idle_timeout=SESSION_IDLE_TIMEOUT):
+        super().__init__(max_sessions, idle_timeout)
+        self.path = path
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connection() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT,
+                    PRIMARY KEY (session_id, seq)
+                );
+            """)
+
+    def _connection(self):
+        """每个线程一个连接，开启WAL以支持多进程并发读写"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self):
+        session_id = str(uuid.uuid4())
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO sessions (id, created_at, updated_at) VALUES (?, ?, ?)",
+                (session_id, now, now)
+            )
+        with self._lock:
+            self._touch(session_id, [])
+        return session_id
+
+    def exists(self, session_id):
+        with self._lock:
+            if self._hot_messages(session_id) is not None:
+                return True
+        row = self._connection().execute(
+            "SELECT 1 FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        return row is not None
+
+    def append(self, session_id, role, content):
+        """追加一条消息，只写入新行，不重写整个会话"""
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            updated = conn.execute(
+                "UPDATE sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id)
+            ).rowcount
+            if not updated:
+                raise KeyError(session_id)
+            conn.execute(
+                "INSERT INTO messages (session_id, seq, role, content) "
+                "SELECT ?, COALESCE(MAX(seq), -1) + 1, ?, ? FROM messages WHERE session_id = ?",
+                (session_id, role, content, session_id)
+            )
+        # 热层中的消息在下一次读取时从数据库补齐，这里只刷新访问时间
+        with self._lock:
+            messages = self._hot_messages(session_id)
+            if messages is not None:
+                self._touch(session_id, messages)
+
+    def get_messages(self, session_id):
+        with self._lock:
+            messages = self._hot_messages(session_id)
+            cached = list(messages) if messages is not None else []
+        rows = self._connection().execute(
+            "SELECT role, content FROM messages WHERE session_id = ? AND seq >= ? ORDER BY seq",
+            (session_id, len(cached))
+        ).fetchall()
+        if messages is None and not rows and not self.exists(session_id):
+            raise KeyError(session_id)
+        cached.extend({"role": role, "content": content} for role, content in rows)
+        with self._lock:
+            # 并发读取时不要用较旧的结果覆盖其他线程刚补齐的热层
+            current = self._hot_messages(session_id)
+            if current is None or len(cached) >= len(current):
+                self._touch(session_id, cached)
+            else:
+                self._touch(session_id, current)
+        return list(cached)
+
+
+def create_session_store():
+    """根据 SESSION_STORE 配置创建会话存储"""
+    if SESSION_STORE == "memory":
+        return MemorySessionStore()
+    return SqliteSessionStore()
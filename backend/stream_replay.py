@@ -0,0 +1,223 @@
+"""可续传的SSE流
+
+每次生成在后台独立运行，产出的帧带上 ``id: <生成id>:<序号>`` 后写入按会话保存的有界回放缓冲区，
+客户端连接只是缓冲区的订阅者。连接断开不会中断生成；EventSource 重连时会带上
+Last-Event-ID 请求头，服务端只补发它错过的帧并继续推送，不再重新调用模型和工具。
+
+每个会话同一时间只有一次生成：重复标签页、双击和重试发来的请求加入正在进行的生成，
+作为订阅者从头接收同一串帧，不会再发起一次生成。
+
+配置（环境变量）：
+- STREAM_REPLAY_MAX_FRAMES: 每次生成最多保留的帧数，默认 4096
+- STREAM_REPLAY_LINGER_SECONDS: 生成结束后缓冲区保留的秒数，默认 300
+- STREAM_REPLAY_MAX_SESSIONS: 最多保留缓冲区的会话数，默认 1000
+- STREAM_KEEPALIVE_SECONDS: 没有新帧时发送SSE注释保活的间隔，默认 15
+"""
+import os
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+STREAM_REPLAY_MAX_FRAMES = int(os.environ.get("STREAM_REPLAY_MAX_FRAMES", "4096"))
+STREAM_REPLAY_LINGER_SECONDS = float(os.environ.get("STREAM_REPLAY_LINGER_SECONDS", "300"))
+STREAM_REPLAY_MAX_SESSIONS = int(os.environ.get("STREAM_REPLAY_MAX_SESSIONS", "1000"))
+STREAM_KEEPALIVE_SECONDS = float(os.environ.get("STREAM_KEEPALIVE_SECONDS", "15"))
+
+KEEPALIVE_FRAME = ": keepalive\n\n"
+
+
+class GenerationInProgress(Exception):
+    """会话中另一条消息仍在生成"""
+
+
+class GenerationCapacityExceeded(Exception):
+    """同时进行的生成已达上限，不能再开始新的生成"""
+
+
+def parse_last_event_id(value):
+    """解析 Last-Event-ID，返回 (生成id, 序号)，格式不对时返回 None"""
+    if not value:
+        return None
+    generation_id, _, seq = value.strip().rpartition(":")
+    if not generation_id or not seq.isdigit():
+        return None
+    return generation_id, int(seq)
+
+
+class StreamGeneration:
+    """一次生成的帧缓冲区，可被多个连接从任意位置订阅"""
+
+    def __init__(self, session_id, user_message=None, max_frames=STREAM_REPLAY_MAX_FRAMES):
+        self.session_id = session_id
+        self.user_message = user_message
+        self.generation_id = uuid.uuid4().hex[:12]
+        self.finished = False
+        self.finished_at = None
+        self._frames = deque(maxlen=max_frames)
+        self._next_seq = 1
+        self._cond = threading.Condition()
+        self._event = None
+
+    def append(self, frame):
+        """写入一帧并唤醒订阅者"""
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._frames.append((seq, f"id: {self.generation_id}:{seq}\n{frame}"))
+            self._cond.notify_all()
+        self._wake_async()
+
+    def finish(self):
+        with self._cond:
+            self.finished = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+        self._wake_async()
+
+    def frames_after(self, seq):
+        """返回序号大于 seq 的帧，以及中间是否有帧已被缓冲区淘汰"""
+        with self._cond:
+            frames = [(s, frame) for s, frame in self._frames if s > seq]
+            lost = bool(self._frames) and self._frames[0][0] > seq + 1
+            return frames, lost, self.finished
+
+    def iter_frames(self, after=0, lost_frame=None):
+        """同步订阅：先补发 after 之后的帧，再阻塞等待新帧，生成结束后退出"""
+        seq = after
+        while True:
+            frames, lost, finished = self.frames_after(seq)
+            if lost and lost_frame:
+                yield lost_frame
+                lost_frame = None
+            for seq, frame in frames:
+                yield frame
+            if finished and not frames:
+                return
+            if not frames:
+                with self._cond:
+                    if self._next_seq - 1 == seq and not self.finished:
+                        if not self._cond.wait(STREAM_KEEPALIVE_SECONDS):
+                            yield KEEPALIVE_FRAME
+
+    async def aiter_frames(self, after=0, lost_frame=None):
+        """异步订阅，语义同 iter_frames；生产者须运行在同一个事件循环中"""
+        seq = after
+        while True:
+            frames, lost, finished = self.frames_after(seq)
+            if lost and lost_frame:
+                yield lost_frame
+                lost_frame = None
+            for seq, frame in frames:
+                yield frame
+            if finished and not frames:
+                return
+            if not frames:
+                if self._event is None:
+                    self._event = asyncio.Event()
+                try:
+                    await asyncio.wait_for(self._event.wait(), STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE_FRAME
+
+    def _wake_async(self):
+        # 每次唤醒换一个新的 Event，多个订阅者互不影响
+        event, self._event = self._event, None
+        if event is not None:
+            event.set()
+
+
+class StreamReplayRegistry:
+    """按会话保存最近一次生成，结束超过 linger 秒或超出会话数上限时淘汰；进行中的生成不会被淘汰"""
+
+    def __init__(self, max_sessions=STREAM_REPLAY_MAX_SESSIONS, linger_seconds=STREAM_REPLAY_LINGER_SECONDS):
+        self.max_sessions = max_sessions
+        self.linger_seconds = linger_seconds
+        self._generations = OrderedDict()
+        self._submitting = set()
+        self._lock = threading.Lock()
+
+    def claim(self, session_id, user_message=None, admit=None):
+        """取得会话的生成，返回 (generation, created)
+
+        会话已有进行中的生成时加入它（created 为 False）；新请求带来的消息与进行中的不同时
+        抛出 GenerationInProgress。否则创建新的生成并替换之前的缓冲区，调用方负责启动它。
+        admit 在需要创建新生成时调用，返回 False 时抛出 GenerationCapacityExceeded，不登记生成。
+        """
+        with self._lock:
+            self._evict_expired()
+            if session_id in self._submitting:
+                raise GenerationInProgress(session_id)
+            current = self._generations.get(session_id)
+            if current is not None and not current.finished:
+                if user_message is not None and user_message != current.user_message:
+                    raise GenerationInProgress(session_id)
+                return current, False
+            if admit is not None and not admit():
+                raise GenerationCapacityExceeded(session_id)
+            generation = StreamGeneration(session_id, user_message)
+            self._generations[session_id] = generation
+            self._generations.move_to_end(session_id)
+            self._evict_overflow()
+        return generation, True
+
+    @contextmanager
+    def submitting(self, session_id):
+        """/api/chat 写入用户消息期间占住会话
+
+        检查和写入在同一个占用区间内完成：会话有进行中的生成或另一次提交时抛出 GenerationInProgress，
+        并发的两次提交不会都通过检查。
+        """
+        with self._lock:
+            current = self._generations.get(session_id)
+            if session_id in self._submitting or (current is not None and not current.finished):
+                raise GenerationInProgress(session_id)
+            self._submitting.add(session_id)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._submitting.discard(session_id)
+
+    def latest(self, session_id):
+        """会话最近一次（进行中或刚结束的）生成"""
+        with self._lock:
+            return self._generations.get(session_id)
+
+    def is_running(self, session_id):
+        generation = self.latest(session_id)
+        return generation is not None and not generation.finished
+
+    def resume(self, session_id, last_event_id):
+        """按 Last-Event-ID 找到对应的生成，返回 (generation, 已收到的序号)，找不到时返回 None"""
+        parsed = parse_last_event_id(last_event_id)
+        if parsed is None:
+            return None
+        generation_id, seq = parsed
+        generation = self.latest(session_id)
+        if generation is None or generation.generation_id != generation_id:
+            return None
+        return generation, seq
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [
+            session_id for session_id, generation in self._generations.items()
+            if generation.finished and now - generation.finished_at > self.linger_seconds
+        ]
+        for session_id in expired:
+            del self._generations[session_id]
+
+    def _evict_overflow(self):
+        """超出会话数上限时从最久未用的开始淘汰已结束的生成；进行中的生成保留，
+        否则同一会话的续传或新请求会再启动一次重复的生成"""
+        overflow = len(self._generations) - self.max_sessions
+        if overflow <= 0:
+            return
+        finished = [
+            session_id for session_id, generation in self._generations.items() if generation.finished
+        ][:overflow]
+        for session_id in finished:
+            del self._generations[session_id]
@@ -0,0 +1,5 @@
+"""后端模块以 backend/ 为工作目录平铺导入，测试时同样把 backend/ 加入 sys.path"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,147 @@
+from types import SimpleNamespace
+
+import completion_cache as cc
+from completion_cache import CompletionCache, cached_tool_calls, cacheable_tool_calls, cacheable_message_tool_calls
+from tool_call_assembler import ToolCallAssembler
+
+MODEL = "qwen-turbo"
+STAGE = "first_pass"
+
+
+def make_cache(tmp_path, **kwargs):
+    return CompletionCache(path=str(tmp_path / "completions.db"), enabled=True, **kwargs)
+
+
+def conversation(question, system="今天是2025-01-01"):
+    return [{"role": "system", "content": system}, {"role": "user", "content": question}]
+
+
+def tool_turn(name, result):
+    return [
+        {"role": "assistant", "content": None, "tool_calls": [
+            {"id": "call_a", "type": "function", "function": {"name": name, "arguments": "{}"}},
+        ]},
+        {"role": "tool", "tool_call_id": "call_a", "content": result},
+    ]
+
+
+def store_and_lookup(cache, messages, value):
+    key, cached = cache.lookup(MODEL, STAGE, messages)
+    assert cached is None
+    cache.store(key, STAGE, messages, value)
+    return cache.lookup(MODEL, STAGE, messages)[1]
+
+
+def test_lookup_returns_stored_answer_and_tool_decisions(tmp_path):
+    cache = make_cache(tmp_path)
+    messages = conversation("违章代码1301是什么")
+    value = {"content": "", "tool_calls": [{"name": "query_violation_code", "arguments": {"code": "1301"}}]}
+    assert store_and_lookup(cache, messages, value) == value
+    replayed, = cached_tool_calls(value)
+    assert replayed["function"]["name"] == "query_violation_code"
+    assert replayed["parsed_arguments"] == {"code": "1301"}
+
+
+def test_system_prompt_date_does_not_change_the_key(tmp_path):
+    cache = make_cache(tmp_path)
+    value = {"content": "你好", "tool_calls": []}
+    store_and_lookup(cache, conversation("你好", "今天是2025-01-01"), value)
+    assert cache.lookup(MODEL, STAGE, conversation("你好", "今天是2025-01-02"))[1] == value
+
+
+def test_disabled_cache_never_stores(tmp_path):
+    cache = CompletionCache(path=str(tmp_path / "completions.db"), enabled=False)
+    key, cached = cache.lookup(MODEL, STAGE, conversation("你好"))
+    assert (key, cached) == (None, None)
+    cache.store(key, STAGE, conversation("你好"), {"content": "你好", "tool_calls": []})
+    assert cache.stats() == {"enabled": False}
+
+
+def test_volatile_tool_results_are_skipped(tmp_path):
+    cache = make_cache(tmp_path)
+    messages = conversation("北京天气") + tool_turn("get_weather", '{"city":"北京"}')
+    key, cached = cache.lookup(MODEL, "tool_followup", messages)
+    assert (key, cached) == (None, None)
+    cache.store(key, "tool_followup", messages, {"content": "晴", "tool_calls": []})
+    assert cache.stats()["entries"] == 0
+
+
+def test_failed_tool_results_are_skipped(tmp_path):
+    cache = make_cache(tmp_path)
+    messages = conversation("违章代码9999") + tool_turn("query_violation_code", '{"error":"未找到"}')
+    assert cache.lookup(MODEL, "tool_followup", messages) == (None, None)
+
+
+def test_stable_tool_results_are_cached(tmp_path):
+    cache = make_cache(tmp_path)
+    messages = conversation("违章代码1301") + tool_turn("query_violation_code", '{"code":"1301"}')
+    value = {"content": "逆行", "tool_calls": []}
+    assert store_and_lookup(cache, messages, value) == value
+
+
+def test_answers_deriving_dates_are_not_stored(tmp_path):
+    cache = make_cache(tmp_path)
+    messages = conversation("我明天的排班")
+    value = {"content": "", "tool_calls": [{"name": "get_shift_info", "arguments": {"date": "2025-01-02"}}]}
+    assert store_and_lookup(cache, messages, value) is None
+    assert cache.stats()["entries"] == 0
+
+    messages = conversation("我2025-01-02的排班")
+    assert store_and_lookup(cache, messages, value) == value
+
+
+def test_malformed_tool_arguments_are_not_cacheable():
+    assembler = ToolCallAssembler()
+    delta = SimpleNamespace(index=0, id="call_a",
+                            function=SimpleNamespace(name="get_weather", arguments='{"city": 北京'))
+    assembler.feed([delta])
+    assembler.finish()
+    assert cacheable_tool_calls(assembler.calls()) is None
+
+
+def test_malformed_non_streaming_tool_arguments_are_not_cacheable():
+    def call(arguments):
+        return SimpleNamespace(function=SimpleNamespace(name="get_weather", arguments=arguments))
+
+    assert cacheable_message_tool_calls([call('{"city": "北京"}'), call("")]) == [
+        {"name": "get_weather", "arguments": {"city": "北京"}},
+        {"name": "get_weather", "arguments": {}},
+    ]
+    assert cacheable_message_tool_calls([call('{"city": 北京')]) is None
+
+
+def test_size_is_tracked_across_replacements(tmp_path):
+    cache = make_cache(tmp_path)
+    store_and_lookup(cache, conversation("a"), {"content": "x" * 100, "tool_calls": []})
+    key, _ = cache.lookup(MODEL, STAGE, conversation("a"))
+    cache.store(key, STAGE, conversation("a"), {"content": "x" * 10, "tool_calls": []})
+    store_and_lookup(cache, conversation("b"), {"content": "y" * 50, "tool_calls": []})
+    assert cache.stats()["entries"] == 2
+    assert cache._bytes == cache.stats()["bytes"]
+
+
+def test_store_over_limit_evicts_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=400)
+    for question in "abcd":
+        store_and_lookup(cache, conversation(question), {"content": question * 100, "tool_calls": []})
+    stats = cache.stats()
+    assert stats["bytes"] <= cache.max_bytes * cc.EVICT_TARGET_RATIO
+    assert cache._bytes == stats["bytes"]
+    assert cache.lookup(MODEL, STAGE, conversation("a"))[1] is None
+    assert cache.lookup(MODEL, STAGE, conversation("d"))[1]["content"] == "d" * 100
+
+
+def test_expired_entries_are_purged_periodically(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, ttl=100)
+    clock = [1000.0]
+    monkeypatch.setattr(cc.time, "time", lambda: clock[0])
+    cache._next_purge = 0.0
+    store_and_lookup(cache, conversation("old"), {"content": "x", "tool_calls": []})
+    clock[0] += cc.PURGE_INTERVAL / 2
+    store_and_lookup(cache, conversation("mid"), {"content": "y", "tool_calls": []})
+    assert cache.stats()["entries"] == 2
+    clock[0] = 1000.0 + 101
+    store_and_lookup(cache, conversation("new"), {"content": "z", "tool_calls": []})
+    assert cache.stats()["entries"] == 2
+    assert cache._bytes == cache.stats()["bytes"]
+    assert cache.lookup(MODEL, STAGE, conversation("old"))[1] is None
@@ -0,0 +1,34 @@
+import context_window
+from context_window import count_message_tokens, count_text_tokens
+
+
+class StrictEncoding:
+    """与 tiktoken 默认行为一致：encode() 遇到特殊token文本时报错"""
+
+    def encode(self, text):
+        if "<|endoftext|>" in text:
+            raise ValueError("disallowed special token")
+        return text.split()
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+
+def test_special_token_text_does_not_raise_with_tiktoken(monkeypatch):
+    monkeypatch.setattr(context_window, "_encoding", StrictEncoding())
+    monkeypatch.setattr(context_window, "_encoding_loaded", True)
+    assert count_text_tokens("hot <|endoftext|> search") == 3
+
+
+def test_special_token_text_is_counted_as_plain_text():
+    text = "热搜：<|endoftext|> 与 <|im_start|>"
+    assert count_text_tokens(text) > 0
+    assert count_message_tokens({"role": "user", "content": text}) > count_text_tokens(text)
+
+
+def test_falls_back_to_estimate_without_an_encoding(monkeypatch):
+    monkeypatch.setattr(context_window, "_encoding", None)
+    monkeypatch.setattr(context_window, "_encoding_loaded", True)
+    assert count_text_tokens("北京天气") == 4
+    assert count_text_tokens("abcdefgh") == 2
+    assert count_text_tokens("<|endoftext|>") == 4
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from http_client import AsyncToolHttpClient, TOOL_HTTP_READ_TIMEOUT
+from tool_guard import TOOL_DEADLINE_SECONDS
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_async_client_counts_opened_connections(server_url):
+    async def main():
+        client = AsyncToolHttpClient()
+        try:
+            for _ in range(3):
+                await client.get(f"{server_url}/a")
+            sequential = dict(client.stats()[server_url])
+            await asyncio.gather(*(client.get(f"{server_url}/b") for _ in range(3)))
+            return sequential, client.stats()[server_url]
+        finally:
+            await client.aclose()
+
+    sequential, concurrent = asyncio.run(main())
+    # 顺序请求复用同一个连接，并发请求才需要新建
+    assert sequential["connections_opened"] == 1
+    assert concurrent["requests"] == 6
+    assert 1 < concurrent["connections_opened"] <= 3
+
+
+def test_read_timeout_is_below_the_tool_deadline():
+    assert TOOL_HTTP_READ_TIMEOUT < TOOL_DEADLINE_SECONDS
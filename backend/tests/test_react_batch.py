@@ -0,0 +1,23 @@
+import os
+import sys
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from react_llm import iter_batch_items  # noqa: E402
+
+
+def test_malformed_lines_are_skipped_and_logged(tmp_path, caplog):
+    path = tmp_path / "queries.jsonl"
+    path.write_text("\n".join([
+        '{"id": "a", "query": "北京天气"}',
+        '{"id": "b", "query": ',
+        '["not", "an", "object"]',
+        '{"id": "c"}',
+        '',
+        '{"question": "抖音热搜"}',
+    ]), encoding="utf-8")
+    with caplog.at_level(logging.WARNING, logger="react_llm"):
+        items = list(iter_batch_items(str(path)))
+    assert items == [{"id": "a", "query": "北京天气"}, {"id": "line-6", "query": "抖音热搜"}]
+    assert [record.getMessage()[:3] for record in caplog.records] == ["第2行", "第3行", "第4行"]
@@ -0,0 +1,136 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from tool_cache import ToolResultCache
+
+
+def make_cache():
+    return ToolResultCache(ttls={"get_weather": 60})
+
+
+def wait_for_coalesced(cache, count):
+    deadline = time.monotonic() + 5
+    while cache.stats()["tools"]["get_weather"]["coalesced"] < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_concurrent_misses_share_one_call():
+    cache = make_cache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"city": "北京"}
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        leader = pool.submit(cache.get_or_compute, "get_weather", {"city": "北京"}, compute)
+        started.wait(5)
+        followers = [pool.submit(cache.get_or_compute, "get_weather", {"city": " 北京 "}, compute)
+                     for _ in range(3)]
+        wait_for_coalesced(cache, 3)
+        release.set()
+        results = [leader.result(5)] + [future.result(5) for future in followers]
+    assert calls == [1]
+    assert results == [{"city": "北京"}] * 4
+    assert cache.get_or_compute("get_weather", {"city": "北京"}, compute) == {"city": "北京"}
+    assert cache.stats()["tools"]["get_weather"] == {"hits": 1, "misses": 1, "coalesced": 3}
+
+
+def test_leader_failure_reaches_followers_and_is_not_cached():
+    cache = make_cache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise ConnectionError("down")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(cache.get_or_compute, "get_weather", {"city": "北京"}, failing)
+        started.wait(5)
+        follower = pool.submit(cache.get_or_compute, "get_weather", {"city": "北京"}, failing)
+        wait_for_coalesced(cache, 1)
+        release.set()
+        with pytest.raises(ConnectionError):
+            leader.result(5)
+        with pytest.raises(ConnectionError):
+            follower.result(5)
+    assert cache.get_or_compute("get_weather", {"city": "北京"}, lambda: {"city": "北京"}) == {"city": "北京"}
+
+
+def test_error_results_are_not_cached():
+    cache = make_cache()
+    cache.get_or_compute("get_weather", {"city": "x"}, lambda: {"error": "未找到城市"})
+    assert cache.get_or_compute("get_weather", {"city": "x"}, lambda: {"city": "x"}) == {"city": "x"}
+
+
+def test_async_leader_failure_reaches_followers():
+    cache = make_cache()
+
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ConnectionError("down")
+
+    async def main():
+        return await asyncio.gather(
+            *(cache.get_or_compute_async("get_weather", {"city": "北京"}, failing) for _ in range(3)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert cache.stats()["tools"]["get_weather"] == {"hits": 0, "misses": 1, "coalesced": 2}
+
+
+def test_async_cancelled_leader_hands_over_to_a_follower():
+    cache = make_cache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"city": "北京"}
+
+    async def main():
+        leader = asyncio.create_task(cache.get_or_compute_async("get_weather", {"city": "北京"}, compute))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(cache.get_or_compute_async("get_weather", {"city": "北京"}, compute))
+                     for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        assert leader.cancelled()
+        return results
+
+    assert asyncio.run(main()) == [{"city": "北京"}] * 2
+    assert len(calls) == 2
+
+
+def test_async_cancelled_follower_does_not_affect_the_leader():
+    cache = make_cache()
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return {"city": "北京"}
+
+    async def main():
+        leader = asyncio.create_task(cache.get_or_compute_async("get_weather", {"city": "北京"}, compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(cache.get_or_compute_async("get_weather", {"city": "北京"}, compute))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+
+    assert asyncio.run(main()) == {"city": "北京"}
@@ -0,0 +1,79 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from tool_call_assembler import ArgumentScanner, ToolCallAssembler
+
+
+def delta(index=None, id=None, name=None, arguments=None):
+    return SimpleNamespace(index=index, id=id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+def test_call_completes_as_soon_as_arguments_close():
+    assembler = ToolCallAssembler()
+    assert assembler.feed([delta(0, "call_a", "get_weather", '{"city":')]) == []
+    completed = assembler.feed([delta(0, None, None, ' "北京"}')])
+    assert [call["id"] for call in completed] == ["call_a"]
+    assert completed[0]["parsed_arguments"] == {"city": "北京"}
+    assert assembler.finish() == []
+
+
+def test_braces_inside_strings_do_not_close_the_call():
+    assembler = ToolCallAssembler()
+    assert assembler.feed([delta(0, "call_a", "apply_leave", '{"reason": "}{"')]) == []
+    completed = assembler.feed([delta(0, None, None, "}")])
+    assert completed[0]["parsed_arguments"] == {"reason": "}{"}
+
+
+def test_reused_index_with_new_id_starts_a_new_call():
+    assembler = ToolCallAssembler()
+    assembler.feed([delta(0, "call_a", "get_weather", '{"city": "北京"')])
+    completed = assembler.feed([delta(0, "call_b", "get_weather", '{"city": "上海"}')])
+    assert [call["id"] for call in completed] == ["call_b"]
+    assert [call["id"] for call in assembler.finish()] == ["call_a"]
+    assert [(call["id"], call["parsed_arguments"]["city"]) for call in assembler.calls()] == \
+        [("call_a", "北京"), ("call_b", "上海")]
+
+
+def test_reused_index_without_id_continues_the_same_call():
+    assembler = ToolCallAssembler()
+    assembler.feed([delta(0, "call_a", "get_weather", '{"city"')])
+    completed = assembler.feed([delta(0, None, None, ': "北京"}')])
+    assert [call["id"] for call in completed] == ["call_a"]
+
+
+def test_empty_arguments_become_empty_object():
+    assembler = ToolCallAssembler()
+    assembler.feed([delta(0, "call_a", "get_douyin_hot", None)])
+    assert assembler.finish()[0]["parsed_arguments"] == {}
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('{"city": "北京', {"city": "北京"}),
+    ('{"a": [1, 2', {"a": [1, 2]}),
+    ('{"a": {"b": [1, {"c": "x', {"a": {"b": [1, {"c": "x"}]}}),
+    ('{"a": 1,', {"a": 1}),
+    ('"city": "北京"', {"city": "北京"}),
+])
+def test_truncated_arguments_are_repaired_at_stream_end(raw, expected):
+    assembler = ToolCallAssembler()
+    assert assembler.feed([delta(0, "call_a", "get_weather", raw)]) == []
+    call, = assembler.finish()
+    assert call["parsed_arguments"] == expected
+    assert json.loads(call["function"]["arguments"]) == expected
+
+
+def test_unrepairable_arguments_are_reported_as_errors():
+    assembler = ToolCallAssembler()
+    assembler.feed([delta(0, "call_a", "get_weather", '{"city": 北京')])
+    call, = assembler.finish()
+    assert "error" in call
+    assert call["function"]["arguments"] == '{"city": 北京'
+
+
+def test_scanner_closes_brackets_in_reverse_order():
+    scanner = ArgumentScanner()
+    scanner.feed('{"a": [{"b": [')
+    assert scanner.stack == ["{", "[", "{", "["]
+    assert scanner.repair('{"a": [{"b": [') == '{"a": [{"b": []}]}'
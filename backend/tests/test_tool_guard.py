@@ -0,0 +1,146 @@
+import asyncio
+import threading
+
+import pytest
+
+import tool_guard as guard_module
+from tool_guard import CircuitBreaker, ToolGuard
+from upstream_scheduler import current_session, session_scope
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_after_consecutive_failures(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(guard_module.time, "monotonic", clock)
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30)
+    assert breaker.record_failure() is False
+    breaker.record_success()
+    assert breaker.record_failure() is False
+    assert breaker.record_failure() is False
+    assert breaker.record_failure() is True
+    assert breaker.state == "open"
+    assert breaker.allow() is False
+    assert breaker.retry_after() == 30
+
+
+def test_breaker_half_open_lets_one_probe_through(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(guard_module.time, "monotonic", clock)
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow() is True
+    assert breaker.state == "half_open"
+    assert breaker.allow() is False
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() is True
+
+
+def test_failed_probe_reopens_the_breaker(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(guard_module.time, "monotonic", clock)
+    breaker = CircuitBreaker(failure_threshold=5, reset_seconds=30)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow() is True
+    assert breaker.record_failure() is True
+    assert breaker.state == "open"
+    clock.now += 29
+    assert breaker.allow() is False
+
+
+def test_guard_returns_circuit_open_after_failures():
+    guard = ToolGuard(deadline=1, bulkhead=2, deadlines={}, bulkheads={})
+    guard._state("flaky").breaker.failure_threshold = 2
+
+    def flaky():
+        raise ConnectionError("down")
+
+    assert guard.call("flaky", flaky, {})["error_type"] == "failed"
+    assert guard.call("flaky", flaky, {})["error_type"] == "failed"
+    error = guard.call("flaky", flaky, {})
+    assert error["error_type"] == "circuit_open"
+    assert error["retryable"] is True
+
+
+def test_guard_times_out_slow_tools_and_keeps_the_slot():
+    guard = ToolGuard(deadline=0.05, bulkhead=1, deadlines={}, bulkheads={})
+    release = threading.Event()
+    assert guard.call("slow", lambda: release.wait(5), {})["error_type"] == "timeout"
+    assert guard.call("slow", lambda: "ok", {})["error_type"] == "overloaded"
+    release.set()
+
+
+def test_guard_rejects_invalid_arguments_without_counting_failures():
+    guard = ToolGuard(deadline=1, bulkhead=1, deadlines={}, bulkheads={})
+    error = guard.call("weather", lambda city: city, {"town": "北京"})
+    assert error["error_type"] == "invalid_arguments"
+    assert guard.stats() == {}
+
+
+def test_guard_runs_tools_in_the_callers_session():
+    guard = ToolGuard(deadline=1, bulkhead=1, deadlines={}, bulkheads={})
+    with session_scope("session-1"):
+        assert guard.call("whoami", lambda: current_session.get(), {}) == "session-1"
+
+
+def test_async_guard_cancels_on_deadline():
+    guard = ToolGuard(deadline=0.05, bulkhead=1, deadlines={}, bulkheads={})
+
+    async def slow():
+        await asyncio.sleep(5)
+
+    error = asyncio.run(guard.call_async("slow", slow, {}))
+    assert error["error_type"] == "timeout"
+    assert guard.stats()["slow"]["running"] == 0
+
+
+def test_cancelled_probe_does_not_leave_the_breaker_half_open():
+    guard = ToolGuard(deadline=5, bulkhead=2, deadlines={}, bulkheads={})
+    breaker = guard._state("flaky").breaker
+    breaker.failure_threshold = 1
+    breaker.record_failure()
+    # 事件循环也用 time.monotonic，不替换时钟，直接把打开时间往前挪过冷却期
+    breaker.opened_at -= breaker.reset_seconds
+
+    async def hang():
+        await asyncio.sleep(5)
+
+    async def ok():
+        return {"ok": True}
+
+    async def main():
+        probe = asyncio.create_task(guard.call_async("flaky", hang, {}))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert breaker.state == "open"
+        return await guard.call_async("flaky", ok, {})
+
+    assert asyncio.run(main()) == {"ok": True}
+    assert guard.stats()["flaky"] == {
+        "deadline": 5, "bulkhead": 2, "running": 0, "circuit": "closed", "consecutive_failures": 0,
+    }
+
+
+def test_submit_failure_resolves_a_half_open_probe():
+    guard = ToolGuard(deadline=1, bulkhead=1, deadlines={}, bulkheads={})
+    state = guard._state("flaky")
+    state.breaker.failure_threshold = 1
+    state.breaker.record_failure()
+    state.breaker.opened_at -= state.breaker.reset_seconds
+    state.executor.shutdown()
+    assert guard.call("flaky", lambda: "ok", {})["error_type"] == "failed"
+    assert state.breaker.state == "open"
+    assert state.running == 0
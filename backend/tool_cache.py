@@ -0,0 +1,228 @@
+"""工具结果缓存
+
+按“工具名 + 规范化参数”缓存工具结果：
+- 每个工具单独配置TTL（秒），也可以是根据结果计算TTL的函数；未配置的工具（如 apply_leave）不缓存
+- 条目总数有上限，超出时按LRU淘汰
+- 同一个键的并发未命中只会触发一次上游调用（single-flight），其余调用等待并共享结果
+- 带 "error" 字段的结果不写入缓存
+"""
+import os
+import json
+import time
+import asyncio
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+TOOL_CACHE_MAX_ENTRIES = int(os.environ.get("TOOL_CACHE_MAX_ENTRIES", "1024"))
+
+# 高德天气大约每小时发布一次，按 report_time 推算下一次更新时间
+WEATHER_REFRESH_INTERVAL = 3600
+
+
+def weather_ttl(result):
+    """天气结果在高德下一次发布之前保持有效"""
+    try:
+        report_time = datetime.strptime(result["report_time"], "%Y-%m-%d %H:%M:%S")
+    except (KeyError, TypeError, ValueError):
+        return 600
+    remaining = WEATHER_REFRESH_INTERVAL - (datetime.now() - report_time).total_seconds()
+    return max(60, min(WEATHER_REFRESH_INTERVAL, remaining))
+
+
+DEFAULT_TOOL_TTLS = {
+    "get_weather": weather_ttl,
+    "get_douyin_hot": 300,
+    "query_violation_code": 86400,
+    "get_attendance_records": 60,
+    "get_shift_info": 300,
+    "get_attendance_records_range": 60,
+    "get_shift_info_range": 300,
+}
+
+
+def load_tool_ttls():
+    """读取工具TTL配置，TOOL_CACHE_TTLS 环境变量（JSON）可覆盖默认值，设为0表示不缓存"""
+    ttls = dict(DEFAULT_TOOL_TTLS)
+    overrides = os.environ.get("TOOL_CACHE_TTLS")
+    if overrides:
+        ttls.update(json.loads(overrides))
+    return {name: ttl for name, ttl in ttls.items() if ttl}
+
+
+def normalize_arguments(arguments):
+    """规范化工具参数：去掉字符串首尾空白、忽略值为None的参数、按键排序"""
+    normalized = {}
+    for key, value in (arguments or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+        normalized[key] = value
+    return json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+
+
+def new_tool_stats():
+    """创建单个工具的命中统计"""
+    return {"hits": 0, "misses": 0, "coalesced": 0}
+
+
+class _Flight:
+    """一次进行中的上游调用，供并发的相同请求等待"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ToolResultCache:
+    """带TTL、LRU淘汰和single-flight的工具结果缓存"""
+
+    def __init__(self, ttls=None, max_entries=TOOL_CACHE_MAX_ENTRIES):
+        self.ttls = load_tool_ttls() if ttls is None else ttls
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._async_flights = {}
+        self._stats = {}
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, function_name):
+        return function_name in self.ttls
+
+    def _count(self, function_name, field):
+        self._stats.setdefault(function_name, new_tool_stats())[field] += 1
+
+    def _lookup(self, key):
+        """查找未过期的条目，调用方需持有锁"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, function_name, key, result):
+        """写入结果，错误结果不缓存"""
+        if isinstance(result, dict) and "error" in result:
+            return
+        ttl = self.ttls[function_name]
+        if callable(ttl):
+            ttl = ttl(result)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def get_or_compute(self, function_name, arguments, compute):
+        """命中则直接返回缓存结果，否则调用 compute()；相同键的并发未命中共享同一次调用"""
+        if not self.is_cacheable(function_name):
+            return compute()
+
+        key = (function_name, normalize_arguments(arguments))
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self._count(function_name, "hits")
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._count(function_name, "misses")
+            else:
+                self._count(function_name, "coalesced")
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+            self._store(function_name, key, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    async def get_or_compute_async(self, function_name, arguments, compute):
+        """异步版本，compute 为返回协程的函数，single-flight 基于 asyncio.Future
+
+        领头的调用被取消（例如它所在的会话断开）时不把取消传给其他会话的等待者：
+        等待者发现 future 被取消后重新查找，由其中一个接替成为新的领头调用。
+        """
+        if not self.is_cacheable(function_name):
+            return await compute()
+
+        key = (function_name, normalize_arguments(arguments))
+        while True:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    self._count(function_name, "hits")
+                    return entry[1]
+                future = self._async_flights.get(key)
+                leader = future is None
+                if leader:
+                    future = self._async_flights[key] = asyncio.get_running_loop().create_future()
+                    self._count(function_name, "misses")
+                else:
+                    self._count(function_name, "coalesced")
+
+            if leader:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 只有 future 本身被取消（领头调用被取消）时重试，自己被取消时照常退出
+                if not future.cancelled():
+                    raise
+
+        try:
+            result = await compute()
+            self._store(function_name, key, result)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 避免没有等待者时出现 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                if self._async_flights.get(key) is future:
+                    self._async_flights.pop(key)
+
+    def stats(self):
+        """返回每个工具的命中、未命中、合并次数以及缓存容量信息"""
+        with self._lock:
+            return {
+                "tools": {name: dict(counts) for name, counts in self._stats.items()},
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "evictions": self._evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# 全局工具结果缓存
+tool_cache = ToolResultCache()
@@ -0,0 +1,179 @@
+"""流式工具调用组装
+
+模型在流式响应中以增量方式返回工具调用，每个增量带有 index 标明属于第几个调用，
+id 和函数名通常只在第一个增量里出现，参数JSON被切成任意多段。
+
+ToolCallAssembler 按 index 分别拼接每个调用的参数，并对新到达的参数片段做增量扫描
+（跟踪未闭合的括号和字符串状态），最外层对象闭合且能解析时即认为该调用的参数已完整，
+调用方可以立即执行这个工具，而不必等整个流结束。
+"""
+import json
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ArgumentScanner:
+    """增量扫描参数JSON，判断最外层对象是否已经闭合"""
+
+    __slots__ = ("stack", "in_string", "escaped", "started", "closed")
+
+    def __init__(self):
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.closed = False
+
+    def feed(self, fragment):
+        """扫描新片段，最外层对象闭合时返回True"""
+        for char in fragment:
+            if self.closed:
+                break
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.stack.append(char)
+                self.started = True
+            elif char in "}]":
+                if self.stack:
+                    self.stack.pop()
+                if self.started and not self.stack:
+                    self.closed = True
+        return self.closed
+
+    def repair(self, text):
+        """流结束时参数仍未闭合，按打开顺序的相反顺序补全未闭合的括号"""
+        text = text.strip()
+        scanner = self
+        if not text.startswith("{"):
+            # 补上开头的 "{" 后重新扫描，括号栈以补全后的文本为准
+            text = "{" + text
+            scanner = ArgumentScanner()
+            scanner.feed(text)
+        if scanner.in_string:
+            if scanner.escaped:
+                text = text[:-1]
+            text += '"'
+        else:
+            text = text.rstrip(", \t\r\n")
+        return text + "".join("}" if char == "{" else "]" for char in reversed(scanner.stack))
+
+
+class ToolCallAssembler:
+    """按 delta index 组装流式工具调用
+
+    feed() 返回本次增量中参数刚好完整的调用，finish() 在流结束时返回其余调用。
+    每个调用只会被返回一次，格式为::
+
+        {"id": ..., "function": {"name": ..., "arguments": 规范化后的JSON文本},
+         "parsed_arguments": dict}
+
+    参数无法解析的调用带有 "error" 字段，arguments 保留原始文本。
+    """
+
+    def __init__(self):
+        self._calls = []
+        self._slots = {}
+
+    def feed(self, delta_tool_calls):
+        completed = []
+        for delta in delta_tool_calls:
+            call = self._slot_for(delta)
+            function = getattr(delta, "function", None)
+            if function is not None:
+                if function.name and not call["function"]["name"]:
+                    call["function"]["name"] = function.name
+                if function.arguments:
+                    self._append_arguments(call, function.arguments, completed)
+        return completed
+
+    def finish(self):
+        """流结束时收尾：未闭合的参数尝试修复，空参数视为 {}"""
+        completed = []
+        for call in self._calls:
+            if call["done"]:
+                continue
+            text = call["raw"].strip()
+            if not text:
+                self._complete(call, {})
+            else:
+                try:
+                    self._complete(call, json.loads(text))
+                except ValueError:
+                    try:
+                        self._complete(call, json.loads(call["scanner"].repair(text)))
+                    except ValueError as e:
+                        self._fail(call, f"参数不是有效的JSON: {e}")
+            completed.append(call["public"])
+        return completed
+
+    def calls(self):
+        """按出现顺序返回已完成的调用"""
+        return [call["public"] for call in self._calls if call["done"]]
+
+    def _slot_for(self, delta):
+        index = getattr(delta, "index", None)
+        delta_id = getattr(delta, "id", None)
+        if index is None:
+            index = self._calls[-1]["index"] if self._calls else 0
+        call = self._slots.get(index)
+        # 有的服务商对并行调用都用同一个 index，只能通过新的 id 区分
+        if call is not None and delta_id and call["id"] and delta_id != call["id"]:
+            call = None
+        if call is None:
+            call = {
+                "index": index,
+                "id": delta_id,
+                "raw": "",
+                "done": False,
+                "scanner": ArgumentScanner(),
+                "function": {"name": None, "arguments": ""},
+            }
+            self._slots[index] = call
+            self._calls.append(call)
+        elif delta_id and not call["id"]:
+            call["id"] = delta_id
+        return call
+
+    def _append_arguments(self, call, fragment, completed):
+        if call["done"]:
+            if fragment.strip():
+                logger.warning("工具调用 %s 的参数已完整，忽略多余的片段", call["function"]["name"])
+            return
+        call["raw"] += fragment
+        if call["scanner"].feed(fragment):
+            try:
+                arguments = json.loads(call["raw"])
+            except ValueError:
+                # 括号闭合但仍无法解析，等流结束时再处理
+                return
+            self._complete(call, arguments)
+            completed.append(call["public"])
+
+    def _complete(self, call, arguments):
+        call["done"] = True
+        call["public"] = {
+            "id": call["id"] or str(uuid.uuid4()),
+            "function": {
+                "name": call["function"]["name"],
+                "arguments": json.dumps(arguments),
+            },
+            "parsed_arguments": arguments,
+        }
+
+    def _fail(self, call, error):
+        call["done"] = True
+        call["public"] = {
+            "id": call["id"] or str(uuid.uuid4()),
+            "function": {"name": call["function"]["name"], "arguments": call["raw"]},
+            "error": error,
+        }
@@ -0,0 +1,267 @@
+"""工具执行保护：截止时间、隔离舱和熔断器
+
+每个工具单独配置，一个后端变慢或故障只影响它自己的工具：
+- 截止时间：超过时立即给模型返回结构化错误；同步工具无法被强制中断，会在它自己的线程池里
+  继续运行到结束，期间占用的名额不释放；异步工具会被取消
+- 隔离舱：每个工具有自己的并发上限（同步工具还有同样大小的专用线程池），名额用完时直接返回错误，
+  不排队，也不会占满其他工具共用的线程
+- 熔断器：连续失败（抛出异常或超时）达到阈值后打开，冷却期内直接返回错误；冷却结束后放行一个
+  探测调用，成功则关闭，失败则重新打开
+
+返回给模型的错误格式::
+
+    {"error": 说明, "error_type": "timeout" | "circuit_open" | "overloaded" | "failed" | "invalid_arguments",
+     "tool": 工具名, "retryable": 是否值得稍后重试}
+
+工具返回的业务错误（例如违章代码不存在）原样交给模型，不计入熔断。
+
+配置（环境变量）：
+- TOOL_DEADLINE_SECONDS: 默认截止时间（秒），默认 8
+- TOOL_DEADLINES: 按工具覆盖截止时间的JSON，例如 {"get_weather": 5}；日期范围工具一次查询多天，默认 20 秒
+- TOOL_BULKHEAD_SIZE: 每个工具的默认并发上限，默认 8
+- TOOL_BULKHEADS: 按工具覆盖并发上限的JSON
+- TOOL_BREAKER_FAILURES: 连续失败多少次后熔断，默认 5
+- TOOL_BREAKER_RESET_SECONDS: 熔断后的冷却时间（秒），默认 30
+"""
+import os
+import json
+import time
+import asyncio
+import inspect
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TOOL_DEADLINE_SECONDS = float(os.environ.get("TOOL_DEADLINE_SECONDS", "8"))
+TOOL_BULKHEAD_SIZE = int(os.environ.get("TOOL_BULKHEAD_SIZE", "8"))
+TOOL_BREAKER_FAILURES = int(os.environ.get("TOOL_BREAKER_FAILURES", "5"))
+TOOL_BREAKER_RESET_SECONDS = float(os.environ.get("TOOL_BREAKER_RESET_SECONDS", "30"))
+
+DEFAULT_TOOL_DEADLINES = {
+    "get_attendance_records_range": 20,
+    "get_shift_info_range": 20,
+}
+
+TOOL_REJECTIONS = registry.counter(
+    "tool_guard_rejections_total", "Tool calls answered with a guard error", ("tool", "reason"))
+TOOL_CIRCUIT_OPEN = registry.gauge(
+    "tool_circuit_open", "Whether the tool's circuit breaker is open (1) or not (0)", ("tool",))
+
+
+def load_overrides(name, cast):
+    """读取按工具覆盖的配置（JSON对象）"""
+    value = os.environ.get(name)
+    if not value:
+        return {}
+    try:
+        return {tool: cast(setting) for tool, setting in json.loads(value).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.warning("%s 配置无效: %s", name, e)
+        return {}
+
+
+def guard_error(tool, error_type, message, retryable=True):
+    return {"error": message, "error_type": error_type, "tool": tool, "retryable": retryable}
+
+
+class CircuitBreaker:
+    """连续失败计数的熔断器：closed -> open -> half_open -> closed/open"""
+
+    def __init__(self, failure_threshold=TOOL_BREAKER_FAILURES, reset_seconds=TOOL_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """是否放行这次调用；冷却结束后只放行一个探测调用"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        """记录一次失败，返回熔断器是否因此打开"""
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                opened = self.state != "open"
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                return opened
+            return False
+
+    def record_cancelled(self):
+        """调用被取消，结果未知：探测调用被取消时退回 open，冷却已过，下一次调用重新探测"""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+    def retry_after(self):
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+
+class _ToolState:
+    """单个工具的截止时间、隔离舱名额和熔断器"""
+
+    def __init__(self, name, deadline, bulkhead):
+        self.name = name
+        self.deadline = deadline
+        self.bulkhead = bulkhead
+        self.running = 0
+        self.breaker = CircuitBreaker()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def try_enter(self):
+        with self._lock:
+            if self.running >= self.bulkhead:
+                return False
+            self.running += 1
+            return True
+
+    def leave(self, *_):
+        with self._lock:
+            self.running -= 1
+
+    @property
+    def executor(self):
+        # 线程数与隔离舱名额相同，取得名额的调用总有空闲线程
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.bulkhead, thread_name_prefix=f"tool-{self.name}"
+                    )
+        return self._executor
+
+
+class ToolGuard:
+    """按工具施加截止时间、隔离舱和熔断，同步和异步工具函数都可以使用"""
+
+    def __init__(self, deadline=TOOL_DEADLINE_SECONDS, bulkhead=TOOL_BULKHEAD_SIZE,
+                 deadlines=None, bulkheads=None):
+        self.deadline = deadline
+        self.bulkhead = bulkhead
+        if deadlines is None:
+            deadlines = {**DEFAULT_TOOL_DEADLINES, **load_overrides("TOOL_DEADLINES", float)}
+        self.deadlines = deadlines
+        self.bulkheads = load_overrides("TOOL_BULKHEADS", int) if bulkheads is None else bulkheads
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _state(self, name):
+        state = self._states.get(name)
+        if state is None:
+            with self._lock:
+                state = self._states.setdefault(name, _ToolState(
+                    name, self.deadlines.get(name, self.deadline), self.bulkheads.get(name, self.bulkhead)
+                ))
+        return state
+
+    def _admit(self, name, func, arguments):
+        """检查参数、隔离舱和熔断器，不放行时返回 (None, 错误)"""
+        try:
+            inspect.signature(func).bind(**arguments)
+        except TypeError as e:
+            return None, guard_error(name, "invalid_arguments", f"工具参数不正确: {e}", retryable=False)
+        state = self._state(name)
+        if not state.try_enter():
+            TOOL_REJECTIONS.inc(tool=name, reason="overloaded")
+            return None, guard_error(name, "overloaded", f"工具 {name} 当前并发调用过多，请稍后再试")
+        if not state.breaker.allow():
+            state.leave()
+            TOOL_REJECTIONS.inc(tool=name, reason="circuit_open")
+            return None, guard_error(
+                name, "circuit_open",
+                f"工具 {name} 的后端服务近期连续失败，暂停调用，约 {state.breaker.retry_after():.0f} 秒后恢复"
+            )
+        return state, None
+
+    def _failed(self, state, error_type, message):
+        TOOL_REJECTIONS.inc(tool=state.name, reason=error_type)
+        if state.breaker.record_failure():
+            TOOL_CIRCUIT_OPEN.set(1, tool=state.name)
+            logger.warning("工具 %s 连续失败，熔断 %.0f 秒", state.name, state.breaker.reset_seconds)
+        return guard_error(state.name, error_type, message)
+
+    def _succeeded(self, state):
+        if state.breaker.state != "closed":
+            TOOL_CIRCUIT_OPEN.set(0, tool=state.name)
+        state.breaker.record_success()
+
+    def call(self, name, func, arguments):
+        """在工具的专用线程池中执行同步工具函数，最多等待截止时间"""
+        state, error = self._admit(name, func, arguments)
+        if error is not None:
+            return error
+        try:
+            # 复制上下文，工具内发起的LLM请求仍计入当前会话
+            future = state.executor.submit(contextvars.copy_context().run, func, **arguments)
+        except RuntimeError as e:
+            state.leave()
+            return self._failed(state, "failed", f"工具 {name} 无法执行: {e}")
+        # 名额在工具真正结束时才归还，超时后仍在运行的调用继续占用
+        future.add_done_callback(state.leave)
+        try:
+            result = future.result(timeout=state.deadline)
+        except FutureTimeout:
+            logger.warning("工具 %s 超过 %.1f 秒未返回", name, state.deadline, extra={"tool": name})
+            return self._failed(state, "timeout", f"工具 {name} 在 {state.deadline:g} 秒内没有返回")
+        except Exception as e:
+            logger.warning("工具 %s 执行出错: %s", name, e, extra={"tool": name})
+            return self._failed(state, "failed", f"工具 {name} 执行出错: {e}")
+        self._succeeded(state)
+        return result
+
+    async def call_async(self, name, func, arguments):
+        """执行异步工具函数，超过截止时间时取消它"""
+        state, error = self._admit(name, func, arguments)
+        if error is not None:
+            return error
+        try:
+            result = await asyncio.wait_for(func(**arguments), state.deadline)
+        except asyncio.TimeoutError:
+            logger.warning("工具 %s 超过 %.1f 秒未返回", name, state.deadline, extra={"tool": name})
+            return self._failed(state, "timeout", f"工具 {name} 在 {state.deadline:g} 秒内没有返回")
+        except asyncio.CancelledError:
+            # 客户端断开等原因取消了调用，不计成功也不计失败，但不能让熔断器停在 half_open
+            state.breaker.record_cancelled()
+            raise
+        except Exception as e:
+            logger.warning("工具 %s 执行出错: %s", name, e, extra={"tool": name})
+            return self._failed(state, "failed", f"工具 {name} 执行出错: {e}")
+        finally:
+            state.leave()
+        self._succeeded(state)
+        return result
+
+    def stats(self):
+        return {
+            name: {
+                "deadline": state.deadline,
+                "bulkhead": state.bulkhead,
+                "running": state.running,
+                "circuit": state.breaker.state,
+                "consecutive_failures": state.breaker.failures,
+            }
+            for name, state in list(self._states.items())
+        }
+
+
+tool_guard = ToolGuard()
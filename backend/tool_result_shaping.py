@@ -0,0 +1,152 @@
+"""工具结果整形：控制回填给模型的 tool 消息大小
+
+工具结果原样 json.dumps 后会带上错误响应里的 raw_response、多天的天气预报、整张考勤记录表，
+推高提示词token数和工具调用后的首包延迟。回填前按工具整形：
+- 字段白名单：按路径只保留回答需要的字段；错误结果保留说明字段，任何位置的 raw_response 都会去掉
+- 行数上限：列表超过上限时只保留前面的行，并在同一层加上 <字段>_total 记录总行数
+- 紧凑编码：不转义中文、不加空格
+- token上限：编码后仍超过 TOOL_RESULT_MAX_TOKENS 时按比例逐步收紧行数上限，最后按字符截断
+
+只删减字段和行，保留下来的值原样输出，人名、日期、地点等不会被改写。
+SSE 的 tool_result 事件仍然发送完整结果。
+
+规则中的路径用点号连接字段名，列表中的元素与列表本身使用同一路径，例如 "days.records"
+表示 days 列表中每一天的 records 列表；"" 表示结果的顶层。
+
+配置（环境变量）：
+- TOOL_RESULT_SHAPING_ENABLED: 为 0 时不整形，只做紧凑编码，默认 1
+- TOOL_RESULT_MAX_TOKENS: 单个工具结果的token上限，默认 1500
+- TOOL_RESULT_MAX_ROWS: 没有单独配置的列表的行数上限，默认 50
+- TOOL_RESULT_SHAPES: 按工具覆盖规则的JSON，整体替换该工具的默认规则，例如
+  {"get_douyin_hot": {"rows": {"list": 5}, "fields": {"list": ["word"]}}}
+"""
+import os
+import json
+import logging
+
+from context_window import count_text_tokens
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TOOL_RESULT_SHAPING_ENABLED = os.environ.get("TOOL_RESULT_SHAPING_ENABLED", "1") == "1"
+TOOL_RESULT_MAX_TOKENS = int(os.environ.get("TOOL_RESULT_MAX_TOKENS", "1500"))
+TOOL_RESULT_MAX_ROWS = int(os.environ.get("TOOL_RESULT_MAX_ROWS", "50"))
+
+# 结果中不需要交给模型的字段
+DROPPED_FIELDS = {"raw_response"}
+
+TRUNCATED_NOTICE = "…（结果过长，已截断）"
+
+DEFAULT_SHAPES = {
+    "get_weather": {
+        "fields": {
+            "": ["city", "province", "type", "report_time", "weather", "temperature", "humidity",
+                 "wind_direction", "wind_power", "forecasts"],
+            "forecasts": ["date", "week", "dayweather", "nightweather", "daytemp", "nighttemp",
+                          "daywind", "daypower"],
+        },
+        "rows": {"forecasts": 4},
+    },
+    "get_douyin_hot": {
+        "fields": {"list": ["word", "hotindex"]},
+        "rows": {"list": 10},
+    },
+    "query_violation_code": {
+        "rows": {"candidates": 5},
+    },
+    "get_attendance_records": {
+        "rows": {"records": 30},
+    },
+    "get_shift_info": {
+        "rows": {"records": 30},
+    },
+    "get_attendance_records_range": {
+        "rows": {"days": 31, "days.records": 10},
+    },
+    "get_shift_info_range": {
+        "rows": {"days": 31, "days.records": 10},
+    },
+}
+
+TOOL_RESULT_TOKENS = registry.counter(
+    "tool_result_tokens_total", "Tokens of tool results before (estimated) and after shaping", ("tool", "stage"))
+
+
+def load_shapes():
+    """默认规则加上 TOOL_RESULT_SHAPES 的覆盖"""
+    shapes = dict(DEFAULT_SHAPES)
+    overrides = os.environ.get("TOOL_RESULT_SHAPES")
+    if overrides:
+        try:
+            shapes.update(json.loads(overrides))
+        except ValueError as e:
+            logger.warning("TOOL_RESULT_SHAPES 配置无效: %s", e)
+    return shapes
+
+
+def encode(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class ToolResultShaper:
+    """按工具规则整形结果并编码成 tool 消息内容"""
+
+    def __init__(self, shapes=None, max_tokens=TOOL_RESULT_MAX_TOKENS, max_rows=TOOL_RESULT_MAX_ROWS,
+                 enabled=TOOL_RESULT_SHAPING_ENABLED):
+        self.shapes = load_shapes() if shapes is None else shapes
+        self.max_tokens = max_tokens
+        self.max_rows = max_rows
+        self.enabled = enabled
+
+    def project(self, function_name, result, scale=1.0):
+        """按字段白名单和行数上限裁剪结果，scale 用于按比例收紧行数上限"""
+        shape = self.shapes.get(function_name) or {}
+        fields = shape.get("fields") or {}
+        rows = shape.get("rows") or {}
+
+        def walk(value, path):
+            if isinstance(value, dict):
+                # 错误结果（包括 tool_guard 的结构化错误）保留全部说明字段
+                allowed = None if not path and "error" in value else fields.get(path)
+                shaped = {}
+                for key, item in value.items():
+                    if key in DROPPED_FIELDS or (allowed is not None and key not in allowed):
+                        continue
+                    child = f"{path}.{key}" if path else key
+                    if isinstance(item, list):
+                        limit = max(1, int(rows.get(child, self.max_rows) * scale))
+                        if len(item) > limit:
+                            shaped[f"{key}_total"] = len(item)
+                            item = item[:limit]
+                    shaped[key] = walk(item, child)
+                return shaped
+            if isinstance(value, list):
+                return [walk(item, path) for item in value]
+            return value
+
+        return walk(result, "")
+
+    def render(self, function_name, result):
+        """tool 消息的内容"""
+        if not self.enabled:
+            return encode(result)
+        content = encode(self.project(function_name, result))
+        tokens = count_text_tokens(content)
+        scale = 1.0
+        while tokens > self.max_tokens and scale > 0.05:
+            scale *= 0.7
+            content = encode(self.project(function_name, result, scale))
+            tokens = count_text_tokens(content)
+        if tokens > self.max_tokens:
+            # 行数已经收紧到最少仍然超限，按token比例截断字符
+            content = content[:int(len(content) * self.max_tokens / tokens * 0.95)] + TRUNCATED_NOTICE
+            tokens = count_text_tokens(content)
+        # 原始结果只用于指标，不完整分词，按整形后内容的字符/token比例估算
+        raw_tokens = len(encode(result)) * tokens // max(len(content), 1)
+        TOOL_RESULT_TOKENS.inc(raw_tokens, tool=function_name, stage="raw")
+        TOOL_RESULT_TOKENS.inc(tokens, tool=function_name, stage="shaped")
+        return content
+
+
+tool_result_shaper = ToolResultShaper()
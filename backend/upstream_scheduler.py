@@ -0,0 +1,329 @@
+"""上游LLM请求调度
+
+所有发往模型服务的请求先在这里排队取得放行，再发起调用：
+- 令牌桶限制每分钟请求数（RPM）和每分钟token数（TPM）；token数按提示词预估，请求结束后按实际用量校正
+- 并发上限按 AIMD 自适应：收到429时减半，首包延迟超过目标时小幅下调，其余成功的请求缓慢上调
+- 等待中的请求按会话分队并轮流放行，一个会话的大量请求不会让其他会话一直排队；
+  没有会话的请求（历史摘要、批量任务）归入 background 队列，同样参与轮转
+
+限制只在当前进程内生效，多个进程共用同一份配额时需要按进程数分配 RPM/TPM。
+
+配置（环境变量）：
+- UPSTREAM_RPM: 每分钟请求数上限，0 表示不限，默认 0
+- UPSTREAM_TPM: 每分钟token数上限，0 表示不限，默认 0
+- UPSTREAM_MAX_CONCURRENCY: 并发上限能调到的最大值（也是初始值），默认 32
+- UPSTREAM_MIN_CONCURRENCY: 并发上限能调到的最小值，默认 1
+- UPSTREAM_TARGET_LATENCY: 首包延迟目标（秒），超过时下调并发，默认 10
+- UPSTREAM_QUEUE_TIMEOUT: 最长排队时间（秒），超时抛出 UpstreamBusy，默认 60
+- UPSTREAM_EXPECTED_OUTPUT_TOKENS: 预估token数时为输出预留的数量，默认 512
+"""
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+
+from metrics import registry
+
+UPSTREAM_RPM = int(os.environ.get("UPSTREAM_RPM", "0"))
+UPSTREAM_TPM = int(os.environ.get("UPSTREAM_TPM", "0"))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get("UPSTREAM_MAX_CONCURRENCY", "32"))
+UPSTREAM_MIN_CONCURRENCY = int(os.environ.get("UPSTREAM_MIN_CONCURRENCY", "1"))
+UPSTREAM_TARGET_LATENCY = float(os.environ.get("UPSTREAM_TARGET_LATENCY", "10"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", "60"))
+UPSTREAM_EXPECTED_OUTPUT_TOKENS = int(os.environ.get("UPSTREAM_EXPECTED_OUTPUT_TOKENS", "512"))
+
+BACKGROUND_SESSION = "background"
+
+# 延迟超标时并发上限的缩小比例（429时固定减半）
+LATENCY_DECREASE_FACTOR = 0.9
+
+UPSTREAM_QUEUE_DEPTH = registry.gauge(
+    "upstream_queue_depth", "LLM requests waiting for an upstream slot")
+UPSTREAM_IN_FLIGHT = registry.gauge(
+    "upstream_requests_in_flight", "LLM requests currently holding an upstream slot")
+UPSTREAM_CONCURRENCY_LIMIT = registry.gauge(
+    "upstream_concurrency_limit", "Current adaptive upstream concurrency limit")
+UPSTREAM_WAIT = registry.histogram(
+    "upstream_wait_seconds", "Time LLM requests spent queued before being sent upstream")
+UPSTREAM_OUTCOMES = registry.counter(
+    "upstream_requests_total", "Finished upstream LLM requests by outcome", ("outcome",))
+
+# 当前请求所属的会话，由生成入口通过 session_scope() 设置；异步任务和 asyncio.to_thread 自动继承，
+# 线程池不会复制上下文，提交工具时用 contextvars.copy_context().run 传递
+current_session = contextvars.ContextVar("upstream_session", default=None)
+
+
+class UpstreamBusy(Exception):
+    """排队超过 UPSTREAM_QUEUE_TIMEOUT 仍未取得放行"""
+
+
+def is_rate_limited(error):
+    """上游是否因限流拒绝了请求（openai.RateLimitError 或其他带429状态码的异常）"""
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+@contextmanager
+def session_scope(session_id):
+    """在 with 块内发起的LLM请求都计入 session_id 的队列"""
+    token = current_session.set(session_id)
+    try:
+        yield
+    finally:
+        current_session.reset(token)
+
+
+class TokenBucket:
+    """按分钟配额匀速补充的令牌桶，per_minute 为 0 时不限制"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, amount, now):
+        """还需等待多少秒才有 amount 个令牌；超过桶容量的请求按整桶计算，避免永远等不到"""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount):
+        if self.capacity:
+            self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        """按实际用量校正已扣除的令牌，amount 为正表示多用了，允许透支"""
+        if self.capacity:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class Ticket:
+    """一次上游请求的放行凭证，调用方在收到首个数据块和用量时回填"""
+
+    __slots__ = ("session", "tokens", "queued_at", "started_at", "first_token_at",
+                 "used_tokens", "_notify")
+
+    def __init__(self, session, tokens):
+        self.session = session
+        self.tokens = tokens
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.first_token_at = None
+        self.used_tokens = None
+        self._notify = None
+
+    def first_token(self):
+        """记录首个数据块到达的时间，用于判断上游延迟"""
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+
+class UpstreamScheduler:
+    """按会话公平排队的上游限流器，同时支持线程和 asyncio 调用方"""
+
+    def __init__(self, rpm=UPSTREAM_RPM, tpm=UPSTREAM_TPM, max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+                 min_concurrency=UPSTREAM_MIN_CONCURRENCY, target_latency=UPSTREAM_TARGET_LATENCY,
+                 queue_timeout=UPSTREAM_QUEUE_TIMEOUT, expected_output_tokens=UPSTREAM_EXPECTED_OUTPUT_TOKENS):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.target_latency = target_latency
+        self.queue_timeout = queue_timeout
+        self.expected_output_tokens = expected_output_tokens
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._last_decrease = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+        UPSTREAM_CONCURRENCY_LIMIT.set(self.limit)
+
+    # ---- 排队与放行 ----
+
+    def _enqueue(self, session_id, prompt_tokens):
+        ticket = Ticket(session_id or current_session.get() or BACKGROUND_SESSION,
+                        prompt_tokens + self.expected_output_tokens)
+        self._queues.setdefault(ticket.session, deque()).append(ticket)
+        self._queued += 1
+        UPSTREAM_QUEUE_DEPTH.set(self._queued)
+        return ticket
+
+    def _withdraw(self, ticket):
+        """从队列中撤回未放行的凭证，已放行时返回 False"""
+        if ticket.started_at is not None:
+            return False
+        queue = self._queues.get(ticket.session)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.session]
+            self._queued -= 1
+            UPSTREAM_QUEUE_DEPTH.set(self._queued)
+        return True
+
+    def _dispatch(self):
+        """在并发和令牌允许的范围内按会话轮流放行队首请求，须持有锁"""
+        now = time.monotonic()
+        while self._queues and self.in_flight < int(self.limit):
+            session, queue = next(iter(self._queues.items()))
+            ticket = queue[0]
+            delay = max(self._requests.delay(1, now), self._tokens.delay(ticket.tokens, now))
+            if delay > 0:
+                self._wake_after(delay)
+                break
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(session)
+            else:
+                del self._queues[session]
+            self._queued -= 1
+            self._requests.take(1)
+            self._tokens.take(ticket.tokens)
+            self.in_flight += 1
+            ticket.started_at = now
+            ticket._notify()
+        UPSTREAM_QUEUE_DEPTH.set(self._queued)
+        UPSTREAM_IN_FLIGHT.set(self.in_flight)
+
+    def _wake_after(self, delay):
+        # 令牌不足时不轮询，只挂一个定时器在令牌补足时重新放行
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    # ---- 释放与并发自适应 ----
+
+    def release(self, ticket, error=None):
+        """请求结束（包括流读完或中途放弃）时归还并发槽"""
+        with self._lock:
+            self.in_flight -= 1
+            if ticket.used_tokens is not None:
+                self._tokens.adjust(ticket.used_tokens - ticket.tokens)
+            self._adapt(ticket, error)
+            self._dispatch()
+
+    def _adapt(self, ticket, error):
+        now = time.monotonic()
+        if error is not None and not isinstance(error, Exception):
+            # 调用方提前关闭流或任务被取消，不作为上游状况的信号
+            UPSTREAM_OUTCOMES.inc(outcome="cancelled")
+        elif error is not None and is_rate_limited(error):
+            UPSTREAM_OUTCOMES.inc(outcome="rate_limited")
+            self._decrease(ticket, 0.5)
+        elif error is not None:
+            UPSTREAM_OUTCOMES.inc(outcome="error")
+        else:
+            UPSTREAM_OUTCOMES.inc(outcome="ok")
+            latency = (ticket.first_token_at or now) - ticket.started_at
+            if latency > self.target_latency:
+                self._decrease(ticket, LATENCY_DECREASE_FACTOR)
+            else:
+                # 每个并发上限大小的窗口内全部成功约增加 1
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+        UPSTREAM_CONCURRENCY_LIMIT.set(self.limit)
+
+    def _decrease(self, ticket, factor):
+        # 同一波请求只下调一次：上次下调之前发出的请求不再触发下调
+        if ticket.started_at <= self._last_decrease:
+            return
+        self.limit = max(float(self.min_concurrency), self.limit * factor)
+        self._last_decrease = time.monotonic()
+
+    # ---- 调用方接口 ----
+
+    def acquire(self, prompt_tokens=0, session_id=None):
+        """阻塞直到取得放行，返回 Ticket；调用方结束后必须 release()"""
+        granted = threading.Event()
+        with self._lock:
+            ticket = self._enqueue(session_id, prompt_tokens)
+            ticket._notify = granted.set
+            self._dispatch()
+        if not granted.wait(self.queue_timeout):
+            with self._lock:
+                if self._withdraw(ticket):
+                    raise UpstreamBusy(f"上游请求排队超过 {self.queue_timeout:g} 秒")
+        UPSTREAM_WAIT.observe(ticket.started_at - ticket.queued_at)
+        return ticket
+
+    async def acquire_async(self, prompt_tokens=0, session_id=None):
+        """acquire 的异步版本，排队时不占用事件循环"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            # 可能在定时器线程中放行，须切回事件循环设置结果
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        with self._lock:
+            ticket = self._enqueue(session_id, prompt_tokens)
+            ticket._notify = notify
+            self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if self._withdraw(ticket):
+                    raise UpstreamBusy(f"上游请求排队超过 {self.queue_timeout:g} 秒") from None
+        except BaseException as e:
+            with self._lock:
+                withdrawn = self._withdraw(ticket)
+            if not withdrawn:
+                # 取消与放行同时发生：凭证已生效，须归还
+                self.release(ticket, e)
+            raise
+        UPSTREAM_WAIT.observe(ticket.started_at - ticket.queued_at)
+        return ticket
+
+    @contextmanager
+    def slot(self, prompt_tokens=0, session_id=None):
+        """with 块内持有一个上游并发槽，异常会作为自适应的信号"""
+        ticket = self.acquire(prompt_tokens, session_id)
+        try:
+            yield ticket
+        except BaseException as e:
+            self.release(ticket, e)
+            raise
+        self.release(ticket)
+
+    @asynccontextmanager
+    async def slot_async(self, prompt_tokens=0, session_id=None):
+        """slot 的异步版本"""
+        ticket = await self.acquire_async(prompt_tokens, session_id)
+        try:
+            yield ticket
+        except BaseException as e:
+            self.release(ticket, e)
+            raise
+        self.release(ticket)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "queued_sessions": len(self._queues),
+                "in_flight": self.in_flight,
+                "concurrency_limit": round(self.limit, 2),
+                "rpm_available": round(self._requests.tokens, 1) if self._requests.capacity else None,
+                "tpm_available": round(self._tokens.tokens, 1) if self._tokens.capacity else None,
+            }
+
+
+upstream = UpstreamScheduler()
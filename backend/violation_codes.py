@@ -0,0 +1,196 @@
+"""本地违章代码表
+
+违章代码表只有几千条且很少变化，每次查询都请求天行API既慢又消耗配额。
+代码表保存在本地SQLite中，启动时整体载入内存（按代码排序，支持精确和前缀查找）：
+- 精确命中直接返回，不发网络请求
+- 未知代码回退到API，查询成功的结果写回本地表（write-through）
+- 可以从JSON或CSV文件批量导入：python violation_codes.py import codes.json
+- 后台线程定期用API重新查询较旧的条目，保持与上游一致
+
+导入文件格式：JSON数组（每项是一条API返回的 result，必须包含 code 字段），
+或带表头的CSV（必须有 code 列，其余列原样保存）。
+
+配置（环境变量）：
+- VIOLATION_CODE_DB_PATH: 数据库路径，默认 backend/data/violation_codes.db
+- VIOLATION_CODE_IMPORT: 启动时导入的文件路径，已有的代码会被覆盖，默认不导入
+- VIOLATION_CODE_MAX_AGE: 条目超过多少秒后由后台刷新，默认 30 天
+- VIOLATION_CODE_REFRESH_INTERVAL: 后台刷新的间隔（秒），0 表示不刷新，默认 3600
+- VIOLATION_CODE_REFRESH_BATCH: 每次后台刷新的最大条数，默认 20
+"""
+import os
+import csv
+import sys
+import json
+import time
+import bisect
+import logging
+import sqlite3
+import threading
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+VIOLATION_CODE_DB_PATH = os.environ.get(
+    "VIOLATION_CODE_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "violation_codes.db")
+)
+VIOLATION_CODE_IMPORT = os.environ.get("VIOLATION_CODE_IMPORT") or None
+VIOLATION_CODE_MAX_AGE = float(os.environ.get("VIOLATION_CODE_MAX_AGE", str(30 * 86400)))
+VIOLATION_CODE_REFRESH_INTERVAL = float(os.environ.get("VIOLATION_CODE_REFRESH_INTERVAL", "3600"))
+VIOLATION_CODE_REFRESH_BATCH = int(os.environ.get("VIOLATION_CODE_REFRESH_BATCH", "20"))
+
+VIOLATION_CODE_LOOKUPS = registry.counter(
+    "violation_code_lookups_total", "Local violation code table lookups by result", ("result",))
+
+
+def normalize_code(code):
+    return str(code).strip().upper()
+
+
+def read_import_file(path):
+    """读取导入文件，返回条目列表"""
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            return list(csv.DictReader(f))
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    if isinstance(entries, dict):
+        # 兼容 {"list": [...]} 或 {代码: 条目} 两种写法
+        entries = entries.get("list") or [dict(entry, code=code) for code, entry in entries.items()]
+    return entries
+
+
+class ViolationCodeTable:
+    """SQLite持久化、内存索引的违章代码表"""
+
+    def __init__(self, path=VIOLATION_CODE_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._codes = []
+        self._refresher = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS violation_codes (
+                    code TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+        for code, payload in self._conn.execute("SELECT code, payload FROM violation_codes"):
+            self._entries[code] = json.loads(payload)
+        self._codes = sorted(self._entries)
+
+    def get(self, code):
+        """精确查找，没有时返回 None"""
+        entry = self._entries.get(normalize_code(code))
+        VIOLATION_CODE_LOOKUPS.inc(result="miss" if entry is None else "hit")
+        return entry
+
+    def search_prefix(self, prefix, limit=10):
+        """按代码前缀查找，返回最多 limit 条"""
+        prefix = normalize_code(prefix)
+        codes = self._codes
+        start = bisect.bisect_left(codes, prefix)
+        matches = []
+        for code in codes[start:start + limit]:
+            if not code.startswith(prefix):
+                break
+            matches.append(self._entries[code])
+        return matches
+
+    def put_many(self, entries):
+        """写入条目（必须包含 code），返回写入的条数"""
+        rows = []
+        now = time.time()
+        for entry in entries:
+            code = normalize_code(entry.get("code") or "")
+            if not code:
+                continue
+            entry = dict(entry, code=code)
+            rows.append((code, json.dumps(entry, ensure_ascii=False), now, entry))
+        if not rows:
+            return 0
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO violation_codes (code, payload, updated_at) VALUES (?, ?, ?)",
+                        [row[:3] for row in rows]
+                    )
+            except sqlite3.Error as e:
+                logger.warning("写入违章代码表失败: %s", e)
+            new_codes = False
+            for code, _, _, entry in rows:
+                new_codes = new_codes or code not in self._entries
+                self._entries[code] = entry
+            if new_codes:
+                self._codes = sorted(self._entries)
+        return len(rows)
+
+    def put(self, entry):
+        self.put_many([entry])
+
+    def import_file(self, path):
+        count = self.put_many(read_import_file(path))
+        logger.info("从 %s 导入违章代码 %d 条", path, count)
+        return count
+
+    def stale_codes(self, max_age=VIOLATION_CODE_MAX_AGE, limit=VIOLATION_CODE_REFRESH_BATCH):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT code FROM violation_codes WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+                (time.time() - max_age, limit)
+            ).fetchall()
+        return [code for code, in rows]
+
+    def refresh_stale(self, fetch):
+        """用 fetch(code) 重新查询较旧的条目，返回更新的条数"""
+        updated = 0
+        for code in self.stale_codes():
+            try:
+                result = fetch(code)
+            except Exception as e:
+                logger.warning("刷新违章代码 %s 失败: %s", code, e)
+                continue
+            if "error" not in result:
+                self.put(dict(result, code=code))
+                updated += 1
+        return updated
+
+    def start_refresher(self, fetch, interval=VIOLATION_CODE_REFRESH_INTERVAL):
+        """启动后台刷新线程，interval 为 0 时不启动"""
+        if interval <= 0 or self._refresher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    updated = self.refresh_stale(fetch)
+                    if updated:
+                        logger.info("后台刷新违章代码 %d 条", updated)
+                except Exception:
+                    logger.exception("后台刷新违章代码出错")
+
+        self._refresher = threading.Thread(target=run, name="violation-code-refresh", daemon=True)
+        self._refresher.start()
+
+    def stats(self):
+        return {"entries": len(self._entries), "refreshing": self._refresher is not None}
+
+
+violation_codes = ViolationCodeTable()
+if VIOLATION_CODE_IMPORT:
+    violation_codes.import_file(VIOLATION_CODE_IMPORT)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "import":
+        sys.exit("用法: python violation_codes.py import <codes.json|codes.csv>")
+    logging.basicConfig(level=logging.INFO)
+    print(f"导入 {violation_codes.import_file(sys.argv[2])} 条，共 {violation_codes.stats()['entries']} 条")
@@ -3,6 +3,10 @@ import React, { useState, useEffect, useRef } from 'react';
 import './ChatAgent.css';
 import ReactMarkdown from 'react-markdown';
 
+// fetch 流中途断开后的续传次数和间隔
+const MAX_RESUME_ATTEMPTS = 3;
+const RESUME_DELAY_MS = 1000;
+
 const ChatAgent = () => {
   const [input, setInput] = useState('');
   const [messages, setMessages] = useState([]);
@@ -13,6 +17,7 @@ const ChatAgent = () => {
   const [currentToolResult, setCurrentToolResult] = useState(null);
   const messageEndRef = useRef(null);
   const eventSourceRef = useRef(null);
+  const abortControllerRef = useRef(null);
   const [showScrollButton, setShowScrollButton] = useState(false);
   const messagesEndRef = useRef(null);
   const messagesContainerRef = useRef(null);
@@ -25,13 +30,21 @@ const ChatAgent = () => {
     messageEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [messages, streamingMessage]);
 
+  // 关闭当前的流式连接（fetch 流或 EventSource）
+  const closeStream = () => {
+    if (abortControllerRef.current) {
+      abortControllerRef.current.abort();
+      abortControllerRef.current = null;
+    }
+    if (eventSourceRef.current) {
+      eventSourceRef.current.close();
+      eventSourceRef.current = null;
+    }
+  };
+
   // 组件卸载时清理 SSE 连接
   useEffect(() => {
-    return () => {
-      if (eventSourceRef.current) {
-        eventSourceRef.current.close();
-      }
-    };
+    return () => closeStream();
   }, []);
 
   // 检查是否需要显示滚动按钮
@@ -104,90 +117,19 @@ const ChatAgent = () => {
     setCurrentToolResult(null);
     
     // 关闭之前的连接
-    if (eventSourceRef.current) {
-        console.log("关闭现有SSE连接");
-        eventSourceRef.current.close();
-        eventSourceRef.current = null;
-    }
+    closeStream();
 
     try {
-        console.log("发送聊天请求");
-        const response = await fetch('http://localhost:5100/api/chat', {
-            method: 'POST',
-            headers: { 
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            },
-            body: JSON.stringify({
-                message: currentInput,
-                sessionId: sessionId || '',
-                stream: true
-            })
-        });
-        
-        console.log("收到初始响应:", response);
-        
-        if (!response.ok) {
-            const errorText = await response.text();
-            throw new Error(`服务器响应错误 ${response.status}: ${errorText}`);
+        // 浏览器支持读取流式响应体时，用一次 POST 提交消息并在同一连接上接收流
+        if (window.ReadableStream && window.TextDecoder) {
+            await streamChat(currentInput);
+        } else {
+            await startLegacyStream(currentInput);
         }
-        
-        const data = await response.json();
-        console.log("解析响应数据:", data);
-        
-        if (data.error) {
-            throw new Error(data.error);
-        }
-        
-        if (!data.sessionId) {
-            throw new Error("服务器未返回会话ID");
-        }
-        
-        // 设置会话ID
-        setSessionId(data.sessionId);
-        
-        // 构建SSE URL
-        const streamUrl = `http://localhost:5100/api/chat/stream?sessionId=${data.sessionId}`;
-        console.log("准备连接SSE:", streamUrl);
-        
-        // 创建新的EventSource
-        const eventSource = new EventSource(streamUrl);
-        eventSourceRef.current = eventSource;
-        
-        // 设置事件处理器
-        eventSource.onopen = () => {
-            console.log("SSE连接已打开");
-        };
-        
-        eventSource.onerror = (error) => {
-            console.error("SSE错误:", error);
-            if (eventSource.readyState === EventSource.CLOSED) {
-                console.log("SSE连接已关闭");
-                setLoading(false);
-                eventSource.close();
-                eventSourceRef.current = null;
-                
-                // 只在没有收到任何消息时显示错误
-                if (!streamingMessageRef.current) {
-                    setMessages(prev => [...prev, {
-                        type: 'error',
-                        content: "连接已断开，请重试"
-                    }]);
-                }
-            }
-        };
-        
-        eventSource.onmessage = (event) => {
-            console.log("收到SSE消息:", event.data);
-            try {
-                const data = JSON.parse(event.data);
-                handleStreamMessage(data);
-            } catch (error) {
-                console.error("处理SSE消息出错:", error);
-            }
-        };
-        
     } catch (error) {
+        if (error.name === 'AbortError') {
+            return;
+        }
         console.error("请求失败:", error);
         setMessages(prev => [...prev, {
             type: 'error',
@@ -197,6 +139,212 @@ const ChatAgent = () => {
     }
 };
 
+// 单次往返：POST /api/chat/stream，通过 ReadableStream 读取SSE响应；
+// 连接中途断开时带上 Last-Event-ID 重新连接，服务端只补发错过的内容
+const streamChat = async (currentInput) => {
+    const controller = new AbortController();
+    abortControllerRef.current = controller;
+    const state = { sessionId: sessionId || '', lastEventId: '', finished: false };
+
+    console.log("发送流式聊天请求");
+    let openStream = () => fetch('http://localhost:5100/api/chat/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream'
+        },
+        body: JSON.stringify({
+            message: currentInput,
+            sessionId: state.sessionId
+        }),
+        signal: controller.signal
+    });
+
+    for (let attempt = 0; !state.finished; attempt++) {
+        try {
+            const response = await openStream();
+            // 204 表示这次生成已不可续传
+            if (response.status === 204) {
+                break;
+            }
+            if (!response.ok || !response.body) {
+                const errorText = await response.text();
+                throw new Error(`服务器响应错误 ${response.status}: ${errorText}`);
+            }
+            await readEventStream(response, state);
+        } catch (error) {
+            if (error.name === 'AbortError' || !state.lastEventId || attempt >= MAX_RESUME_ATTEMPTS) {
+                throw error;
+            }
+            console.warn("流式连接中断，准备续传:", error);
+        }
+        if (state.finished || !state.lastEventId || attempt >= MAX_RESUME_ATTEMPTS) {
+            break;
+        }
+        await new Promise(resolve => setTimeout(resolve, RESUME_DELAY_MS));
+        openStream = () => fetch(
+            `http://localhost:5100/api/chat/stream?sessionId=${state.sessionId}`,
+            {
+                headers: { 'Accept': 'text/event-stream', 'Last-Event-ID': state.lastEventId },
+                signal: controller.signal
+            }
+        );
+    }
+
+    if (abortControllerRef.current === controller) {
+        abortControllerRef.current = null;
+        controller.abort();
+        if (!state.finished) {
+            setLoading(false);
+            if (!streamingMessageRef.current) {
+                setMessages(prev => [...prev, {
+                    type: 'error',
+                    content: "连接已断开，请重试"
+                }]);
+            }
+        }
+    }
+};
+
+// 读取一个SSE响应体，记录最后的事件ID，读到 done 或 close 时返回
+const readEventStream = async (response, state) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            return;
+        }
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE 事件以空行分隔，最后一段可能不完整，留到下一次读取
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+            const { id, data } = parseSseEvent(event);
+            if (id) {
+                state.lastEventId = id;
+            }
+            if (data === null) {
+                continue;
+            }
+            if (data === 'close') {
+                state.finished = true;
+                return;
+            }
+            try {
+                const message = JSON.parse(data);
+                if (message.type === 'session_id') {
+                    state.sessionId = message.sessionId;
+                    setSessionId(message.sessionId);
+                }
+                handleStreamMessage(message);
+                if (message.type === 'done') {
+                    state.finished = true;
+                    return;
+                }
+            } catch (error) {
+                console.error("处理SSE消息出错:", error);
+            }
+        }
+    }
+};
+
+// 解析一个SSE事件的 id 和 data 字段，没有 data 时 data 为 null
+const parseSseEvent = (event) => {
+    let id = '';
+    const dataLines = [];
+    for (const line of event.split('\n')) {
+        if (line.startsWith('id:')) {
+            id = line.slice(3).trim();
+        } else if (line.startsWith('data:')) {
+            dataLines.push(line.slice(5).replace(/^ /, ''));
+        }
+    }
+    return { id, data: dataLines.length ? dataLines.join('\n') : null };
+};
+
+// 两步流程：先 POST /api/chat 提交消息，再用 EventSource 打开流（不支持流式读取的浏览器）
+const startLegacyStream = async (currentInput) => {
+    console.log("发送聊天请求");
+    const response = await fetch('http://localhost:5100/api/chat', {
+        method: 'POST',
+        headers: { 
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        },
+        body: JSON.stringify({
+            message: currentInput,
+            sessionId: sessionId || '',
+            stream: true
+        })
+    });
+    
+    console.log("收到初始响应:", response);
+    
+    if (!response.ok) {
+        const errorText = await response.text();
+        throw new Error(`服务器响应错误 ${response.status}: ${errorText}`);
+    }
+    
+    const data = await response.json();
+    console.log("解析响应数据:", data);
+    
+    if (data.error) {
+        throw new Error(data.error);
+    }
+    
+    if (!data.sessionId) {
+        throw new Error("服务器未返回会话ID");
+    }
+    
+    // 设置会话ID
+    setSessionId(data.sessionId);
+    
+    // 构建SSE URL
+    const streamUrl = `http://localhost:5100/api/chat/stream?sessionId=${data.sessionId}`;
+    console.log("准备连接SSE:", streamUrl);
+    
+    // 创建新的EventSource
+    const eventSource = new EventSource(streamUrl);
+    eventSourceRef.current = eventSource;
+    
+    // 设置事件处理器
+    eventSource.onopen = () => {
+        console.log("SSE连接已打开");
+    };
+    
+    eventSource.onerror = (error) => {
+        console.error("SSE错误:", error);
+        if (eventSource.readyState === EventSource.CLOSED) {
+            console.log("SSE连接已关闭");
+            setLoading(false);
+            eventSource.close();
+            eventSourceRef.current = null;
+            
+            // 只在没有收到任何消息时显示错误
+            if (!streamingMessageRef.current) {
+                setMessages(prev => [...prev, {
+                    type: 'error',
+                    content: "连接已断开，请重试"
+                }]);
+            }
+        }
+    };
+    
+    eventSource.onmessage = (event) => {
+        console.log("收到SSE消息:", event.data);
+        try {
+            const data = JSON.parse(event.data);
+            handleStreamMessage(data);
+        } catch (error) {
+            console.error("处理SSE消息出错:", error);
+        }
+    };
+};
+
 // 修改消息处理函数
 const handleStreamMessage = React.useCallback((data) => {
     console.log("处理流消息:", data);
@@ -258,7 +406,7 @@ const handleStreamMessage = React.useCallback((data) => {
                 return newMessages;
             });
             
-            // 关闭连接
+            // 关闭EventSource连接；fetch 流在读到 done 后由 streamChat 自行结束
             if (eventSourceRef.current) {
                 eventSourceRef.current.close();
                 eventSourceRef.current = null;
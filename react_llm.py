@@ -1,6 +1,36 @@
 import os
-from openai import OpenAI# 也可以使用OpenAI或其他LLM提供商
-from typing import Dict, Any
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Any, Iterator, Optional, Set, Tuple
+
+# 与对话服务共用上游调度（限流、自适应并发）和服务商池（故障切换，可通过 LLM_PROVIDERS 加入
+# DeepSeek 等其他 OpenAI 兼容服务），见 backend/upstream_scheduler.py、backend/provider_pool.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from context_window import count_messages_tokens  # noqa: E402
+from provider_pool import ProviderPool  # noqa: E402
+from upstream_scheduler import upstream  # noqa: E402
+from log_pipeline import configure_logging  # noqa: E402
+
+logger = logging.getLogger("react_llm")
+
+REACT_MODEL = os.getenv("REACT_MODEL", "qwen-max")
+
+_providers = None
+_providers_lock = threading.Lock()
+
+def get_providers() -> ProviderPool:
+    """返回共享的服务商池，批量模式下各线程复用同一组连接池"""
+    global _providers
+    if _providers is None:
+        with _providers_lock:
+            if _providers is None:
+                _providers = ProviderPool.from_env()
+    return _providers
 
 def react_with_llm(query: str, tools: Dict[str, Any] = None, max_iterations: int = 5):
     """
@@ -14,14 +44,17 @@ def react_with_llm(query: str, tools: Dict[str, Any] = None, max_iterations: int
     Returns:
         LLM的最终回答
     """
-    # 初始化API客户端
-    # client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
-    client = OpenAI(
-    # api_key=os.getenv("deepseek_api_key"),  
-    # base_url="https://api.deepseek.com/v1"
-     api_key=os.getenv("AliDeep"),  
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-)
+    answer, _ = react_with_usage(query, tools, max_iterations)
+    return answer
+
+def react_with_usage(query: str, tools: Dict[str, Any] = None, max_iterations: int = 5) -> Tuple[str, Dict[str, int]]:
+    """
+    与 react_with_llm 相同，同时返回本次调用的token用量
+    
+    Returns:
+        (最终回答, {"prompt_tokens", "completion_tokens", "total_tokens"})
+    """
+    providers = get_providers()
     
     # ReAct模式提示词
     react_prompt = """
@@ -56,16 +89,138 @@ def react_with_llm(query: str, tools: Dict[str, Any] = None, max_iterations: int
     #     max_tokens=4000,
     #     messages=messages
     # )
-    response = client.chat.completions.create(
-        model="qwen-max",
-        messages=messages,
-    )
+    with upstream.slot(count_messages_tokens(messages)) as ticket:
+        response = providers.create(REACT_MODEL, messages=messages)
+        if response.usage:
+            ticket.used_tokens = response.usage.total_tokens
     # 如果需要实现多轮工具调用，这里可以添加解析响应并执行工具的逻辑
     
-    return response.choices[0].message.content
+    usage = response.usage
+    return response.choices[0].message.content, {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "total_tokens": getattr(usage, "total_tokens", 0) or 0,
+    }
+
+class RateLimiter:
+    """按固定间隔放行请求，多个线程共享"""
+    
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_for = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+def iter_batch_items(input_path: str, query_field: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """逐行读取JSONL中的查询，不一次性读入整个文件
+    
+    每行需要一个查询字段（默认依次尝试 query、question、message、body）和可选的 id
+    （依次尝试 id、request_id，没有时使用行号）。不是有效JSON或没有查询字段的行记录警告后跳过。
+    """
+    fields = [query_field] if query_field else ["query", "question", "message", "body"]
+    with open(input_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                logger.warning("第%d行不是有效的JSON，已跳过: %s", line_number, e)
+                continue
+            if not isinstance(record, dict):
+                logger.warning("第%d行不是JSON对象，已跳过", line_number)
+                continue
+            query = next((record[field] for field in fields if record.get(field)), None)
+            if query is None:
+                logger.warning("第%d行没有查询字段，已跳过", line_number)
+                continue
+            item_id = record.get("id") or record.get("request_id") or f"line-{line_number}"
+            yield {"id": str(item_id), "query": query}
+
+def load_finished_ids(output_path: str) -> Set[str]:
+    """读取已有输出中成功完成的条目，续跑时跳过它们"""
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 上次中断时可能留下半行
+                continue
+            if record.get("status") == "ok":
+                finished.add(record["id"])
+    return finished
+
+def run_batch_item(item: Dict[str, Any], tools: Optional[Dict[str, Any]], limiter: RateLimiter) -> Dict[str, Any]:
+    """执行一条查询，返回输出记录"""
+    limiter.acquire()
+    started_at = time.perf_counter()
+    record = {"id": item["id"], "query": item["query"], "model": REACT_MODEL}
+    try:
+        answer, usage = react_with_usage(item["query"], tools=tools)
+        record.update(status="ok", answer=answer, usage=usage)
+    except Exception as e:
+        record.update(status="error", error=str(e))
+    record["latency"] = round(time.perf_counter() - started_at, 3)
+    return record
+
+def run_batch(input_path: str, output_path: str, workers: int = 4, rate: Optional[float] = None,
+              tools: Dict[str, Any] = None, query_field: Optional[str] = None) -> Dict[str, int]:
+    """
+    并发批量执行ReAct查询
+    
+    结果逐条追加到输出JSONL（每条带耗时和token用量）。输出文件中已成功的条目在续跑时跳过，
+    失败的条目会重新执行。同时提交的查询数不超过 workers 的两倍，输入文件按需读取。
+    
+    Returns:
+        {"ok", "error", "skipped", "total_tokens"} 统计
+    """
+    finished = load_finished_ids(output_path)
+    limiter = RateLimiter(rate)
+    summary = {"ok": 0, "error": 0, "skipped": 0, "total_tokens": 0}
+    
+    with open(output_path, "a", encoding="utf-8") as output, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        
+        def write_done(done):
+            for future in done:
+                record = future.result()
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                summary[record["status"]] += 1
+                summary["total_tokens"] += record.get("usage", {}).get("total_tokens", 0)
+                logger.info("[%s] %s %ss", record["status"], record["id"], record["latency"])
+        
+        for item in iter_batch_items(input_path, query_field):
+            if item["id"] in finished:
+                summary["skipped"] += 1
+                continue
+            finished.add(item["id"])
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write_done(done)
+            pending.add(executor.submit(run_batch_item, item, tools, limiter))
+        
+        done, _ = wait(pending)
+        write_done(done)
+    
+    return summary
 
 # 使用示例
-if __name__ == "__main__":
+def run_example():
     # 定义可选工具
     available_tools = {
         "search": {
@@ -81,3 +236,20 @@ if __name__ == "__main__":
     user_question = "我需要设计一个电子商务网站的推荐系统，应该考虑哪些关键因素？"
     answer = react_with_llm(user_question, tools=available_tools)
     print(answer)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        run_example()
+    else:
+        parser = argparse.ArgumentParser(description="批量执行ReAct查询")
+        parser.add_argument("--input", required=True, help="输入JSONL，每行一个查询")
+        parser.add_argument("--output", required=True, help="输出JSONL，已有的成功条目会被跳过")
+        parser.add_argument("--workers", type=int, default=4, help="并发数")
+        parser.add_argument("--rate", type=float, help="每秒最多发起的请求数")
+        parser.add_argument("--query-field", help="查询所在的字段名")
+        args = parser.parse_args()
+        # 进度和跳过的行写入日志，标准输出只保留最终统计
+        configure_logging()
+        summary = run_batch(args.input, args.output, workers=args.workers, rate=args.rate,
+                            query_field=args.query_field)
+        print(json.dumps(summary, ensure_ascii=False))